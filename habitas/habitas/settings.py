@@ -89,6 +89,63 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# Compartilhado entre processos (workers do gunicorn) para propagar a versão
+# das configurações de serviços ecossistêmicos. Em produção com vários hosts,
+# aponte para Redis ou Memcached.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": BASE_DIR / ".django_cache",
+    }
+}
+
+# Número máximo de resultados memoizados por combinação distinta de entradas
+# (dap, altura, espécie...) dos serviços ecossistêmicos (ver main/memo.py)
+
+ECOSYSTEM_SERVICES_MEMO_TAMANHO = 100000
+
+# Orçamento de memória (MB) da matriz amostras x árvores na análise de
+# incerteza por Monte Carlo (ver main/incerteza.py)
+
+ECOSYSTEM_SERVICES_MONTE_CARLO_MEMORIA_MB = 256
+
+# Proteção contra fórmulas caras (ver main/guarda.py): custo máximo por
+# árvore aceito ao salvar no admin (µs), limites da sonda que avalia cada
+# versão da fórmula em um processo separado (segundos, MB, árvores) e parte
+# fixa do tempo limite (s) de cada avaliação real, que cresce com o número
+# de árvores
+
+ECOSYSTEM_SERVICES_ORCAMENTO_US = 500
+ECOSYSTEM_SERVICES_SONDA_TIMEOUT = 5.0
+ECOSYSTEM_SERVICES_SONDA_MEMORIA_MB = 512
+ECOSYSTEM_SERVICES_SONDA_AMOSTRA = 200
+ECOSYSTEM_SERVICES_TEMPO_LIMITE = 5.0
+
+# Lado (m) das células da grade usada para a área da união das copas por
+# bairro (ver main/copa.py)
+
+COPA_RESOLUCAO_M = 0.2
+
+# Tempo (s) que o navegador reutiliza o detalhe de uma árvore do mapa
+# (/api/trees/<id>/) antes de revalidar pelo ETag (ver main/mapa.py)
+
+MAPA_DETALHE_MAX_AGE = 60
+
+# Diretório dos ladrilhos PNG da camada de árvores (/tiles/trees/<z>/<x>/<y>.png),
+# por cidade, versão do inventário e filtros (ver main/ladrilhos.py e o
+# comando seed_map_tiles)
+
+MAPA_LADRILHOS_DIR = BASE_DIR / ".tiles_cache"
+
+# Cidade exibida quando a requisição não informa ?cidade=<slug> e atribuída
+# às árvores fora do limite de todas as cidades (ver main/cidades.py)
+
+CIDADE_PADRAO = 'sao-jose-dos-campos'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -1,12 +1,24 @@
 from django.contrib import admin
 from django.contrib import messages
 from django.contrib.auth.admin import UserAdmin
+from django.core.exceptions import PermissionDenied
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.html import format_html, format_html_join
 from import_export import resources
 from import_export.admin import ImportExportModelAdmin
 from .models import (
-    Tree, Post, CustomUser, Laudo, Notificacao, HistoricoNotificacao,
-    EcosystemServiceConfig, EcosystemServiceHistory
+    Tree, Post, CustomUser, Laudo, Notificacao, HistoricoNotificacao, City, CityCoefficient,
+    EcosystemServiceConfig, EcosystemServiceHistory, EcosystemServiceScenario, Species, SpeciesCoefficient
 )
+from . import guarda
+from .cenarios import ESPECIES_EXIBIDAS, simular_cenario
+from .forms import CenarioServicoForm
+from .formulas import invalidar_formula
+from .materializacao import recalcular_servico
+from .perfil import perfil_servicos
 
 
 class CustomUserAdmin(UserAdmin):
@@ -53,6 +65,7 @@ class TreeResource(resources.ModelResource):
 
 class MedicamentoDataAdmin(ImportExportModelAdmin):
     resource_class = TreeResource
+    list_filter = ['city']
 
 
 # ============ ADMIN PARA SERVIÇOS ECOSSISTÊMICOS ============
@@ -69,14 +82,29 @@ class EcosystemServiceHistoryInline(admin.TabularInline):
         return False
 
 
+class SpeciesCoefficientInline(admin.TabularInline):
+    """Coeficientes que sobrepõem o valor global para uma espécie"""
+    model = SpeciesCoefficient
+    extra = 0
+    autocomplete_fields = ['species']
+    verbose_name_plural = 'Coeficientes por espécie (sobrepõem o valor global)'
+
+
+class CityCoefficientInline(admin.TabularInline):
+    """Coeficientes que sobrepõem o valor global (e o clima) para uma cidade"""
+    model = CityCoefficient
+    extra = 0
+    verbose_name_plural = 'Coeficientes por cidade (sobrepõem o valor global e o clima da cidade)'
+
+
 @admin.register(EcosystemServiceConfig)
 class EcosystemServiceConfigAdmin(admin.ModelAdmin):
     """Admin customizado para configuração de serviços ecossistêmicos"""
     list_display = ['nome', 'codigo', 'categoria', 'ativo', 'valor_monetario_unitario', 'data_atualizacao']
     list_filter = ['ativo', 'categoria', 'data_atualizacao']
     search_fields = ['nome', 'codigo', 'descricao']
-    readonly_fields = ['data_criacao', 'data_atualizacao', 'criado_por']
-    inlines = [EcosystemServiceHistoryInline]
+    readonly_fields = ['data_criacao', 'data_atualizacao', 'criado_por', 'link_cenario', 'estado_execucao', 'estatisticas_execucao']
+    inlines = [SpeciesCoefficientInline, CityCoefficientInline, EcosystemServiceHistoryInline]
     
     fieldsets = (
         ('Informações Básicas', {
@@ -84,8 +112,8 @@ class EcosystemServiceConfigAdmin(admin.ModelAdmin):
             'description': 'Configure o nome, código único e informações básicas do serviço.'
         }),
         ('Cálculo', {
-            'fields': ('formula', 'coeficientes'),
-            'description': 'Fórmula Python que será avaliada. Use variáveis: dap, altura, biomassa, tree. Exemplo: "math.exp(coeficientes[\'BETA0\'] + coeficientes[\'BETA1\'] * math.log(dap) + coeficientes[\'BETA2\'] * math.log(altura)) / 1000"'
+            'fields': ('formula', 'coeficientes', 'distribuicoes', 'estado_execucao', 'estatisticas_execucao', 'link_cenario'),
+            'description': 'Fórmula Python que será avaliada. Use variáveis: dap, altura, biomassa, tree. Exemplo: "math.exp(coeficientes[\'BETA0\'] + coeficientes[\'BETA1\'] * math.log(dap) + coeficientes[\'BETA2\'] * math.log(altura)) / 1000". Distribuições (opcional, para intervalos de incerteza): {"BETA0": {"tipo": "normal", "desvio": 0.05}}; tipos: normal, lognormal, uniforme, triangular.'
         }),
         ('Valoração', {
             'fields': ('valor_monetario_unitario', 'unidade_medida'),
@@ -138,12 +166,129 @@ class EcosystemServiceConfigAdmin(admin.ModelAdmin):
                 pass
         
         super().save_model(request, obj, form, change)
+        # Descarta a fórmula compilada da versão anterior
+        invalidar_formula(obj.pk)
         
         if not change:
             messages.success(request, f'Serviço "{obj.nome}" criado com sucesso!')
         else:
             messages.success(request, f'Serviço "{obj.nome}" atualizado com sucesso!')
     
+    def save_related(self, request, form, formsets, change):
+        """Recalcula o serviço depois de salvar também os coeficientes por espécie"""
+        super().save_related(request, form, formsets, change)
+        obj = form.instance
+        # Os sinais dos coeficientes por espécie avançam data_atualizacao
+        obj.refresh_from_db(fields=['data_atualizacao'])
+        # Recalcula em lote apenas este serviço para todas as árvores
+        recalcular_servico(obj)
+    
+    # ==================== CENÁRIOS "E SE" ====================
+    
+    def get_urls(self):
+        urls = [
+            path(
+                '<path:object_id>/cenario/',
+                self.admin_site.admin_view(self.cenario_view),
+                name='main_ecosystemserviceconfig_cenario',
+            ),
+        ]
+        return urls + super().get_urls()
+    
+    @admin.display(description='Simulação')
+    def link_cenario(self, obj):
+        """Link para simular um rascunho antes de salvar"""
+        if obj is None or obj.pk is None:
+            return 'Salve o serviço para simular cenários.'
+        return format_html(
+            '<a class="button" href="{}">Simular cenário com outra fórmula/coeficientes</a>',
+            reverse('admin:main_ecosystemserviceconfig_cenario', args=[obj.pk]),
+        )
+    
+    @admin.display(description='Execução')
+    def estado_execucao(self, obj):
+        """Resultado da sonda de custo da fórmula salva (ver guarda.py)"""
+        if obj is None or obj.pk is None or not obj.ativo:
+            return '-'
+        motivo = guarda.motivo_degradacao(obj)
+        if motivo:
+            return f'⚠️ Degradado (valor 0): {motivo}'
+        return '✓ Normal'
+    
+    @admin.display(description='Estatísticas de execução')
+    def estatisticas_execucao(self, obj):
+        """Chamadas, latência, erros e retornos 0 acumulados (ver perfil.py)"""
+        if obj is None or obj.pk is None:
+            return '-'
+        linhas = []
+        for caminho, contadores in perfil_servicos.estatisticas(obj.codigo).items():
+            resumo = contadores.resumo()
+            if not resumo['chamadas']:
+                continue
+            linhas.append(format_html(
+                '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td>'
+                '<td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>',
+                'Árvore a árvore' if caminho == 'arvore' else 'Lote',
+                resumo['chamadas'], resumo['arvores'], resumo['tempo_total_ms'], resumo['media_us'],
+                resumo['p50_us'], resumo['p90_us'], resumo['p99_us'], resumo['erros'], resumo['zeros'],
+            ))
+        if not linhas:
+            return 'Nenhuma chamada registrada.'
+        return format_html(
+            '<table><thead><tr><th>Caminho</th><th>Chamadas</th><th>Árvores</th><th>Total (ms)</th>'
+            '<th>Média (µs)</th><th>p50 (µs)</th><th>p90 (µs)</th><th>p99 (µs)</th><th>Erros</th>'
+            '<th>Retornos 0</th></tr></thead><tbody>{}</tbody></table>',
+            format_html_join('', '{}', ((linha,) for linha in linhas)),
+        )
+    
+    def cenario_view(self, request, object_id):
+        """Simula fórmula/coeficientes em rascunho sobre todo o inventário"""
+        servico = self.get_object(request, object_id)
+        if servico is None:
+            raise Http404('Serviço não encontrado')
+        if not self.has_change_permission(request, servico):
+            raise PermissionDenied
+        
+        cenario = None
+        if request.method == 'POST':
+            form = CenarioServicoForm(request.POST, servico=servico)
+            if form.is_valid():
+                cenario = form.save(commit=False)
+                cenario.servico = servico
+                cenario.criado_por = request.user
+                cenario.versao_base = servico.data_atualizacao
+                cenario.resultado = simular_cenario(
+                    servico, cenario.formula, cenario.coeficientes, cenario.valor_monetario_unitario
+                )
+                cenario.save()
+                messages.success(
+                    request,
+                    f'Cenário "{cenario.nome}" simulado para {cenario.resultado["n_arvores"]} árvores '
+                    f'em {cenario.resultado["tempo_ms"]} ms.'
+                )
+        else:
+            if request.GET.get('cenario'):
+                cenario = get_object_or_404(servico.cenarios, pk=request.GET['cenario'])
+            base = cenario or servico
+            form = CenarioServicoForm(servico=servico, initial={
+                'nome': cenario.nome if cenario else f'Rascunho de {servico.nome}',
+                'formula': base.formula,
+                'coeficientes': base.coeficientes,
+                'valor_monetario_unitario': base.valor_monetario_unitario,
+            })
+        
+        context = {
+            **self.admin_site.each_context(request),
+            'title': f'Simular cenário: {servico.nome}',
+            'opts': self.model._meta,
+            'original': servico,
+            'form': form,
+            'cenario': cenario,
+            'especies': cenario.resultado.get('por_especie', [])[:ESPECIES_EXIBIDAS] if cenario else [],
+            'cenarios_anteriores': servico.cenarios.select_related('criado_por')[:20],
+        }
+        return TemplateResponse(request, 'admin/main/ecosystemserviceconfig/cenario.html', context)
+    
     def get_queryset(self, request):
         """Limita acesso apenas a gestores ou superusers"""
         qs = super().get_queryset(request)
@@ -176,6 +321,48 @@ class EcosystemServiceHistoryAdmin(admin.ModelAdmin):
         return False
 
 
+@admin.register(Species)
+class SpeciesAdmin(admin.ModelAdmin):
+    """Admin de espécies, com os parâmetros da curva de crescimento usados na projeção"""
+    list_display = ['name', 'bio_index', 'dap_maximo', 'altura_maxima', 'taxa_crescimento']
+    list_editable = ['dap_maximo', 'altura_maxima', 'taxa_crescimento']
+    search_fields = ['name']
+
+
+@admin.register(City)
+class CityAdmin(admin.ModelAdmin):
+    """Admin de cidades: centro do mapa, geometrias e clima (PRECIPITATION/RADIATION das fórmulas)"""
+    list_display = ['nome', 'slug', 'precipitacao', 'radiacao', 'arquivo_bairros', 'arquivo_limite']
+    prepopulated_fields = {'slug': ['nome']}
+    search_fields = ['nome']
+
+
+@admin.register(EcosystemServiceScenario)
+class EcosystemServiceScenarioAdmin(admin.ModelAdmin):
+    """Admin para cenários simulados (somente leitura)"""
+    list_display = ['nome', 'servico', 'criado_por', 'data_criacao', 'abrir_cenario']
+    list_filter = ['servico', 'data_criacao']
+    search_fields = ['nome', 'servico__nome', 'criado_por__username']
+    readonly_fields = [
+        'servico', 'nome', 'formula', 'coeficientes', 'valor_monetario_unitario',
+        'versao_base', 'resultado', 'criado_por', 'data_criacao'
+    ]
+    
+    @admin.display(description='Resultado')
+    def abrir_cenario(self, obj):
+        url = reverse('admin:main_ecosystemserviceconfig_cenario', args=[obj.servico_id])
+        return format_html('<a href="{}?cenario={}">Ver comparação</a>', url, obj.pk)
+    
+    def has_view_permission(self, request, obj=None):
+        return request.user.is_gestor() or request.user.is_superuser
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 # ============ REGISTROS PADRÃO ============
 
 admin.site.register(CustomUser, CustomUserAdmin)
@@ -0,0 +1,482 @@
+"""
+Avaliação em lote (vetorizada) dos serviços ecossistêmicos.
+
+Os campos usados pelas fórmulas (`dap`, `altura` e os campos de `tree` e da
+espécie que a análise estática da fórmula encontrar, ex.: `bio_index`) são
+carregados uma única vez como arrays numpy e cada fórmula ativa é
+avaliada sobre o inventário inteiro de uma vez. As regras de borda de
+`EcosystemServiceConfig.calcular` são mantidas como máscaras: DAP/altura
+não positivos resultam em 0, NaN/inf resultam em 0 e os valores são
+arredondados para 4 casas.
+
+Árvores com as mesmas entradas (ex.: mesmo DAP, altura e espécie) são
+avaliadas uma única vez por versão da configuração (ver memo.py).
+
+Fórmulas que não podem ser vetorizadas caem, de forma transparente, no
+cálculo árvore a árvore.
+"""
+import time
+
+import numpy as np
+from django.db.models import QuerySet
+
+from . import guarda, memo, perfil
+from .coeficientes import tabela_coeficientes
+from .formulas import (
+    FUNCOES_VETORIZADAS,
+    ArvoresVetorizadas,
+    Dependencias,
+    FormulaNaoVetorizavel,
+    MathVetorizado,
+    RelacaoVetorizada,
+    obter_formula_compilada,
+)
+
+# Mesmos coeficientes usados para a biomassa em EcosystemServiceConfig.calcular
+BIOMASSA_BETA0 = -0.906586
+BIOMASSA_BETA1 = 1.60421
+BIOMASSA_BETA2 = 0.37162
+
+# Colunas sempre carregadas (máscara de validade, presença da espécie e coeficientes por cidade)
+CAMPOS_BASE = ('id', 'dap', 'altura', 'species_id', 'city_id')
+# Campos extras carregados quando as dependências das fórmulas não são informadas
+CAMPOS_PADRAO = ('species__bio_index',)
+
+
+def dependencias_servicos(servicos):
+    """União das dependências das fórmulas dos serviços (ver formulas.analisar_dependencias)"""
+    return Dependencias.unir(obter_formula_compilada(servico).dependencias for servico in servicos)
+
+
+def _campo_concreto(caminho):
+    """Indica se o caminho é uma coluna de Tree ou de Species (um nível de relação)"""
+    from django.core.exceptions import FieldDoesNotExist
+
+    from .models import Species, Tree
+
+    partes = caminho.split('__')
+    modelo = {1: Tree, 2: Species}.get(len(partes))
+    if modelo is None or (len(partes) == 2 and partes[0] != 'species'):
+        return False
+    try:
+        campo = modelo._meta.get_field(partes[-1])
+    except FieldDoesNotExist:
+        return False
+    return campo.concrete and not campo.is_relation
+
+
+def campos_extras(dependencias):
+    """Colunas além de CAMPOS_BASE lidas pelas fórmulas (ex.: species__bio_index)"""
+    return tuple(sorted(
+        campo for campo in dependencias.campos_tree
+        if campo not in CAMPOS_BASE and _campo_concreto(campo)
+    ))
+
+
+def _coluna(valores):
+    """Array numérico (None -> NaN) ou, para campos não numéricos, array de objetos"""
+    if any(isinstance(v, str) for v in valores):
+        return np.array(valores, dtype=object)
+    try:
+        return np.array([np.nan if v is None else v for v in valores], dtype=float)
+    except (TypeError, ValueError):
+        return np.array(valores, dtype=object)
+
+
+class DadosLote:
+    """Colunas do inventário carregadas uma única vez como arrays numpy"""
+
+    def __init__(self, ids, dap, altura, species_id, colunas=None, origem=None, city_id=None):
+        self.ids = ids
+        self.dap = dap
+        self.altura = altura
+        self.species_id = species_id
+        # -1 quando a cidade não é conhecida (coeficientes globais)
+        self.city_id = np.full(len(ids), -1, dtype=np.int64) if city_id is None else city_id
+        # Campos extras lidos pelas fórmulas: caminho do ORM -> array
+        self.colunas = colunas or {}
+        # Queryset ou lista de árvores de onde os dados vieram (usado no fallback)
+        self.origem = origem
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def bio_index(self):
+        return self.colunas.get('species__bio_index')
+
+    def linhas(self, indices):
+        """Sub-lote com as árvores nas posições informadas"""
+        origem = self.origem
+        if origem is not None and not isinstance(origem, QuerySet):
+            origem = [origem[i] for i in indices]
+        return DadosLote(
+            ids=self.ids[indices],
+            dap=self.dap[indices],
+            altura=self.altura[indices],
+            species_id=self.species_id[indices],
+            colunas={campo: valores[indices] for campo, valores in self.colunas.items()},
+            # Um queryset continua válido: o fallback associa os valores pelo id
+            origem=origem,
+            city_id=self.city_id[indices],
+        )
+
+    @classmethod
+    def de(cls, arvores, campos=CAMPOS_PADRAO):
+        """Constrói os arrays a partir de um queryset, de uma lista de Tree ou de outro DadosLote
+
+        `campos` são os campos extras a carregar (ver campos_extras); por padrão
+        apenas o bio_index da espécie.
+        """
+        if isinstance(arvores, DadosLote):
+            return arvores
+        if isinstance(arvores, QuerySet):
+            return cls.do_queryset(arvores, campos)
+        return cls.das_arvores(list(arvores), campos)
+
+    @classmethod
+    def para_servicos(cls, arvores, servicos):
+        """Carrega apenas as colunas que as fórmulas dos serviços usam"""
+        return cls.de(arvores, campos_extras(dependencias_servicos(servicos)))
+
+    @classmethod
+    def do_queryset(cls, queryset, campos=CAMPOS_PADRAO):
+        """Carrega as colunas com uma única consulta values_list
+
+        O JOIN com Species só acontece quando algum campo da espécie é pedido.
+        """
+        campos = tuple(campos)
+        linhas = list(queryset.values_list(*CAMPOS_BASE, *campos))
+        return cls._das_linhas(linhas, campos, origem=queryset)
+
+    @classmethod
+    def das_arvores(cls, arvores, campos=CAMPOS_PADRAO):
+        """Carrega as colunas de instâncias de Tree já em memória
+
+        Espécies que ainda não foram carregadas (sem select_related) são
+        buscadas em uma única consulta, e não uma por árvore.
+        """
+        from .models import Species, Tree
+
+        campos = tuple(campos)
+        campos_especie = [campo.split('__', 1)[1] for campo in campos if campo.startswith('species__')]
+
+        valores_por_especie = {}
+        if campos_especie:
+            pendentes = set()
+            for arvore in arvores:
+                if arvore.species_id is None:
+                    continue
+                if Tree.species.is_cached(arvore) and arvore.species is not None:
+                    valores_por_especie[arvore.species_id] = {
+                        campo: getattr(arvore.species, campo) for campo in campos_especie
+                    }
+                else:
+                    pendentes.add(arvore.species_id)
+            pendentes -= valores_por_especie.keys()
+            if pendentes:
+                for especie in Species.objects.filter(id__in=pendentes).values('id', *campos_especie):
+                    valores_por_especie[especie.pop('id')] = especie
+
+        def valor(arvore, campo):
+            if campo.startswith('species__'):
+                return valores_por_especie.get(arvore.species_id, {}).get(campo.split('__', 1)[1])
+            return getattr(arvore, campo)
+
+        linhas = [
+            (arvore.id, arvore.dap, arvore.altura, arvore.species_id, arvore.city_id,
+             *(valor(arvore, c) for c in campos))
+            for arvore in arvores
+        ]
+        return cls._das_linhas(linhas, campos, origem=arvores)
+
+    @classmethod
+    def _das_linhas(cls, linhas, campos, origem):
+        colunas = list(zip(*linhas)) if linhas else [()] * (len(CAMPOS_BASE) + len(campos))
+        ids, dap, altura, species_id, city_id = colunas[:len(CAMPOS_BASE)]
+        return cls(
+            ids=np.array([-1 if i is None else i for i in ids], dtype=np.int64),
+            dap=np.array(dap, dtype=float),
+            altura=np.array(altura, dtype=float),
+            species_id=np.array([-1 if i is None else i for i in species_id], dtype=np.int64),
+            colunas={campo: _coluna(valores) for campo, valores in zip(campos, colunas[len(CAMPOS_BASE):])},
+            origem=origem,
+            city_id=np.array([-1 if i is None else i for i in city_id], dtype=np.int64),
+        )
+
+
+def _valores_entrada(dados):
+    """Normaliza DAP/altura como em calcular: None/0 viram 0 e invalidam a árvore"""
+    dap = np.nan_to_num(dados.dap, nan=0.0)
+    altura = np.nan_to_num(dados.altura, nan=0.0)
+    validos = (dap > 0) & (altura > 0)
+    return dap, altura, validos
+
+
+def _biomassa(dap, altura, validos):
+    """Biomassa (toneladas) vetorizada; 0 onde DAP/altura são inválidos"""
+    with np.errstate(all='ignore'):
+        biomassa = np.exp(
+            BIOMASSA_BETA0 + BIOMASSA_BETA1 * np.log(dap) + BIOMASSA_BETA2 * np.log(altura)
+        ) / 1000
+    return np.where(validos, biomassa, 0.0)
+
+
+def _contexto_vetorizado(config, dados, dap, altura, biomassa):
+    """Monta o contexto de avaliação com arrays no lugar dos valores escalares"""
+    # Coeficientes sobrepostos por cidade/espécie viram arrays consultados pelo id da cidade/espécie
+    tabela = tabela_coeficientes(config)
+    coeficientes = tabela.colunas(dados.species_id, dados.city_id) if tabela else tabela.globais
+    especie_presente = dados.species_id >= 0
+    campos_tree = {c: v for c, v in dados.colunas.items() if '__' not in c}
+    campos_especie = {c.split('__', 1)[1]: v for c, v in dados.colunas.items() if c.startswith('species__')}
+    tree = ArvoresVetorizadas(
+        **campos_tree,
+        dap=dap,
+        altura=altura,
+        species_id=np.where(especie_presente, dados.species_id, 0),
+        species=RelacaoVetorizada(especie_presente, **campos_especie),
+    )
+    context = {
+        'math': MathVetorizado,
+        'dap': dap,
+        'altura': altura,
+        'biomassa': biomassa,
+        'tree': tree,
+        'coeficientes': coeficientes,
+        'hasattr': hasattr,
+        'getattr': getattr,
+    }
+    for key, value in coeficientes.items():
+        context[key] = value
+    context.update(FUNCOES_VETORIZADAS)
+    return context
+
+
+def _queryset_otimizado(queryset, dependencias):
+    """Aplica select_related/only conforme os campos que a fórmula lê de `tree`"""
+    if dependencias.acesso_dinamico:
+        # Não dá para saber o que a fórmula lê: carrega a árvore completa com a espécie
+        return queryset.select_related('species')
+    campos = {'id', 'dap', 'altura', 'species', 'city'}
+    campos.update(campo for campo in dependencias.campos_tree if _campo_concreto(campo))
+    relacoes = [relacao for relacao in dependencias.relacoes if relacao == 'species']
+    return queryset.select_related(*relacoes).only(*sorted(campos))
+
+
+def _calcular_por_arvore(config, dados, prazo):
+    """Fallback: avalia a fórmula árvore a árvore com EcosystemServiceConfig.calcular
+
+    Levanta guarda.LimiteExcedido quando o relógio passa de `prazo` (perf_counter).
+    """
+    def calcular(arvore):
+        if time.perf_counter() > prazo:
+            raise guarda.LimiteExcedido(f'Cálculo árvore a árvore de {len(dados)} árvores excedeu o tempo limite')
+        return config.calcular(arvore)
+
+    origem = dados.origem
+    if isinstance(origem, QuerySet):
+        arvores = _queryset_otimizado(origem, obter_formula_compilada(config).dependencias)
+        por_id = {arvore.id: calcular(arvore) for arvore in arvores}
+        return np.array([por_id.get(i, 0.0) for i in dados.ids], dtype=float)
+    if origem is None:
+        raise FormulaNaoVetorizavel(f'{config.codigo}: sem árvores de origem para o cálculo individual')
+    return np.array([calcular(arvore) for arvore in origem], dtype=float)
+
+
+def _avaliar(config, compilada, dados, prazo):
+    """Avalia a fórmula vetorizada sobre o lote (sem memoização)"""
+    n = len(dados)
+    dap, altura, validos = _valores_entrada(dados)
+    # A biomassa só é calculada para as fórmulas que a usam
+    biomassa = _biomassa(dap, altura, validos) if compilada.dependencias.usa_biomassa else None
+
+    try:
+        codigo = compilada.codigo_vetorizado
+        context = _contexto_vetorizado(config, dados, dap, altura, biomassa)
+        with np.errstate(all='ignore'):
+            resultado = np.asarray(eval(codigo, {"__builtins__": {}}, context))
+    except (ValueError, ZeroDivisionError, OverflowError):
+        # Erro matemático independente da árvore: calcular retornaria 0 para todas
+        perfil.perfil_servicos.contar(config.codigo, 'lote', zeros=int(validos.sum()))
+        return np.zeros(n)
+    except MemoryError:
+        # Tratado em _calcular_lote (a versão é degradada), sem cair no cálculo árvore a árvore
+        raise
+    except Exception:
+        return _calcular_por_arvore(config, dados, prazo)
+
+    if resultado.dtype.kind not in 'biuf':
+        return _calcular_por_arvore(config, dados, prazo)
+
+    resultado = resultado.astype(float) + np.zeros(n)
+    finitos = np.isfinite(resultado)
+    if not finitos.all():
+        perfil.perfil_servicos.contar(config.codigo, 'lote', zeros=int((validos & ~finitos).sum()))
+    resultado = np.where(validos & finitos, resultado, 0.0)
+    return np.round(resultado, 4)
+
+
+def matriz_entrada(dados, dependencias, por_especie=False, por_cidade=False):
+    """Matriz (árvores x entradas) com os valores que a fórmula lê de cada árvore
+
+    As colunas são a validade da árvore (DAP e altura > 0), DAP e altura
+    quando a fórmula os usa e os campos de `tree` lidos pela fórmula em ordem
+    alfabética, mais o id da espécie e o da cidade no fim quando a
+    configuração tem coeficientes por espécie (`por_especie`) ou por cidade
+    (`por_cidade`).
+    Retorna None quando a fórmula lê algo que não está no lote ou que não é
+    numérico.
+    """
+    if dependencias.acesso_dinamico:
+        return None
+    dap, altura, validos = _valores_entrada(dados)
+    usa_dap, usa_altura = memo.usa_dap_altura(dependencias)
+    colunas = [validos.astype(float)]
+    if usa_dap:
+        colunas.append(dap)
+    if usa_altura:
+        colunas.append(altura)
+    for campo in sorted(dependencias.campos_tree):
+        if campo == 'species':
+            colunas.append((dados.species_id >= 0).astype(float))
+        elif campo == 'dap':
+            colunas.append(dap)
+        elif campo == 'altura':
+            colunas.append(altura)
+        elif campo in ('id', 'species_id'):
+            ids = dados.ids if campo == 'id' else dados.species_id
+            colunas.append(np.where(ids >= 0, ids, np.nan))
+        elif campo in dados.colunas and dados.colunas[campo].dtype.kind in 'biuf':
+            colunas.append(dados.colunas[campo].astype(float))
+        else:
+            return None
+    if por_especie:
+        colunas.append(dados.species_id.astype(float))
+    if por_cidade:
+        colunas.append(dados.city_id.astype(float))
+    return np.column_stack(colunas)
+
+
+def linhas_distintas(matriz):
+    """Índice de um representante de cada linha distinta e o mapeamento linha -> representante"""
+    # Cada linha vira um único valor binário: NaN (ex.: espécie ausente) é comparado pelos bytes
+    matriz = np.ascontiguousarray(matriz)
+    linhas = matriz.view(np.dtype((np.void, matriz.dtype.itemsize * matriz.shape[1]))).ravel()
+    _, indices, inversa = np.unique(linhas, return_index=True, return_inverse=True)
+    return indices, inversa.reshape(-1)
+
+
+def calcular_lote(config, dados, memoizar=True):
+    """Avalia a fórmula de uma configuração sobre todas as árvores do lote
+
+    Cada combinação distinta de entradas é avaliada uma única vez e o
+    resultado é distribuído para as árvores; combinações já vistas nesta
+    versão da configuração vêm da tabela de memoização (ver memo.py).
+    `memoizar=False` avalia direto, para entradas que não se repetem (ex.:
+    DAP/altura projetados) e não devem ocupar a tabela.
+
+    Retorna um array numpy alinhado com `dados.ids`.
+    """
+    n = len(dados)
+    if not config.ativo or n == 0:
+        return np.zeros(n)
+    if not perfil.perfil_servicos.habilitado:
+        return _calcular_lote(config, dados, memoizar)
+
+    inicio = time.perf_counter()
+    falhou = True
+    try:
+        valores = _calcular_lote(config, dados, memoizar)
+        falhou = False
+        return valores
+    finally:
+        perfil.perfil_servicos.registrar(
+            config.codigo, 'lote', time.perf_counter() - inicio, arvores=n, erros=int(falhou)
+        )
+
+
+def _calcular_lote(config, dados, memoizar):
+    n = len(dados)
+    if guarda.motivo_degradacao(config):
+        perfil.perfil_servicos.contar(config.codigo, 'lote', zeros=n)
+        return np.zeros(n)
+    # Tempo limite proporcional ao lote (ver guarda.py): o fallback árvore a árvore para no prazo e
+    # uma avaliação vetorizada que o excede degrada a versão para as chamadas seguintes
+    inicio = time.perf_counter()
+    try:
+        resultado = _calcular_lote_limitado(config, dados, memoizar, inicio + guarda.tempo_limite(n))
+    except (guarda.LimiteExcedido, MemoryError) as e:
+        motivo = e if isinstance(e, guarda.LimiteExcedido) else 'Limite de memória excedido na avaliação'
+        if not guarda.degradar(config, motivo):
+            raise
+        perfil.perfil_servicos.contar(config.codigo, 'lote', zeros=n)
+        return np.zeros(n)
+    guarda.excedeu_tempo(config, inicio, n)
+    return resultado
+
+
+def _calcular_lote_limitado(config, dados, memoizar, prazo):
+    compilada = obter_formula_compilada(config)
+    if not memoizar:
+        return _avaliar(config, compilada, dados, prazo)
+    versao = memo.chave_versao(config)
+    tabela = tabela_coeficientes(config)
+    matriz = matriz_entrada(
+        dados, compilada.dependencias, tabela.por_especie, tabela.por_cidade
+    ) if versao is not None else None
+    if matriz is None:
+        return _avaliar(config, compilada, dados, prazo)
+
+    indices, inversa = linhas_distintas(matriz)
+    # NaN vira None: a chave não depende da representação de NaN
+    unicas = matriz[indices]
+    unicas = np.where(np.isnan(unicas), None, unicas).tolist()
+    chaves = [(versao, *linha) for linha in unicas]
+    memoizados = memo.memo_servicos.obter_varios(chaves)
+    faltantes = [i for i, valor in enumerate(memoizados) if valor is None]
+    valores = np.array([0.0 if valor is None else valor for valor in memoizados])
+
+    if faltantes:
+        calculados = _avaliar(config, compilada, dados.linhas(indices[faltantes]), prazo)
+        valores[faltantes] = calculados
+        memo.memo_servicos.guardar_varios(zip([chaves[i] for i in faltantes], calculados.tolist()))
+
+    return valores[inversa]
+
+
+class ResultadoLote:
+    """Valores de todos os serviços avaliados sobre um lote de árvores"""
+
+    def __init__(self, ids, servicos, valores):
+        self.ids = ids
+        self.servicos = servicos
+        # codigo do serviço -> array de valores físicos alinhado com ids
+        self.valores = valores
+
+    def totais(self):
+        """Retorna dict com o total físico e monetário de cada serviço"""
+        resultado = {}
+        for servico in self.servicos:
+            valor_fisico = float(self.valores[servico.codigo].sum())
+            resultado[servico.codigo] = {
+                'nome': servico.nome,
+                'valor_fisico': valor_fisico,
+                'valor_monetario': servico.calcular_valor_monetario(valor_fisico),
+                'unidade': servico.unidade_medida,
+                'codigo': servico.codigo,
+                'categoria': servico.categoria,
+            }
+        return resultado
+
+
+def evaluate_services(queryset, servicos=None):
+    """Avalia todos os serviços ativos (ou os informados) sobre um queryset de Tree"""
+    if servicos is None:
+        from . import registry
+
+        servicos = registry.servicos_ativos()
+    servicos = list(servicos)
+    dados = DadosLote.para_servicos(queryset, servicos)
+    valores = {servico.codigo: calcular_lote(servico, dados) for servico in servicos}
+    return ResultadoLote(dados.ids, servicos, valores)
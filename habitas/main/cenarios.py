@@ -0,0 +1,153 @@
+"""
+Simulação de cenários "e se" para os serviços ecossistêmicos.
+
+Um gestor pode avaliar uma fórmula/coeficientes em rascunho sobre o
+inventário inteiro antes de salvar a configuração. O rascunho, a
+configuração em vigor e as versões anteriores registradas em
+`EcosystemServiceHistory` são avaliados em lote (numpy) sobre as mesmas
+colunas, carregadas uma única vez, e comparados no total da cidade e por
+espécie.
+"""
+import time
+
+import numpy as np
+
+from .batch import DadosLote, calcular_lote
+from .models import EcosystemServiceConfig, Species, Tree
+
+# Quantidade de espécies com maior diferença exibidas na página do cenário
+ESPECIES_EXIBIDAS = 50
+
+
+def configuracao_rascunho(servico, formula, coeficientes, valor_monetario_unitario):
+    """Cópia não salva da configuração com a fórmula, os coeficientes e o valor do rascunho"""
+    rascunho = EcosystemServiceConfig(
+        nome=servico.nome,
+        codigo=servico.codigo,
+        formula=formula,
+        coeficientes=coeficientes or {},
+        valor_monetario_unitario=valor_monetario_unitario,
+        unidade_medida=servico.unidade_medida,
+        categoria=servico.categoria,
+        ativo=True,
+    )
+    # Os coeficientes por espécie do serviço continuam valendo no rascunho
+    rascunho.origem_coeficientes_id = servico.pk
+    return rascunho
+
+
+def versoes_historico(servico):
+    """Versões anteriores da configuração registradas no histórico, da mais recente à mais antiga
+
+    Cada registro do histórico guarda em `valores_anteriores` a versão que
+    esteve em vigor até a data da alteração.
+    """
+    versoes = []
+    vistas = set()
+    for registro in servico.historico.order_by('-data'):
+        valores = registro.valores_anteriores or {}
+        if not valores.get('formula'):
+            continue
+        chave = (
+            valores['formula'],
+            repr(sorted((valores.get('coeficientes') or {}).items())),
+            valores.get('valor_monetario_unitario'),
+        )
+        if chave in vistas:
+            continue
+        vistas.add(chave)
+        versoes.append({
+            'rotulo': f"Em vigor até {registro.data.strftime('%d/%m/%Y %H:%M')}",
+            'data': registro.data.isoformat(),
+            'config': configuracao_rascunho(
+                servico,
+                valores['formula'],
+                valores.get('coeficientes'),
+                valores.get('valor_monetario_unitario', servico.valor_monetario_unitario) or 0.0,
+            ),
+        })
+    return versoes
+
+
+def _totais(config, valores):
+    valor_fisico = float(valores.sum())
+    return {
+        'valor_fisico': round(valor_fisico, 4),
+        'valor_monetario': config.calcular_valor_monetario(valor_fisico),
+    }
+
+
+def _diferenca(cenario, referencia):
+    delta_fisico = cenario['valor_fisico'] - referencia['valor_fisico']
+    return {
+        'valor_fisico': round(delta_fisico, 4),
+        'valor_monetario': round(cenario['valor_monetario'] - referencia['valor_monetario'], 2),
+        'percentual': (
+            round(delta_fisico / referencia['valor_fisico'] * 100, 2) if referencia['valor_fisico'] else None
+        ),
+    }
+
+
+def _por_especie(servico, rascunho, species_id, atuais, simulados):
+    """Totais atual/cenário por espécie, ordenados pela maior diferença monetária"""
+    especies, inversa = np.unique(species_id, return_inverse=True)
+    soma_atual = np.bincount(inversa, weights=atuais, minlength=len(especies))
+    soma_cenario = np.bincount(inversa, weights=simulados, minlength=len(especies))
+    quantidade = np.bincount(inversa, minlength=len(especies))
+    nomes = dict(Species.objects.filter(id__in=especies[especies >= 0].tolist()).values_list('id', 'name'))
+
+    linhas = []
+    for especie, n, atual, cenario in zip(especies.tolist(), quantidade.tolist(), soma_atual, soma_cenario):
+        atual_monetario = servico.calcular_valor_monetario(float(atual))
+        cenario_monetario = rascunho.calcular_valor_monetario(float(cenario))
+        linhas.append({
+            'species_id': especie if especie >= 0 else None,
+            'nome': nomes.get(especie, 'Sem espécie'),
+            'n_arvores': n,
+            'atual_fisico': round(float(atual), 4),
+            'cenario_fisico': round(float(cenario), 4),
+            'delta_fisico': round(float(cenario - atual), 4),
+            'delta_monetario': round(cenario_monetario - atual_monetario, 2),
+        })
+    linhas.sort(key=lambda linha: abs(linha['delta_monetario']), reverse=True)
+    return linhas
+
+
+def simular_cenario(servico, formula, coeficientes, valor_monetario_unitario, queryset=None):
+    """Avalia o rascunho sobre o inventário e compara com a versão em vigor e com o histórico
+
+    Retorna um dict serializável em JSON (guardado em EcosystemServiceScenario.resultado).
+    """
+    inicio = time.perf_counter()
+    if queryset is None:
+        queryset = Tree.objects.all()
+
+    rascunho = configuracao_rascunho(servico, formula, coeficientes, valor_monetario_unitario)
+    versoes = versoes_historico(servico)
+    dados = DadosLote.para_servicos(queryset, [servico, rascunho, *(versao['config'] for versao in versoes)])
+
+    atuais = calcular_lote(servico, dados)
+    simulados = calcular_lote(rascunho, dados)
+    atual = _totais(servico, atuais)
+    cenario = _totais(rascunho, simulados)
+
+    historico = []
+    for versao in versoes:
+        totais = _totais(versao['config'], calcular_lote(versao['config'], dados))
+        historico.append({
+            'rotulo': versao['rotulo'],
+            'data': versao['data'],
+            **totais,
+            'delta': _diferenca(cenario, totais),
+        })
+
+    return {
+        'n_arvores': len(dados),
+        'unidade': servico.unidade_medida,
+        'atual': atual,
+        'cenario': cenario,
+        'delta': _diferenca(cenario, atual),
+        'por_especie': _por_especie(servico, rascunho, dados.species_id, atuais, simulados),
+        'historico': historico,
+        'tempo_ms': round((time.perf_counter() - inicio) * 1000, 1),
+    }
@@ -0,0 +1,106 @@
+"""
+Cidades (municípios) hospedadas na mesma instalação.
+
+Cada árvore pertence a uma cidade (`Tree.city`). O mapa, os agregados e os
+resultados em cache (versão do inventário, contagens de espécies, cobertura
+de copa) são sempre restritos a uma cidade, com índices compostos que
+começam pela cidade: o inventário de uma cidade grande não pesa nas
+consultas de uma pequena.
+
+O clima da cidade (`precipitacao`, `radiacao`) substitui os coeficientes
+PRECIPITATION e RADIATION das fórmulas nas árvores da cidade; qualquer outro
+coeficiente pode ser sobreposto por cidade com `CityCoefficient` (ver
+coeficientes.py). As cidades ficam em memória junto com as configurações
+ativas (ver registry.py).
+"""
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.http import Http404
+
+from . import geo, registry
+
+# Coeficiente das fórmulas -> campo de City
+CLIMA = {
+    'PRECIPITATION': 'precipitacao',
+    'RADIATION': 'radiacao',
+}
+
+
+def cidade(city_id):
+    """City com o id informado (ou None)"""
+    return registry.cidades().get(city_id)
+
+
+def por_slug(slug):
+    """City com o slug informado (ou None)"""
+    for candidata in registry.cidades().values():
+        if candidata.slug == slug:
+            return candidata
+    return None
+
+
+def cidade_padrao():
+    """Cidade de settings.CIDADE_PADRAO (ou a primeira cadastrada)"""
+    padrao = por_slug(getattr(settings, 'CIDADE_PADRAO', None))
+    if padrao is not None:
+        return padrao
+    return min(registry.cidades().values(), key=lambda c: c.pk, default=None)
+
+
+def cidade_do_comando(slug):
+    """Cidade da opção --cidade de um comando (a padrão quando omitida); CommandError se não existir"""
+    encontrada = por_slug(slug) if slug else cidade_padrao()
+    if encontrada is None:
+        raise CommandError(f'Cidade "{slug}" não encontrada' if slug else 'Nenhuma cidade cadastrada')
+    return encontrada
+
+
+def cidade_da_requisicao(request):
+    """Cidade do parâmetro GET `cidade` (slug) ou a cidade padrão; 404 para slug desconhecido"""
+    slug = request.GET.get('cidade')
+    if not slug:
+        padrao = cidade_padrao()
+        if padrao is None:
+            raise Http404('Nenhuma cidade cadastrada')
+        return padrao
+    encontrada = por_slug(slug)
+    if encontrada is None:
+        raise Http404(f'Cidade "{slug}" não encontrada')
+    return encontrada
+
+
+def cidade_do_ponto(latitude, longitude):
+    """Cidade cujo limite contém o ponto (a cidade padrão quando nenhuma contém)"""
+    if latitude is not None and longitude is not None:
+        for candidata in registry.cidades().values():
+            if geo.dentro_da_cidade([latitude], [longitude], candidata)[0]:
+                return candidata
+    return cidade_padrao()
+
+
+def clima(city_id, chave):
+    """Valor do coeficiente climático (PRECIPITATION/RADIATION) na cidade, ou o padrão de models.py"""
+    from . import models
+
+    encontrada = cidade(city_id)
+    if encontrada is None:
+        return getattr(models, chave)
+    return getattr(encontrada, CLIMA[chave])
+
+
+def sobreposicoes_clima(coeficientes):
+    """{city_id: {chave: valor}} do clima das cidades que difere dos coeficientes globais da configuração
+
+    Coeficientes sorteados (arrays da análise de Monte Carlo) não são
+    sobrepostos: a distribuição é definida sobre o valor global.
+    """
+    resultado = {}
+    for city_id, encontrada in registry.cidades().items():
+        for chave, campo in CLIMA.items():
+            global_ = coeficientes.get(chave)
+            if isinstance(global_, bool) or not isinstance(global_, (int, float)):
+                continue
+            valor = getattr(encontrada, campo)
+            if valor != global_:
+                resultado.setdefault(city_id, {})[chave] = valor
+    return resultado
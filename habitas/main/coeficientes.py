@@ -0,0 +1,120 @@
+"""
+Coeficientes dos serviços ecossistêmicos por cidade e por espécie.
+
+Um `SpeciesCoefficient` sobrepõe, para uma espécie, o valor global de um
+coeficiente da configuração (ex.: DIAMETER_RATIO ou os BETA da alometria);
+as demais espécies continuam com o valor global. Da mesma forma, o clima de
+cada cidade (ver cidades.py) e os `CityCoefficient` sobrepõem o valor global
+nas árvores da cidade. A precedência é global < cidade < espécie.
+
+As sobreposições de uma configuração são carregadas com uma única consulta
+por tipo e versão e guardadas na instância. O cálculo árvore a árvore recebe
+o dicionário de coeficientes já mesclado da (espécie, cidade) (uma consulta
+de dicionário por árvore, sem consultas ao banco); o cálculo em lote recebe,
+para cada coeficiente sobreposto, um array de consulta indexado pelo id da
+espécie ou da cidade.
+"""
+import numpy as np
+
+from . import cidades
+
+
+def _tabela_consulta(valores):
+    """Array indexado pelo id; a última posição vazia faz o id -1 (ausente) cair no valor global"""
+    tabela = np.full(max(valores) + 2, np.nan)
+    tabela[list(valores)] = list(valores.values())
+    return tabela
+
+
+def _consultar(tabela, ids):
+    indices = np.where((ids >= 0) & (ids < len(tabela) - 1), ids, -1)
+    return tabela[indices]
+
+
+class TabelaCoeficientes:
+    """Coeficientes globais e sobreposições por cidade e por espécie de uma configuração"""
+
+    def __init__(self, globais, sobreposicoes, sobreposicoes_cidade=None):
+        self.globais = globais
+        # chave -> {species_id: valor}
+        self.sobreposicoes = sobreposicoes
+        # city_id -> {chave: valor}
+        self.sobreposicoes_cidade = sobreposicoes_cidade or {}
+        self._por_especie = {}
+        for chave, valores in sobreposicoes.items():
+            for species_id, valor in valores.items():
+                self._por_especie.setdefault(species_id, {})[chave] = valor
+        # (species_id, city_id) -> dicionário mesclado, montado na primeira árvore da combinação
+        self._mesclados = {}
+        self._tabelas = {chave: _tabela_consulta(valores) for chave, valores in sobreposicoes.items()}
+        por_chave = {}
+        for city_id, valores in self.sobreposicoes_cidade.items():
+            for chave, valor in valores.items():
+                por_chave.setdefault(chave, {})[city_id] = valor
+        self._tabelas_cidade = {chave: _tabela_consulta(valores) for chave, valores in por_chave.items()}
+
+    def __bool__(self):
+        return self.por_especie or self.por_cidade
+
+    @property
+    def por_especie(self):
+        return bool(self.sobreposicoes)
+
+    @property
+    def por_cidade(self):
+        return bool(self.sobreposicoes_cidade)
+
+    def para_arvore(self, species_id, city_id=None):
+        """Dicionário de coeficientes da árvore (o global quando a espécie e a cidade não têm sobreposições)"""
+        combinacao = (species_id, city_id)
+        mesclados = self._mesclados.get(combinacao)
+        if mesclados is None:
+            da_cidade = self.sobreposicoes_cidade.get(city_id)
+            da_especie = self._por_especie.get(species_id)
+            mesclados = {**self.globais, **(da_cidade or {}), **(da_especie or {})} if da_cidade or da_especie \
+                else self.globais
+            self._mesclados[combinacao] = mesclados
+        return mesclados
+
+    def colunas(self, species_id, city_id=None):
+        """Coeficientes para um lote: arrays alinhados com `species_id` nos sobrepostos, escalares nos demais"""
+        if city_id is None:
+            city_id = np.full(len(species_id), -1, dtype=np.int64)
+        coeficientes = dict(self.globais)
+        for ids, tabelas in ((city_id, self._tabelas_cidade), (species_id, self._tabelas)):
+            for chave, tabela in tabelas.items():
+                valores = _consultar(tabela, ids)
+                if chave in coeficientes:
+                    coeficientes[chave] = np.where(~np.isnan(valores), valores, coeficientes[chave])
+                else:
+                    coeficientes[chave] = valores
+        return coeficientes
+
+
+def tabela_coeficientes(config):
+    """Tabela da configuração, guardada na instância enquanto a versão e os coeficientes forem os mesmos
+
+    Rascunhos não salvos (cenários) usam as sobreposições do serviço indicado
+    em `origem_coeficientes_id`.
+    """
+    marcador = (config.data_atualizacao, id(config.coeficientes))
+    guardada = config.__dict__.get('_tabela_coeficientes')
+    if guardada is not None and guardada[0] == marcador:
+        return guardada[1]
+
+    from .models import CityCoefficient, SpeciesCoefficient
+
+    globais = config.coeficientes if config.coeficientes else {}
+    servico_id = config.pk if config.pk is not None else getattr(config, 'origem_coeficientes_id', None)
+    sobreposicoes = {}
+    sobreposicoes_cidade = cidades.sobreposicoes_clima(globais)
+    if servico_id is not None:
+        linhas = SpeciesCoefficient.objects.filter(servico_id=servico_id).values_list('chave', 'species_id', 'valor')
+        for chave, species_id, valor in linhas:
+            sobreposicoes.setdefault(chave, {})[species_id] = valor
+        linhas = CityCoefficient.objects.filter(servico_id=servico_id).values_list('chave', 'city_id', 'valor')
+        for chave, city_id, valor in linhas:
+            sobreposicoes_cidade.setdefault(city_id, {})[chave] = valor
+    tabela = TabelaCoeficientes(globais, sobreposicoes, sobreposicoes_cidade)
+    config.__dict__['_tabela_coeficientes'] = (marcador, tabela)
+    return tabela
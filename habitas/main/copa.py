@@ -0,0 +1,226 @@
+"""
+Cobertura de copa por bairro.
+
+O diâmetro da copa segue o modelo de `Tree.stormwater_intercepted`:
+diâmetro = dap * DIAMETER_RATIO (dap em cm, copa em cm), com a razão do
+serviço chuva_interceptada (inclusive sobreposições por espécie, ver
+coeficientes.py) ou a constante de models.py quando o serviço não existe.
+
+A área de copa é a área da união dos círculos, sem contar duas vezes as
+copas sobrepostas: as copas são rasterizadas em uma grade de RESOLUCAO_PADRAO
+metros (projeção equiretangular local) e cada célula coberta conta uma única
+vez. A grade nunca é materializada inteira: uma varredura em faixas
+verticais (árvores ordenadas por x, índice espacial por busca binária)
+gera apenas as células cobertas de cada faixa, que são deduplicadas com
+ordenação. Cada célula pertence ao bairro da árvore que a cobre; células de
+árvores cuja copa cruza o limite do bairro são classificadas pelo próprio
+centro com o teste de ponto em polígono.
+
+A cobertura é calculada por cidade, com os bairros da cidade (ver geo.py).
+O resultado é guardado no cache do Django por cidade, versão do inventário
+da cidade (ver inventario.versao_inventario), versão da razão de copa e
+resolução.
+"""
+import math
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from . import geo, registry
+from .coeficientes import tabela_coeficientes
+from .crescimento import SEM_BAIRRO
+from .inventario import versao_inventario
+from .models import DIAMETER_RATIO, Tree
+
+RESOLUCAO_PADRAO = 0.2  # metros
+LARGURA_FAIXA = 250.0  # metros
+# Máximo de pares (árvore, célula candidata) gerados de uma vez
+ELEMENTOS_POR_BLOCO = 2_000_000
+METROS_POR_GRAU_LAT = 110540.0
+METROS_POR_GRAU_LON = 111320.0
+SERVICO_RAZAO = 'chuva_interceptada'
+CHAVE_CACHE = 'copa:{}:{}:{}:{}'
+
+
+class Projecao:
+    """Projeção equiretangular em metros em torno de um ponto de referência"""
+
+    def __init__(self, lat0, lon0):
+        self.lat0 = lat0
+        self.lon0 = lon0
+        self.escala_lon = METROS_POR_GRAU_LON * math.cos(math.radians(lat0))
+
+    def para_metros(self, lat, lon):
+        return (np.asarray(lon) - self.lon0) * self.escala_lon, (np.asarray(lat) - self.lat0) * METROS_POR_GRAU_LAT
+
+    def para_graus(self, x, y):
+        return self.lat0 + np.asarray(y) / METROS_POR_GRAU_LAT, self.lon0 + np.asarray(x) / self.escala_lon
+
+
+def _area_anel(x, y):
+    return abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+
+def areas_bairros(projecao, cidade=None):
+    """Área (m²) de cada bairro, na ordem de geo.nomes_bairros(cidade)"""
+    areas = []
+    for _, poligonos in geo.bairros(cidade):
+        area = 0.0
+        for poligono in poligonos:
+            for i, anel in enumerate(poligono.aneis):
+                x, y = projecao.para_metros(anel[:, 1], anel[:, 0])
+                area += _area_anel(x, y) if i == 0 else -_area_anel(x, y)
+        areas.append(area)
+    return np.array(areas)
+
+
+def razao_copa(species_id, city_id):
+    """Razão diâmetro da copa / DAP de cada árvore e a versão da configuração usada"""
+    servico = registry.servico_ativo(SERVICO_RAZAO)
+    if servico is None or 'DIAMETER_RATIO' not in (servico.coeficientes or {}):
+        return np.full(len(species_id), float(DIAMETER_RATIO)), 'padrao'
+    tabela = tabela_coeficientes(servico)
+    razao = tabela.colunas(species_id, city_id)['DIAMETER_RATIO'] if tabela \
+        else servico.coeficientes['DIAMETER_RATIO']
+    return np.broadcast_to(np.asarray(razao, dtype=float), species_id.shape), str(servico.data_atualizacao)
+
+
+def _celulas(x, y, raio, resolucao):
+    """Pares (índice da árvore, coluna, linha) das células cujo centro está dentro de cada copa"""
+    k = np.ceil(raio / resolucao).astype(np.int64) + 1
+    coluna = np.floor(x / resolucao).astype(np.int64)
+    linha = np.floor(y / resolucao).astype(np.int64)
+    arvores, colunas, linhas = [], [], []
+    for tamanho in np.unique(k):
+        grupo = np.flatnonzero(k == tamanho)
+        passos = np.arange(-tamanho, tamanho + 1)
+        dx, dy = (a.ravel() for a in np.meshgrid(passos, passos))
+        por_bloco = max(1, ELEMENTOS_POR_BLOCO // len(dx))
+        for inicio in range(0, len(grupo), por_bloco):
+            bloco = grupo[inicio:inicio + por_bloco]
+            c = coluna[bloco, None] + dx[None, :]
+            l = linha[bloco, None] + dy[None, :]
+            dentro = ((c + 0.5) * resolucao - x[bloco, None]) ** 2 + ((l + 0.5) * resolucao - y[bloco, None]) ** 2 \
+                <= raio[bloco, None] ** 2
+            indices, _ = np.nonzero(dentro)
+            arvores.append(bloco[indices])
+            colunas.append(c[dentro])
+            linhas.append(l[dentro])
+    if not arvores:
+        vazio = np.zeros(0, dtype=np.int64)
+        return vazio, vazio, vazio
+    return np.concatenate(arvores), np.concatenate(colunas), np.concatenate(linhas)
+
+
+def calcular_cobertura(cidade, queryset=None, resolucao=RESOLUCAO_PADRAO):
+    """Área de copa (união dos círculos) e porcentagem de cobertura de cada bairro da cidade"""
+    inicio = time.perf_counter()
+    if queryset is None:
+        queryset = Tree.objects.filter(city=cidade)
+    linhas = list(queryset.values_list('latitude', 'longitude', 'dap', 'species_id', 'city_id'))
+    lat, lon, dap, species_id, city_id = (
+        np.array(coluna, dtype=float) for coluna in (zip(*linhas) if linhas else ([], [], [], [], []))
+    )
+    species_id = np.nan_to_num(species_id, nan=-1).astype(np.int64)
+    city_id = np.nan_to_num(city_id, nan=-1).astype(np.int64)
+    razao, versao_razao = razao_copa(species_id, city_id)
+    raio = np.where(np.nan_to_num(dap) > 0, np.nan_to_num(dap) * razao / 200, 0.0)  # metros
+    validas = np.isfinite(lat) & np.isfinite(lon) & (raio > 0)
+
+    nomes = geo.nomes_bairros(cidade)
+    projecao = Projecao(float(np.mean(lat[validas])) if validas.any() else cidade.latitude,
+                        float(np.mean(lon[validas])) if validas.any() else cidade.longitude)
+    area_bairro = areas_bairros(projecao, cidade)
+    copa = np.zeros(len(nomes) + 1)  # posição 0: fora dos bairros
+    arvores = np.zeros(len(nomes) + 1, dtype=np.int64)
+
+    lat, lon, raio = lat[validas], lon[validas], raio[validas]
+    x, y = projecao.para_metros(lat, lon)
+    rotulo = geo.bairro_dos_pontos(lat, lon, cidade)
+    arvores += np.bincount(rotulo + 1, minlength=len(nomes) + 1)
+
+    # Copa que cruza o limite do bairro: algum canto do quadrado envolvente fica em outro bairro
+    borda = np.zeros(len(x), dtype=bool)
+    for sx, sy in ((-1, -1), (-1, 1), (1, -1), (1, 1)):
+        lat_canto, lon_canto = projecao.para_graus(x + sx * raio, y + sy * raio)
+        borda |= geo.bairro_dos_pontos(lat_canto, lon_canto, cidade) != rotulo
+
+    # Varredura em faixas verticais: árvores ordenadas por x
+    ordem = np.argsort(x, kind='stable')
+    x, y, raio, rotulo, borda = x[ordem], y[ordem], raio[ordem], rotulo[ordem], borda[ordem]
+    raio_maximo = raio.max() if len(raio) else 0.0
+    colunas_por_faixa = max(1, int(LARGURA_FAIXA / resolucao))
+    if len(x):
+        primeira = int(np.floor((x[0] - raio_maximo) / resolucao))
+        ultima = int(np.floor((x[-1] + raio_maximo) / resolucao))
+    else:
+        primeira, ultima = 0, -1
+    for coluna_inicial in range(primeira, ultima + 1, colunas_por_faixa):
+        coluna_final = coluna_inicial + colunas_por_faixa
+        de = np.searchsorted(x, coluna_inicial * resolucao - raio_maximo, side='left')
+        ate = np.searchsorted(x, coluna_final * resolucao + raio_maximo, side='right')
+        if de == ate:
+            continue
+        faixa = slice(de, ate)
+        indices, c, l = _celulas(x[faixa], y[faixa], raio[faixa], resolucao)
+        na_faixa = (c >= coluna_inicial) & (c < coluna_final)
+        indices, c, l = indices[na_faixa] + de, c[na_faixa], l[na_faixa]
+        if not len(indices):
+            continue
+
+        # Uma célula por posição; se alguma árvore de borda a cobre, ela é a representante
+        chave = (c - coluna_inicial) + l * colunas_por_faixa
+        ordem_celulas = np.lexsort((~borda[indices], chave))
+        chave, indices = chave[ordem_celulas], indices[ordem_celulas]
+        primeiras = np.r_[True, chave[1:] != chave[:-1]]
+        indices = indices[primeiras]
+        c, l = c[ordem_celulas][primeiras], l[ordem_celulas][primeiras]
+
+        rotulos = rotulo[indices].copy()
+        exatas = borda[indices]
+        if exatas.any():
+            lat_celula, lon_celula = projecao.para_graus((c[exatas] + 0.5) * resolucao, (l[exatas] + 0.5) * resolucao)
+            rotulos[exatas] = geo.bairro_dos_pontos(lat_celula, lon_celula, cidade)
+        copa += np.bincount(rotulos + 1, minlength=len(nomes) + 1) * resolucao ** 2
+
+    bairros = {}
+    for i, nome in enumerate(nomes):
+        bairros[nome] = {
+            'area_m2': round(float(area_bairro[i]), 1),
+            'copa_m2': round(float(copa[i + 1]), 1),
+            'cobertura_pct': round(float(copa[i + 1] / area_bairro[i] * 100), 4) if area_bairro[i] else 0.0,
+            'arvores': int(arvores[i + 1]),
+        }
+    area_total = float(area_bairro.sum())
+    return {
+        'cidade': cidade.slug,
+        'resolucao_m': resolucao,
+        'versao_razao': versao_razao,
+        'bairros': bairros,
+        'total': {
+            'area_m2': round(area_total, 1),
+            'copa_m2': round(float(copa[1:].sum()), 1),
+            'cobertura_pct': round(float(copa[1:].sum() / area_total * 100), 4) if area_total else 0.0,
+            'arvores': int(arvores[1:].sum()),
+        },
+        SEM_BAIRRO: {'copa_m2': round(float(copa[0]), 1), 'arvores': int(arvores[0])},
+        'tempo_s': round(time.perf_counter() - inicio, 3),
+    }
+
+
+def cobertura_por_bairro(cidade, resolucao=None, usar_cache=True):
+    """Cobertura de copa do inventário da cidade, calculada uma vez por versão do inventário da cidade"""
+    if resolucao is None:
+        resolucao = getattr(settings, 'COPA_RESOLUCAO_M', RESOLUCAO_PADRAO)
+    servico = registry.servico_ativo(SERVICO_RAZAO)
+    versao_razao = str(servico.data_atualizacao) if servico is not None else 'padrao'
+    chave = CHAVE_CACHE.format(cidade.pk, versao_inventario(cidade), versao_razao, resolucao).replace(' ', '_')
+    if usar_cache:
+        resultado = cache.get(chave)
+        if resultado is not None:
+            return resultado
+    resultado = calcular_cobertura(cidade, resolucao=resolucao)
+    cache.set(chave, resultado, None)
+    return resultado
@@ -0,0 +1,180 @@
+"""
+Projeção de crescimento das árvores e dos serviços ecossistêmicos.
+
+DAP e altura de cada árvore são projetados ano a ano com a curva de von
+Bertalanffy da espécie:
+
+    x(t) = x_max - (x_max - x0) * exp(-k * t)
+
+com `dap_maximo`, `altura_maxima` e `taxa_crescimento` (k) de `Species`
+(valores vazios usam CRESCIMENTO_PADRAO). Os serviços ativos são então
+reavaliados em lote sobre a matriz árvores x anos, em blocos de árvores
+para limitar a memória, e os resultados são acumulados por árvore, por
+bairro e por `plantado_por`.
+
+Serviços medidos por ano (unidade terminada em "/ano", ex.: CO₂ absorvido,
+chuva interceptada) são somados ao longo do horizonte; serviços de estoque
+(ex.: CO₂ armazenado) acumulam o ganho entre o ano 0 e o último ano.
+"""
+import numpy as np
+
+from . import geo
+from .batch import DadosLote, calcular_lote, campos_extras, dependencias_servicos
+from .formulas import FormulaNaoVetorizavel
+
+# Curva usada quando a espécie não tem parâmetros próprios
+CRESCIMENTO_PADRAO = {
+    'dap_maximo': 80.0,        # cm
+    'altura_maxima': 20.0,     # m
+    'taxa_crescimento': 0.03,  # 1/ano
+}
+CAMPOS_CRESCIMENTO = (
+    'species__dap_maximo', 'species__altura_maxima', 'species__taxa_crescimento',
+    'latitude', 'longitude', 'plantado_por',
+)
+# Máximo de elementos (árvores x anos) avaliados de uma vez
+ELEMENTOS_POR_BLOCO = 2_000_000
+SEM_BAIRRO = 'Fora dos bairros'
+
+
+def fluxo_anual(servico):
+    """Indica se o serviço é medido por ano (somado ao longo do horizonte)"""
+    return servico.unidade_medida.strip().endswith('/ano')
+
+
+def _parametro(dados, nome):
+    valores = dados.colunas.get(f'species__{nome}')
+    if valores is None:
+        return np.full(len(dados), CRESCIMENTO_PADRAO[nome])
+    valores = valores.astype(float)
+    return np.where(np.isnan(valores), CRESCIMENTO_PADRAO[nome], valores)
+
+
+def curva(inicial, maximo, taxa, anos):
+    """Matriz (árvores x anos) com o valor projetado pela curva de von Bertalanffy
+
+    Árvores já acima do máximo da espécie permanecem no tamanho atual.
+    """
+    maximo = np.maximum(maximo, inicial)
+    return maximo[:, None] - (maximo - inicial)[:, None] * np.exp(-taxa[:, None] * anos[None, :])
+
+
+def _lote_projetado(dados, dap, altura):
+    """DadosLote com uma linha por (árvore, ano), para avaliar as fórmulas sobre a matriz"""
+    repeticoes = dap.shape[1]
+    return DadosLote(
+        ids=np.repeat(dados.ids, repeticoes),
+        dap=dap.ravel(),
+        altura=altura.ravel(),
+        species_id=np.repeat(dados.species_id, repeticoes),
+        colunas={campo: np.repeat(valores, repeticoes) for campo, valores in dados.colunas.items()},
+        city_id=np.repeat(dados.city_id, repeticoes),
+    )
+
+
+class ResultadoProjecao:
+    """Totais por ano e acumulados por árvore de cada serviço projetado"""
+
+    def __init__(self, anos, ids, servicos, totais_por_ano, acumulado, bairro, plantado_por, nao_vetorizaveis,
+                 cidade=None):
+        self.anos = anos
+        self.ids = ids
+        self.servicos = servicos
+        # codigo -> array (anos + 1) com o total da cidade em cada ano
+        self.totais_por_ano = totais_por_ano
+        # codigo -> array alinhado com ids (soma dos fluxos anuais ou ganho de estoque)
+        self.acumulado = acumulado
+        # Índice em geo.nomes_bairros(cidade) (-1 fora dos bairros) e organização de plantio de cada árvore
+        self.cidade = cidade
+        self.bairro = bairro
+        self.plantado_por = plantado_por
+        # Serviços que não puderam ser projetados (fórmula não vetorizável)
+        self.nao_vetorizaveis = nao_vetorizaveis
+
+    def _agrupar(self, rotulos):
+        grupos, inversa = np.unique(rotulos, return_inverse=True)
+        resultado = {}
+        for servico in self.servicos:
+            if servico.codigo not in self.acumulado:
+                continue
+            somas = np.bincount(inversa.reshape(-1), weights=self.acumulado[servico.codigo], minlength=len(grupos))
+            for grupo, soma in zip(grupos.tolist(), somas.tolist()):
+                resultado.setdefault(grupo, {})[servico.codigo] = round(soma, 4)
+        return resultado
+
+    def por_bairro(self):
+        """Acumulado de cada serviço por bairro"""
+        nomes = np.array(geo.nomes_bairros(self.cidade) + [SEM_BAIRRO], dtype=object)
+        return self._agrupar(nomes[self.bairro])
+
+    def por_plantado_por(self):
+        """Acumulado de cada serviço por organização de plantio"""
+        return self._agrupar(self.plantado_por)
+
+    def por_arvore(self):
+        """Acumulado de cada serviço por árvore: {tree_id: {codigo: valor}}"""
+        codigos = [servico.codigo for servico in self.servicos if servico.codigo in self.acumulado]
+        return {
+            int(tree_id): {codigo: round(float(self.acumulado[codigo][i]), 4) for codigo in codigos}
+            for i, tree_id in enumerate(self.ids)
+        }
+
+
+def projetar_crescimento(queryset, servicos, anos=30, cidade=None):
+    """Projeta DAP/altura por `anos` anos e reavalia os serviços sobre a matriz árvores x anos
+
+    Os bairros são os da `cidade` (o queryset deve estar restrito a ela).
+    """
+    servicos = [servico for servico in servicos if servico.ativo]
+    campos = sorted(set(campos_extras(dependencias_servicos(servicos))) | set(CAMPOS_CRESCIMENTO))
+    dados = DadosLote.de(queryset, campos)
+    n = len(dados)
+    t = np.arange(anos + 1, dtype=float)
+
+    dap_maximo = _parametro(dados, 'dap_maximo')
+    altura_maxima = _parametro(dados, 'altura_maxima')
+    taxa = _parametro(dados, 'taxa_crescimento')
+    # Árvores sem DAP/altura válidos continuam inválidas (valor 0) em todos os anos
+    validos = (np.nan_to_num(dados.dap) > 0) & (np.nan_to_num(dados.altura) > 0)
+
+    totais_por_ano = {servico.codigo: np.zeros(anos + 1) for servico in servicos}
+    acumulado = {servico.codigo: np.zeros(n) for servico in servicos}
+    nao_vetorizaveis = []
+
+    bloco = max(1, ELEMENTOS_POR_BLOCO // (anos + 1))
+    for inicio in range(0, n, bloco):
+        fatia = slice(inicio, min(inicio + bloco, n))
+        sub = dados.linhas(np.arange(fatia.start, fatia.stop))
+        dap = np.where(validos[fatia, None], curva(sub.dap, dap_maximo[fatia], taxa[fatia], t), np.nan)
+        altura = np.where(validos[fatia, None], curva(sub.altura, altura_maxima[fatia], taxa[fatia], t), np.nan)
+        projetado = _lote_projetado(sub, dap, altura)
+
+        for servico in servicos:
+            if servico in nao_vetorizaveis:
+                continue
+            try:
+                valores = calcular_lote(servico, projetado, memoizar=False).reshape(len(sub), anos + 1)
+            except FormulaNaoVetorizavel:
+                nao_vetorizaveis.append(servico)
+                continue
+            totais_por_ano[servico.codigo] += valores.sum(axis=0)
+            if fluxo_anual(servico):
+                acumulado[servico.codigo][fatia] = valores[:, 1:].sum(axis=1)
+            else:
+                acumulado[servico.codigo][fatia] = valores[:, -1] - valores[:, 0]
+
+    for servico in nao_vetorizaveis:
+        del totais_por_ano[servico.codigo]
+        del acumulado[servico.codigo]
+
+    return ResultadoProjecao(
+        anos=t,
+        ids=dados.ids,
+        servicos=servicos,
+        totais_por_ano=totais_por_ano,
+        acumulado=acumulado,
+        bairro=geo.bairro_dos_pontos(dados.colunas['latitude'], dados.colunas['longitude'], cidade),
+        plantado_por=dados.colunas['plantado_por'],
+        nao_vetorizaveis=nao_vetorizaveis,
+        cidade=cidade,
+    )
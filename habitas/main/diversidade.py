@@ -0,0 +1,159 @@
+"""
+Índices de diversidade de espécies por bairro e por seleção de árvores.
+
+`Tree.biodiversity` é o bio_index de uma única árvore; para o planejamento
+interessam índices do conjunto:
+
+    riqueza  S = número de espécies com pelo menos uma árvore
+    Shannon  H = -Σ p_i ln p_i
+    Simpson  1 - Σ n_i (n_i - 1) / (N (N - 1))   (probabilidade de duas
+             árvores sorteadas sem reposição serem de espécies diferentes)
+
+com n_i árvores da espécie i, N = Σ n_i e p_i = n_i / N. Árvores sem
+espécie entram em `arvores` mas não nos índices.
+
+Os índices são calculados a partir da tabela `SpeciesCount` (árvores por
+cidade, bairro, plantado_por e espécie), mantida de forma incremental pelos sinais
+de Tree: cada inserção, alteração ou remoção ajusta no máximo duas linhas,
+em vez de um GROUP BY sobre o inventário a cada consulta. Inserções em massa
+que não disparam sinais (bulk_create, update) exigem
+`python manage.py diversity_indices --reconstruir`.
+
+Filtros que a tabela não cobre (nome, DAP, altura) usam o GROUP BY sobre o
+queryset filtrado (`indices_queryset`).
+"""
+import numpy as np
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from .crescimento import SEM_BAIRRO
+from .models import SpeciesCount, Tree
+
+# Árvores fora de todos os bairros ficam com bairro vazio
+SEM_BAIRRO_TABELA = ''
+
+
+def indices(contagens, sem_especie=0):
+    """Riqueza, Shannon e Simpson de um vetor de árvores por espécie"""
+    n = np.asarray([c for c in contagens if c > 0], dtype=float)
+    total = n.sum()
+    resultado = {
+        'arvores': int(total) + int(sem_especie),
+        'riqueza': int(len(n)),
+        'shannon': 0.0,
+        'simpson': 0.0,
+    }
+    if total > 0:
+        p = n / total
+        resultado['shannon'] = round(float(-(p * np.log(p)).sum()), 4) + 0.0
+    if total > 1:
+        resultado['simpson'] = round(float(1 - (n * (n - 1)).sum() / (total * (total - 1))), 4)
+    return resultado
+
+
+# ==================== TABELA DE CONTAGENS ====================
+
+CAMPOS_CONTAGEM = ('city_id', 'bairro', 'plantado_por', 'species_id')
+
+
+def chave_contagem(tree):
+    """(city_id, bairro, plantado_por, species_id) carregados na instância, ou None se algum foi adiado (only/defer)"""
+    valores = tree.__dict__
+    if any(campo not in valores for campo in CAMPOS_CONTAGEM):
+        return None
+    return (valores['city_id'], valores['bairro'] or '', valores['plantado_por'] or '', valores['species_id'])
+
+
+def ajustar_contagem(chave, delta):
+    """Soma `delta` às árvores da combinação (cidade, bairro, plantado_por, espécie)"""
+    city_id, bairro, plantado_por, species_id = chave
+    linhas = SpeciesCount.objects.filter(
+        city_id=city_id, bairro=bairro, plantado_por=plantado_por, species_id=species_id
+    )
+    if linhas.update(contagem=F('contagem') + delta) or delta <= 0:
+        return
+    try:
+        with transaction.atomic():
+            SpeciesCount.objects.create(
+                city_id=city_id, bairro=bairro, plantado_por=plantado_por, species_id=species_id, contagem=delta
+            )
+    except IntegrityError:
+        # Criada por outra requisição entre o update e o create
+        linhas.update(contagem=F('contagem') + delta)
+
+
+def reconstruir_contagens():
+    """Recria a tabela de contagens a partir de um GROUP BY sobre o inventário"""
+    grupos = Tree.objects.values(*CAMPOS_CONTAGEM).annotate(n=Count('id')).order_by()
+    with transaction.atomic():
+        SpeciesCount.objects.all().delete()
+        SpeciesCount.objects.bulk_create([
+            SpeciesCount(
+                city_id=grupo['city_id'], bairro=grupo['bairro'], plantado_por=grupo['plantado_por'],
+                species_id=grupo['species_id'], contagem=grupo['n'],
+            )
+            for grupo in grupos
+        ], batch_size=500)
+    return len(grupos)
+
+
+# ==================== CONSULTAS ====================
+
+def _agrupar(linhas):
+    """{grupo: ({species_id: n}, sem_especie)} a partir de (grupo, species_id, n)"""
+    grupos = {}
+    for grupo, species_id, n in linhas:
+        por_especie, sem_especie = grupos.get(grupo, ({}, 0))
+        if species_id is None:
+            sem_especie += n
+        else:
+            por_especie[species_id] = por_especie.get(species_id, 0) + n
+        grupos[grupo] = (por_especie, sem_especie)
+    return grupos
+
+
+def _contagens(cidade=None, bairros=None, plantado_por=None, species=None):
+    linhas = SpeciesCount.objects.filter(contagem__gt=0)
+    if cidade is not None:
+        linhas = linhas.filter(city=cidade)
+    if bairros:
+        linhas = linhas.filter(bairro__in=[SEM_BAIRRO_TABELA if b == SEM_BAIRRO else b for b in bairros])
+    if plantado_por:
+        linhas = linhas.filter(plantado_por__icontains=plantado_por)
+    if species:
+        linhas = linhas.filter(species_id=species)
+    return linhas
+
+
+def indices_por_bairro(cidade=None, bairros=None, plantado_por=None, species=None):
+    """{bairro: índices} a partir da tabela de contagens"""
+    linhas = _contagens(cidade, bairros, plantado_por, species).values_list('bairro', 'species_id', 'contagem')
+    return {
+        bairro or SEM_BAIRRO: indices(por_especie.values(), sem_especie)
+        for bairro, (por_especie, sem_especie) in sorted(_agrupar(linhas).items())
+    }
+
+
+def indices_selecao(cidade=None, bairros=None, plantado_por=None, species=None):
+    """Índices do conjunto de árvores da seleção (todas as combinações somadas)"""
+    linhas = _contagens(cidade, bairros, plantado_por, species).values_list('species_id', 'contagem')
+    por_especie, sem_especie = _agrupar((None, species_id, n) for species_id, n in linhas).get(None, ({}, 0))
+    return indices(por_especie.values(), sem_especie)
+
+
+def indices_queryset(queryset):
+    """Índices de um queryset arbitrário de Tree (GROUP BY; para filtros fora da tabela)"""
+    linhas = queryset.values('species_id').annotate(n=Count('id')).order_by().values_list('species_id', 'n')
+    por_especie, sem_especie = _agrupar((None, species_id, n) for species_id, n in linhas).get(None, ({}, 0))
+    return indices(por_especie.values(), sem_especie)
+
+
+def indices_queryset_por_bairro(queryset):
+    """{bairro: índices} de um queryset arbitrário de Tree (GROUP BY)"""
+    linhas = queryset.values('bairro', 'species_id').annotate(n=Count('id')).order_by().values_list(
+        'bairro', 'species_id', 'n'
+    )
+    return {
+        bairro or SEM_BAIRRO: indices(por_especie.values(), sem_especie)
+        for bairro, (por_especie, sem_especie) in sorted(_agrupar(linhas).items())
+    }
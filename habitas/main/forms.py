@@ -1,6 +1,9 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
-from .models import CustomUser, Laudo, Notificacao
+from . import guarda
+from .cenarios import configuracao_rascunho
+from .formulas import compilar_formula
+from .models import CustomUser, EcosystemServiceScenario, Laudo, Notificacao
 
 
 class CidadaoRegistrationForm(UserCreationForm):
@@ -97,3 +100,52 @@ class AprovacaoTecnicoForm(forms.ModelForm):
         widgets = {
             'aprovacao_status': forms.Select(attrs={'class': 'form-control'}),
         }
+
+
+class CenarioServicoForm(forms.ModelForm):
+    """Formulário do admin para simular fórmula/coeficientes em rascunho
+
+    O rascunho passa pela mesma proteção do admin da configuração
+    (guarda.validar_formula) antes de ser simulado sobre o inventário.
+    """
+
+    def __init__(self, *args, servico=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.servico = servico
+    
+    class Meta:
+        model = EcosystemServiceScenario
+        fields = ['nome', 'formula', 'coeficientes', 'valor_monetario_unitario']
+        widgets = {
+            'nome': forms.TextInput(attrs={'class': 'vTextField'}),
+            'formula': forms.Textarea(attrs={'class': 'vLargeTextField', 'rows': 4}),
+            'coeficientes': forms.Textarea(attrs={'class': 'vLargeTextField', 'rows': 6}),
+        }
+    
+    def clean_formula(self):
+        formula = self.cleaned_data['formula']
+        try:
+            compilar_formula(formula)
+        except SyntaxError as e:
+            raise forms.ValidationError(f"Fórmula inválida: {e.msg}")
+        return formula
+    
+    def clean_coeficientes(self):
+        coeficientes = self.cleaned_data['coeficientes']
+        if not isinstance(coeficientes, dict):
+            raise forms.ValidationError("Os coeficientes devem ser um objeto JSON (ex.: {\"BETA0\": -0.9})")
+        return coeficientes
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        formula = cleaned_data.get('formula')
+        if self.servico is None or not formula or 'coeficientes' not in cleaned_data:
+            return cleaned_data
+        rascunho = configuracao_rascunho(
+            self.servico, formula, cleaned_data['coeficientes'], cleaned_data.get('valor_monetario_unitario') or 0
+        )
+        try:
+            guarda.validar_formula(rascunho)
+        except guarda.FormulaRejeitada as e:
+            self.add_error('formula', str(e))
+        return cleaned_data
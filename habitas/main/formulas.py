@@ -0,0 +1,406 @@
+"""
+Compilação e cache das fórmulas dos serviços ecossistêmicos.
+
+Cada fórmula de `EcosystemServiceConfig` é compilada uma única vez para um
+code object reutilizável. O cache é indexado pelo pk da configuração e por
+`data_atualizacao`, de modo que uma nova versão salva no admin gera uma nova
+entrada automaticamente.
+
+Além do code object usado por `calcular` (uma árvore por vez), cada versão
+pode gerar uma variante vetorizada, em que `math.*` é mapeado para `numpy` e
+as construções condicionais (`x if cond else y`, `and`, `or`, `not`,
+`is None`) são reescritas para operar elemento a elemento sobre arrays.
+"""
+import ast
+
+import numpy as np
+
+
+class FormulaCompilada:
+    """Artefatos derivados de uma versão da fórmula, construídos sob demanda"""
+
+    def __init__(self, formula):
+        self.formula = formula
+        self.codigo = compilar_formula(formula)
+        self._codigo_vetorizado = None
+        self._dependencias = None
+
+    @property
+    def dependencias(self):
+        """Entradas usadas pela fórmula (ver analisar_dependencias)"""
+        if self._dependencias is None:
+            self._dependencias = analisar_dependencias(self.formula)
+        return self._dependencias
+
+    @property
+    def codigo_vetorizado(self):
+        """Code object da variante vetorizada (numpy) da fórmula"""
+        if self._codigo_vetorizado is None:
+            self._codigo_vetorizado = compilar_formula_vetorizada(self.formula)
+        return self._codigo_vetorizado
+
+
+# Cache: pk da configuração -> ((pk, data_atualizacao), FormulaCompilada)
+_cache_formulas = {}
+
+
+def compilar_formula(formula):
+    """Compila a string da fórmula para um code object avaliável com eval()"""
+    return compile(formula, '<formula>', 'eval')
+
+
+def obter_formula_compilada(config):
+    """Retorna a FormulaCompilada da configuração, compilando apenas uma vez por versão"""
+    if config.pk is None:
+        # Configuração ainda não salva: não há versão para indexar o cache
+        return FormulaCompilada(config.formula)
+
+    chave = (config.pk, config.data_atualizacao)
+    entrada = _cache_formulas.get(config.pk)
+    # A fórmula também é comparada para cobrir edições em memória ainda não salvas
+    if entrada is not None and entrada[0] == chave and entrada[1].formula == config.formula:
+        return entrada[1]
+
+    compilada = FormulaCompilada(config.formula)
+    _cache_formulas[config.pk] = (chave, compilada)
+    return compilada
+
+
+def invalidar_formula(pk=None):
+    """Remove do cache a fórmula de uma configuração (ou todas, se pk for None)"""
+    if pk is None:
+        _cache_formulas.clear()
+    else:
+        _cache_formulas.pop(pk, None)
+
+
+# ============ ANÁLISE DE DEPENDÊNCIAS ============
+
+# Nomes que o contexto de avaliação sempre fornece; os demais são coeficientes
+NOMES_CONTEXTO = {'math', 'dap', 'altura', 'biomassa', 'tree', 'coeficientes', 'hasattr', 'getattr'}
+
+
+class Dependencias:
+    """Entradas usadas por uma fórmula, obtidas por análise estática da AST
+
+    - variaveis: nomes do contexto usados (dap, altura, biomassa, tree...)
+    - coeficientes: chaves de coeficientes lidas (coeficientes["X"] ou X)
+    - campos_tree: caminhos lidos a partir de `tree`, no formato do ORM
+      (ex.: "dap", "species", "species__bio_index")
+    - acesso_dinamico: `tree` é usado de forma que a análise não consegue
+      resolver (ex.: getattr com nome variável); exige o objeto completo
+    """
+
+    def __init__(self, variaveis=(), coeficientes=(), campos_tree=(), acesso_dinamico=False):
+        self.variaveis = frozenset(variaveis)
+        self.coeficientes = frozenset(coeficientes)
+        self.campos_tree = frozenset(campos_tree)
+        self.acesso_dinamico = acesso_dinamico
+
+    @property
+    def usa_biomassa(self):
+        return 'biomassa' in self.variaveis
+
+    @property
+    def relacoes(self):
+        """Relações de Tree acessadas (candidatas a select_related)"""
+        return frozenset(campo.split('__')[0] for campo in self.campos_tree if '__' in campo) | (
+            frozenset(['species']) & self.campos_tree
+        )
+
+    @classmethod
+    def unir(cls, dependencias):
+        """Dependências combinadas de várias fórmulas"""
+        dependencias = list(dependencias)
+        return cls(
+            variaveis=set().union(*(d.variaveis for d in dependencias)),
+            coeficientes=set().union(*(d.coeficientes for d in dependencias)),
+            campos_tree=set().union(*(d.campos_tree for d in dependencias)),
+            acesso_dinamico=any(d.acesso_dinamico for d in dependencias),
+        )
+
+    def __repr__(self):
+        return (
+            f'Dependencias(variaveis={sorted(self.variaveis)}, coeficientes={sorted(self.coeficientes)}, '
+            f'campos_tree={sorted(self.campos_tree)}, acesso_dinamico={self.acesso_dinamico})'
+        )
+
+
+def _caminho_tree(node):
+    """Retorna ['species', 'bio_index'] para tree.species.bio_index (ou None se não partir de tree)"""
+    partes = []
+    while isinstance(node, ast.Attribute):
+        partes.append(node.attr)
+        node = node.value
+    if isinstance(node, ast.Name) and node.id == 'tree':
+        return partes[::-1]
+    return None
+
+
+class _AnalisadorDependencias(ast.NodeVisitor):
+
+    def __init__(self, locais=()):
+        self.variaveis = set()
+        self.coeficientes = set()
+        self.campos_tree = set()
+        self.acesso_dinamico = False
+        # Nomes ligados dentro da própria fórmula (parâmetros de lambda, compreensões)
+        self.locais = set(locais)
+
+    def _registrar_caminho(self, partes):
+        self.variaveis.add('tree')
+        if partes:
+            self.campos_tree.add('__'.join(partes))
+        else:
+            # `tree` usado diretamente, sem atributo
+            self.acesso_dinamico = True
+
+    def visit_Attribute(self, node):
+        partes = _caminho_tree(node)
+        if partes is None:
+            self.generic_visit(node)
+        else:
+            self._registrar_caminho(partes)
+
+    def visit_Name(self, node):
+        if node.id == 'tree':
+            self._registrar_caminho([])
+        elif node.id in NOMES_CONTEXTO:
+            self.variaveis.add(node.id)
+        elif node.id not in self.locais:
+            self.coeficientes.add(node.id)
+
+    def visit_Subscript(self, node):
+        if (
+            isinstance(node.value, ast.Name) and node.value.id == 'coeficientes'
+            and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str)
+        ):
+            self.variaveis.add('coeficientes')
+            self.coeficientes.add(node.slice.value)
+        else:
+            self.generic_visit(node)
+
+    def visit_Call(self, node):
+        # hasattr(tree.x, "y") / getattr(tree.x, "y"[, padrao]) com nome constante
+        if (
+            isinstance(node.func, ast.Name) and node.func.id in ('hasattr', 'getattr')
+            and len(node.args) >= 2 and _caminho_tree(node.args[0]) is not None
+        ):
+            self.variaveis.add(node.func.id)
+            partes = _caminho_tree(node.args[0])
+            nome = node.args[1]
+            if isinstance(nome, ast.Constant) and isinstance(nome.value, str):
+                if partes:
+                    self.campos_tree.add('__'.join(partes))
+                self._registrar_caminho(partes + [nome.value])
+            else:
+                self._registrar_caminho([])
+            for arg in node.args[2:]:
+                self.visit(arg)
+            return
+        self.generic_visit(node)
+
+
+def analisar_dependencias(formula):
+    """Analisa a fórmula e retorna as Dependencias (entradas que ela realmente usa)"""
+    arvore = ast.parse(formula, mode='eval')
+    locais = {node.arg for node in ast.walk(arvore) if isinstance(node, ast.arg)}
+    locais.update(
+        node.id for node in ast.walk(arvore) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)
+    )
+    analisador = _AnalisadorDependencias(locais)
+    analisador.visit(arvore)
+    return Dependencias(
+        variaveis=analisador.variaveis,
+        coeficientes=analisador.coeficientes,
+        campos_tree=analisador.campos_tree,
+        acesso_dinamico=analisador.acesso_dinamico,
+    )
+
+
+# ============ AVALIAÇÃO VETORIZADA ============
+
+class FormulaNaoVetorizavel(Exception):
+    """A fórmula usa construções que não podem ser avaliadas sobre arrays"""
+
+
+class MathVetorizado:
+    """Substituto do módulo `math` nas fórmulas: cada função aponta para o equivalente numpy"""
+    pi = np.pi
+    e = np.e
+    inf = np.inf
+    nan = np.nan
+    exp = staticmethod(np.exp)
+    log = staticmethod(np.log)
+    log10 = staticmethod(np.log10)
+    log2 = staticmethod(np.log2)
+    sqrt = staticmethod(np.sqrt)
+    pow = staticmethod(np.power)
+    sin = staticmethod(np.sin)
+    cos = staticmethod(np.cos)
+    tan = staticmethod(np.tan)
+    atan = staticmethod(np.arctan)
+    floor = staticmethod(np.floor)
+    ceil = staticmethod(np.ceil)
+    fabs = staticmethod(np.fabs)
+    isnan = staticmethod(np.isnan)
+    isinf = staticmethod(np.isinf)
+
+
+class RelacaoVetorizada:
+    """Relação (ex.: tree.species) carregada como colunas, com máscara de presença"""
+
+    def __init__(self, presente, **colunas):
+        self._presente = presente
+        for nome, valores in colunas.items():
+            setattr(self, nome, valores)
+
+
+class ArvoresVetorizadas:
+    """Substituto de `tree` nas fórmulas vetorizadas: cada atributo é um array"""
+
+    def __init__(self, **colunas):
+        for nome, valores in colunas.items():
+            setattr(self, nome, valores)
+
+
+def _vet_verdade(valor):
+    """Máscara do valor de verdade de Python elemento a elemento
+
+    Uma relação é verdadeira onde existe; NaN representa None (campo nulo)
+    e é falso, como o None de `calcular`.
+    """
+    if isinstance(valor, RelacaoVetorizada):
+        return valor._presente
+    if valor is None:
+        return np.False_
+    valores = np.asarray(valor)
+    if valores.dtype.kind == 'O':
+        return np.array([bool(v) for v in valores.ravel()], dtype=bool).reshape(valores.shape)
+    if valores.dtype.kind == 'f':
+        return (valores != 0) & ~np.isnan(valores)
+    return valores != 0
+
+
+def _vet_operando(valor):
+    """Valor de um operando devolvido por and/or/if
+
+    Em `calcular` uma relação devolvida como valor (a espécie ou None) não é
+    numérica e a árvore resulta em 0; aqui vira NaN, que também resulta em 0.
+    """
+    if isinstance(valor, RelacaoVetorizada):
+        return np.full(np.shape(valor._presente), np.nan)
+    if valor is None:
+        return np.nan
+    return valor
+
+
+def _vet_onde(condicao, se_verdadeiro, se_falso):
+    return np.where(_vet_verdade(condicao), _vet_operando(se_verdadeiro), _vet_operando(se_falso))
+
+
+def _vet_e(*valores):
+    """`a and b and c`: o primeiro operando falso de cada elemento, ou o último"""
+    resultado = _vet_operando(valores[-1])
+    for valor in reversed(valores[:-1]):
+        resultado = np.where(_vet_verdade(valor), resultado, _vet_operando(valor))
+    return resultado
+
+
+def _vet_ou(*valores):
+    """`a or b or c`: o primeiro operando verdadeiro de cada elemento, ou o último"""
+    resultado = _vet_operando(valores[-1])
+    for valor in reversed(valores[:-1]):
+        resultado = np.where(_vet_verdade(valor), _vet_operando(valor), resultado)
+    return resultado
+
+
+def _vet_nao(valor):
+    return np.logical_not(_vet_verdade(valor))
+
+
+def _vet_nao_nulo(valor):
+    if isinstance(valor, RelacaoVetorizada):
+        return valor._presente
+    if valor is None:
+        return np.False_
+    valores = np.asarray(valor)
+    if valores.dtype.kind == 'f':
+        return ~np.isnan(valores)
+    if valores.dtype.kind == 'O':
+        return np.array([v is not None for v in valores.ravel()], dtype=bool).reshape(valores.shape)
+    return np.ones(valores.shape, dtype=bool)
+
+
+def _vet_nulo(valor):
+    return np.logical_not(_vet_nao_nulo(valor))
+
+
+FUNCOES_VETORIZADAS = {
+    '_vet_onde': _vet_onde,
+    '_vet_e': _vet_e,
+    '_vet_ou': _vet_ou,
+    '_vet_nao': _vet_nao,
+    '_vet_nao_nulo': _vet_nao_nulo,
+    '_vet_nulo': _vet_nulo,
+}
+
+
+class _TransformadorVetorial(ast.NodeTransformer):
+    """Reescreve construções de controle de fluxo em chamadas elemento a elemento"""
+
+    NAO_SUPORTADOS = (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.NamedExpr)
+
+    def generic_visit(self, node):
+        if isinstance(node, self.NAO_SUPORTADOS):
+            raise FormulaNaoVetorizavel(type(node).__name__)
+        return super().generic_visit(node)
+
+    def _chamar(self, nome, args, origem):
+        return ast.copy_location(
+            ast.Call(func=ast.Name(id=nome, ctx=ast.Load()), args=args, keywords=[]),
+            origem,
+        )
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return self._chamar('_vet_onde', [node.test, node.body, node.orelse], node)
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        nome = '_vet_e' if isinstance(node.op, ast.And) else '_vet_ou'
+        return self._chamar(nome, node.values, node)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return self._chamar('_vet_nao', [node.operand], node)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        comparacoes = []
+        esquerda = node.left
+        for operador, direita in zip(node.ops, node.comparators):
+            if isinstance(operador, (ast.Is, ast.IsNot)):
+                if not (isinstance(direita, ast.Constant) and direita.value is None):
+                    raise FormulaNaoVetorizavel('comparação "is" com valor diferente de None')
+                nome = '_vet_nulo' if isinstance(operador, ast.Is) else '_vet_nao_nulo'
+                comparacoes.append(self._chamar(nome, [esquerda], node))
+            else:
+                comparacoes.append(ast.copy_location(
+                    ast.Compare(left=esquerda, ops=[operador], comparators=[direita]), node
+                ))
+            esquerda = direita
+        if len(comparacoes) == 1:
+            return comparacoes[0]
+        # Comparações encadeadas (a < b < c) viram um "e" elemento a elemento
+        return self._chamar('_vet_e', comparacoes, node)
+
+
+def compilar_formula_vetorizada(formula):
+    """Compila a variante vetorizada da fórmula (levanta FormulaNaoVetorizavel se impossível)"""
+    arvore = ast.parse(formula, mode='eval')
+    arvore = _TransformadorVetorial().visit(arvore)
+    ast.fix_missing_locations(arvore)
+    return compile(arvore, '<formula vetorizada>', 'eval')
@@ -0,0 +1,143 @@
+"""
+Geometrias da cidade usadas nos cálculos do servidor.
+
+Os limites da cidade e dos bairros vêm dos mesmos arquivos usados pelo mapa
+(static/js/city.js e static/js/bairros.js, GeoJSON atribuído a uma
+constante JavaScript). Cada `City` indica os seus arquivos em static/js;
+sem cidade valem os de São José dos Campos. Os polígonos são lidos uma
+única vez por processo e arquivo e os testes de ponto em polígono são
+vetorizados com numpy.
+"""
+import json
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+
+DIRETORIO_GEOMETRIAS = settings.BASE_DIR / 'static' / 'js'
+ARQUIVO_BAIRROS = DIRETORIO_GEOMETRIAS / 'bairros.js'
+ARQUIVO_CIDADE = DIRETORIO_GEOMETRIAS / 'city.js'
+# Tamanho máximo (pontos x vértices) das matrizes temporárias do teste de ponto em polígono
+ELEMENTOS_POR_BLOCO = 2_000_000
+
+
+def ler_geojson_js(caminho):
+    """Lê um arquivo `const NOME = {...}` e retorna o GeoJSON como dict"""
+    texto = caminho.read_text(encoding='utf-8')
+    inicio = texto.index('{')
+    fim = texto.rindex('}')
+    return json.loads(texto[inicio:fim + 1])
+
+
+class Poligono:
+    """Polígono (com ou sem buracos) e seu retângulo envolvente, em (longitude, latitude)"""
+
+    def __init__(self, aneis):
+        # Coordenadas GeoJSON podem ter altitude como terceira componente
+        self.aneis = [np.asarray(anel, dtype=float)[:, :2] for anel in aneis]
+        externo = self.aneis[0]
+        self.lon_min, self.lat_min = externo.min(axis=0)
+        self.lon_max, self.lat_max = externo.max(axis=0)
+
+    def contem(self, lon, lat):
+        """Máscara dos pontos dentro do polígono (regra par-ímpar, vetorizada)"""
+        dentro = np.zeros(len(lon), dtype=bool)
+        candidatos = np.flatnonzero(
+            (lon >= self.lon_min) & (lon <= self.lon_max) & (lat >= self.lat_min) & (lat <= self.lat_max)
+        )
+        if len(candidatos) == 0:
+            return dentro
+        vertices = sum(len(anel) for anel in self.aneis)
+        # Blocos de pontos para limitar a matriz pontos x arestas na memória
+        tamanho_bloco = max(1, ELEMENTOS_POR_BLOCO // vertices)
+        for inicio in range(0, len(candidatos), tamanho_bloco):
+            bloco = candidatos[inicio:inicio + tamanho_bloco]
+            dentro[bloco] = self._paridade(lon[bloco][:, None], lat[bloco][:, None])
+        return dentro
+
+    def _paridade(self, x, y):
+        paridade = np.zeros(len(x), dtype=bool)
+        for anel in self.aneis:
+            x1, y1 = anel[:, 0], anel[:, 1]
+            x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+            cruza = (y1 > y) != (y2 > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_intersecao = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            paridade ^= (np.count_nonzero(cruza & (x < x_intersecao), axis=1) % 2).astype(bool)
+        return paridade
+
+
+def _poligonos(geometria):
+    if geometria['type'] == 'Polygon':
+        return [Poligono(geometria['coordinates'])]
+    if geometria['type'] == 'MultiPolygon':
+        return [Poligono(aneis) for aneis in geometria['coordinates']]
+    return []
+
+
+@lru_cache(maxsize=None)
+def _bairros(arquivo):
+    resultado = []
+    for feature in ler_geojson_js(DIRETORIO_GEOMETRIAS / arquivo)['features']:
+        nome = (feature.get('properties') or {}).get('bairro') or f"Bairro {feature.get('id', '').strip()}"
+        resultado.append((nome.strip(), _poligonos(feature['geometry'])))
+    return resultado
+
+
+def bairros(cidade=None):
+    """Lista de (nome do bairro, [Poligono, ...]) na ordem do arquivo"""
+    return _bairros(cidade.arquivo_bairros if cidade is not None else ARQUIVO_BAIRROS.name)
+
+
+@lru_cache(maxsize=None)
+def _limite(arquivo):
+    poligonos = []
+    for feature in ler_geojson_js(DIRETORIO_GEOMETRIAS / arquivo)['features']:
+        poligonos.extend(_poligonos(feature['geometry']))
+    return poligonos
+
+
+def limite_cidade(cidade=None):
+    """Polígonos do limite do município"""
+    return _limite(cidade.arquivo_limite if cidade is not None else ARQUIVO_CIDADE.name)
+
+
+def nomes_bairros(cidade=None):
+    return [nome for nome, _ in bairros(cidade)]
+
+
+def bairro_dos_pontos(latitude, longitude, cidade=None):
+    """Índice (em nomes_bairros(cidade)) do bairro de cada ponto, ou -1 fora de todos os bairros"""
+    lat = np.asarray(latitude, dtype=float)
+    lon = np.asarray(longitude, dtype=float)
+    indices = np.full(len(lat), -1, dtype=np.int64)
+    if len(lat) == 0:
+        return indices
+    # Retângulo dos pontos: descarta os polígonos distantes sem operações numpy (ex.: uma árvore salva)
+    lon_min, lon_max, lat_min, lat_max = np.nanmin(lon), np.nanmax(lon), np.nanmin(lat), np.nanmax(lat)
+    for i, (_, poligonos) in enumerate(bairros(cidade)):
+        for poligono in poligonos:
+            if (poligono.lon_min > lon_max or poligono.lon_max < lon_min
+                    or poligono.lat_min > lat_max or poligono.lat_max < lat_min):
+                continue
+            dentro = poligono.contem(lon, lat) & (indices < 0)
+            indices[dentro] = i
+    return indices
+
+
+def dentro_da_cidade(latitude, longitude, cidade=None):
+    """Máscara dos pontos dentro do limite do município"""
+    lat = np.asarray(latitude, dtype=float)
+    lon = np.asarray(longitude, dtype=float)
+    dentro = np.zeros(len(lat), dtype=bool)
+    for poligono in limite_cidade(cidade):
+        dentro |= poligono.contem(lon, lat)
+    return dentro
+
+
+def bairro_do_ponto(latitude, longitude, cidade=None):
+    """Nome do bairro que contém o ponto ('' fora de todos os bairros ou sem coordenadas)"""
+    if latitude is None or longitude is None:
+        return ''
+    indice = bairro_dos_pontos([latitude], [longitude], cidade)[0]
+    return nomes_bairros(cidade)[indice] if indice >= 0 else ''
@@ -0,0 +1,132 @@
+"""
+Grade multirresolução das árvores (quadkeys).
+
+Cada árvore guarda em `Tree.quadkey` o quadkey (ladrilhos Web Mercator, como
+os do mapa) da célula de nível NIVEL_QUADKEY que a contém: um dígito de 0 a
+3 por nível, de modo que os primeiros n dígitos identificam a célula de
+nível n. Agrupar as árvores pelo prefixo do quadkey dá a grade de qualquer
+nível sem recalcular coordenadas (ver mapa.agrupamentos).
+
+O quadkey é preenchido ao salvar a árvore (sinais); árvores inseridas sem
+sinais (bulk_create) podem ser completadas com preencher_quadkeys.
+"""
+import math
+
+import numpy as np
+from django.db import connection, transaction
+
+from .models import Tree
+
+# Nível 22: células de ~9 m de lado no inventário atual
+NIVEL_QUADKEY = 22
+LATITUDE_MAXIMA = 85.05112878
+TAMANHO_LOTE = 5000
+
+
+def posicoes(latitude, longitude, nivel):
+    """Coordenadas Web Mercator (x, y) dos pontos em unidades de ladrilho de `nivel` (fracionárias)"""
+    latitude = np.clip(np.asarray(latitude, dtype=float), -LATITUDE_MAXIMA, LATITUDE_MAXIMA)
+    longitude = np.asarray(longitude, dtype=float)
+    lado = 2 ** nivel
+    seno = np.sin(np.radians(latitude))
+    x = (longitude + 180) / 360 * lado
+    y = (0.5 - np.log((1 + seno) / (1 - seno)) / (4 * math.pi)) * lado
+    return x, y
+
+
+def ladrilhos(latitude, longitude, nivel):
+    """Coordenadas (x, y) dos ladrilhos Web Mercator de `nivel` que contêm os pontos"""
+    x, y = posicoes(latitude, longitude, nivel)
+    lado = 2 ** nivel
+    return (
+        np.clip(x, 0, lado - 1).astype(np.int64),
+        np.clip(y, 0, lado - 1).astype(np.int64),
+    )
+
+
+def quadkeys(latitude, longitude, nivel=NIVEL_QUADKEY):
+    """Quadkeys (str) de `nivel` dígitos dos pontos, vetorizado"""
+    x, y = ladrilhos(latitude, longitude, nivel)
+    deslocamentos = np.arange(nivel - 1, -1, -1)
+    digitos = ((x[:, None] >> deslocamentos) & 1) + 2 * ((y[:, None] >> deslocamentos) & 1)
+    texto = (digitos + ord('0')).astype(np.uint8)
+    return [bytes(linha).decode() for linha in texto]
+
+
+def quadkey(latitude, longitude):
+    """Quadkey de um único ponto"""
+    return quadkeys([latitude], [longitude])[0]
+
+
+def ladrilho(chave):
+    """Coordenadas (x, y) do ladrilho identificado pelo quadkey (o nível é o número de dígitos)"""
+    x = y = 0
+    for digito in chave:
+        digito = int(digito)
+        x = 2 * x + (digito & 1)
+        y = 2 * y + (digito >> 1)
+    return x, y
+
+
+def limites_ladrilho(x, y, nivel):
+    """Retângulo (sul, oeste, norte, leste) do ladrilho (x, y) de `nivel`"""
+    lado = 2 ** nivel
+
+    def latitude(linha):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * linha / lado))))
+
+    return latitude(y + 1), x / lado * 360 - 180, latitude(y), (x + 1) / lado * 360 - 180
+
+
+def faixa_ladrilhos(sul, oeste, norte, leste, nivel):
+    """Faixas ((x_min, x_max), (y_min, y_max)) dos ladrilhos de `nivel` que cobrem o retângulo"""
+    x, y = ladrilhos([norte, sul], [oeste, leste], nivel)
+    return (int(x[0]), int(x[1])), (int(y[0]), int(y[1]))
+
+
+def quadkey_do_ladrilho(x, y, nivel):
+    """Quadkey do ladrilho (x, y) de `nivel`"""
+    return ''.join(
+        str(((x >> deslocamento) & 1) + 2 * ((y >> deslocamento) & 1))
+        for deslocamento in range(nivel - 1, -1, -1)
+    )
+
+
+def prefixos_no_retangulo(sul, oeste, norte, leste, nivel):
+    """Quadkeys das células de `nivel` que cobrem o retângulo
+
+    As árvores de uma célula são as de quadkey entre o prefixo e o
+    prefixo + '4': uma faixa do índice por cidade e quadkey.
+    """
+    (x_min, x_max), (y_min, y_max) = faixa_ladrilhos(sul, oeste, norte, leste, nivel)
+    return [
+        quadkey_do_ladrilho(x, y, nivel)
+        for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)
+    ]
+
+
+def celulas_no_retangulo(sul, oeste, norte, leste, nivel):
+    """Número de células de `nivel` que cobrem o retângulo"""
+    (x_min, x_max), (y_min, y_max) = faixa_ladrilhos(sul, oeste, norte, leste, nivel)
+    return (x_max - x_min + 1) * (y_max - y_min + 1)
+
+
+def salvar_quadkeys(ids, latitude, longitude):
+    """Grava o quadkey das árvores informadas (um executemany em uma transação)"""
+    linhas = list(zip(quadkeys(latitude, longitude), (int(tree_id) for tree_id in ids)))
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.executemany(f'UPDATE {Tree._meta.db_table} SET quadkey = %s WHERE id = %s', linhas)
+
+
+def preencher_quadkeys(queryset=None):
+    """Calcula o quadkey das árvores que ainda não o têm (ex.: bulk_create); retorna quantas"""
+    if queryset is None:
+        queryset = Tree.objects.all()
+    pendentes = queryset.filter(quadkey='')
+    total = 0
+    while True:
+        linhas = list(pendentes.order_by('id').values_list('id', 'latitude', 'longitude')[:TAMANHO_LOTE])
+        if not linhas:
+            return total
+        salvar_quadkeys(*zip(*linhas))
+        total += len(linhas)
@@ -0,0 +1,363 @@
+"""
+Proteção contra fórmulas de serviços ecossistêmicos caras ou descontroladas.
+
+Qualquer expressão digitada no admin é avaliada durante a renderização do
+mapa, então uma fórmula como `10**10**8` travaria todos os workers. Há três
+camadas de proteção:
+
+1. Verificação estática da AST (construções proibidas, potências enormes,
+   atributos privados), feita em toda avaliação de uma versão nova.
+2. Sonda: a fórmula é avaliada sobre uma amostra de árvores em um processo
+   separado, com limite de tempo e de memória (RLIMIT_AS, quando o sistema
+   oferece). Roda ao salvar no admin, onde o custo medido por árvore também
+   precisa ficar dentro do orçamento configurado, e antes de trabalhos em
+   lote (sondar_servicos, ex.: recompute_ecosystem_services); nunca durante
+   uma requisição.
+3. Na avaliação real (calcular por árvore e calcular_lote, usados pelo
+   mapa, cenários, projeções e Monte Carlo) cada chamada tem um tempo
+   limite proporcional ao número de árvores, medido ao fim da avaliação e,
+   no cálculo árvore a árvore de um lote, entre uma árvore e outra (a
+   fórmula é uma única expressão sem laços: o que demora é uma operação
+   numérica, que nenhum sinal interromperia). Exceder o tempo ou a memória
+   (MemoryError; o teto de memória do processo só é aplicado na sonda)
+   marca a versão (fórmula + coeficientes) como degradada: o estado fica no
+   cache do Django, compartilhado entre os processos, e a versão passa a
+   valer 0 nas avaliações seguintes.
+"""
+import ast
+import hashlib
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from .coeficientes import tabela_coeficientes
+
+logger = logging.getLogger(__name__)
+
+ORCAMENTO_PADRAO_US = 500
+TIMEOUT_PADRAO = 5.0
+# Tempo limite de uma avaliação real: TEMPO_LIMITE_PADRAO + árvores x orçamento x FOLGA_ORCAMENTO
+TEMPO_LIMITE_PADRAO = 5.0
+FOLGA_ORCAMENTO = 10
+MEMORIA_PADRAO_MB = 512
+AMOSTRA_PADRAO = 200
+
+LIMITE_NOS = 500
+LIMITE_EXPOENTE = 100
+LIMITE_REPETICAO = 1000
+LIMITE_TEXTO = 1000
+CONSTRUCOES_PROIBIDAS = (
+    ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.NamedExpr,
+)
+CHAVE_ESTADO = 'ecosystem_services:sonda:{}'
+
+_estado_local = {}
+_amostra = []
+# Verdadeiro dentro do processo da sonda (evita sondar recursivamente)
+_em_sonda = False
+
+
+class FormulaRejeitada(Exception):
+    """A fórmula foi reprovada pela verificação estática, pela sonda ou pelo orçamento"""
+
+
+class LimiteExcedido(Exception):
+    """O cálculo árvore a árvore de um lote passou do prazo (ver batch.calcular_lote)"""
+
+
+def _configuracao(nome, padrao):
+    return getattr(settings, nome, padrao)
+
+
+# ==================== VERIFICAÇÃO ESTÁTICA ====================
+
+def _constante_numerica(node):
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        return _constante_numerica(node.operand)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return node.value
+    return None
+
+
+def _sequencia(node):
+    return isinstance(node, (ast.List, ast.Tuple)) or (
+        isinstance(node, ast.Constant) and isinstance(node.value, (str, bytes))
+    )
+
+
+def verificar_estatica(formula):
+    """Levanta FormulaRejeitada para construções que podem travar a avaliação"""
+    try:
+        arvore = ast.parse(formula, mode='eval')
+    except SyntaxError as e:
+        raise FormulaRejeitada(f'Sintaxe inválida: {e.msg}')
+
+    nos = list(ast.walk(arvore))
+    if len(nos) > LIMITE_NOS:
+        raise FormulaRejeitada(f'Fórmula muito longa ({len(nos)} nós; máximo {LIMITE_NOS})')
+
+    for node in nos:
+        if isinstance(node, CONSTRUCOES_PROIBIDAS):
+            raise FormulaRejeitada(f'Construção não permitida: {type(node).__name__}')
+        if isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+            raise FormulaRejeitada(f'Atributo privado não permitido: {node.attr}')
+        if isinstance(node, ast.Constant) and isinstance(node.value, (str, bytes)) and len(node.value) > LIMITE_TEXTO:
+            raise FormulaRejeitada('Texto constante muito longo')
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+            expoente = _constante_numerica(node.right)
+            if isinstance(node.right, ast.BinOp) and isinstance(node.right.op, ast.Pow):
+                raise FormulaRejeitada('Potências encadeadas (a ** b ** c) não são permitidas')
+            if expoente is not None and abs(expoente) > LIMITE_EXPOENTE:
+                raise FormulaRejeitada(f'Expoente muito grande ({expoente}; máximo {LIMITE_EXPOENTE})')
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+            for sequencia, fator in ((node.left, node.right), (node.right, node.left)):
+                vezes = _constante_numerica(fator)
+                if _sequencia(sequencia) and (vezes is None or vezes > LIMITE_REPETICAO):
+                    raise FormulaRejeitada('Repetição de sequências não permitida')
+
+
+# ==================== SONDA EM PROCESSO SEPARADO ====================
+
+def _limitar_memoria(memoria_mb):
+    """Limita o espaço de endereçamento do processo (apenas sistemas com o módulo resource)"""
+    try:
+        import resource
+    except ImportError:
+        return
+    try:
+        with open('/proc/self/statm') as arquivo:
+            atual = int(arquivo.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError):
+        atual = 0
+    limite = atual + memoria_mb * 1024 * 1024
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+    except (ValueError, OSError):
+        pass
+
+
+def _executar_sonda(conexao, config, arvores, memoria_mb):
+    """Executa no processo filho: mede calcular (por árvore) e o cálculo em lote na amostra"""
+    global _em_sonda
+    _em_sonda = True
+    try:
+        from django.apps import apps
+
+        if not apps.ready:
+            # Processo iniciado com spawn (ex.: Windows)
+            import django
+
+            django.setup()
+        from .batch import DadosLote, calcular_lote
+        from .perfil import perfil_servicos
+
+        # As chamadas da sonda não entram nas estatísticas de execução
+        perfil_servicos.habilitado = False
+        _limitar_memoria(memoria_mb)
+        inicio = time.perf_counter()
+        for arvore in arvores:
+            config.calcular(arvore)
+        por_arvore = (time.perf_counter() - inicio) / max(len(arvores), 1) * 1e6
+        calcular_lote(config, DadosLote.de(arvores), memoizar=False)
+        conexao.send({'status': 'ok', 'us_por_arvore': por_arvore, 'mensagem': ''})
+    except LimiteExcedido as e:
+        conexao.send({'status': 'timeout', 'us_por_arvore': None, 'mensagem': str(e)})
+    except MemoryError:
+        conexao.send({'status': 'memoria', 'us_por_arvore': None, 'mensagem': 'Limite de memória excedido'})
+    except Exception as e:
+        conexao.send({'status': 'erro', 'us_por_arvore': None, 'mensagem': str(e)})
+    finally:
+        conexao.close()
+
+
+def amostra_arvores():
+    """Amostra fixa de árvores (com espécie) usada pela sonda, carregada uma vez por processo"""
+    if not _amostra:
+        from .models import Tree
+
+        tamanho = _configuracao('ECOSYSTEM_SERVICES_SONDA_AMOSTRA', AMOSTRA_PADRAO)
+        _amostra.extend(Tree.objects.select_related('species').order_by('id')[:tamanho])
+    return _amostra
+
+
+def sondar(config, arvores=None):
+    """Avalia a configuração em um processo separado com limite de tempo e memória
+
+    Retorna {'status': 'ok'|'timeout'|'memoria'|'erro'|'indisponivel', 'us_por_arvore', 'mensagem'}.
+    Processos daemon (ex.: workers de multiprocessing.Pool) não podem ter
+    filhos: neles a sonda fica 'indisponivel' e deve ser feita antes, no
+    processo principal (ver sondar_servicos).
+    """
+    if multiprocessing.current_process().daemon:
+        return {'status': 'indisponivel', 'us_por_arvore': None, 'mensagem': 'Sonda indisponível em processo daemon'}
+    if arvores is None:
+        arvores = amostra_arvores()
+    # Carregada antes do fork: o processo filho não acessa o banco
+    tabela_coeficientes(config)
+    timeout = _configuracao('ECOSYSTEM_SERVICES_SONDA_TIMEOUT', TIMEOUT_PADRAO)
+    memoria_mb = _configuracao('ECOSYSTEM_SERVICES_SONDA_MEMORIA_MB', MEMORIA_PADRAO_MB)
+
+    metodos = multiprocessing.get_all_start_methods()
+    contexto = multiprocessing.get_context('fork' if 'fork' in metodos else 'spawn')
+    recebe, envia = contexto.Pipe(duplex=False)
+    processo = contexto.Process(target=_executar_sonda, args=(envia, config, list(arvores), memoria_mb), daemon=True)
+    processo.start()
+    envia.close()
+    try:
+        if recebe.poll(timeout):
+            return recebe.recv()
+        return {'status': 'timeout', 'us_por_arvore': None, 'mensagem': f'Tempo limite de {timeout}s excedido'}
+    except EOFError:
+        # O filho morreu sem responder (ex.: abortado ao exceder o limite de memória)
+        return {'status': 'memoria', 'us_por_arvore': None, 'mensagem': 'Processo de avaliação abortado'}
+    finally:
+        recebe.close()
+        if processo.is_alive():
+            processo.kill()
+        processo.join()
+
+
+def validar_formula(config):
+    """Validação do admin: verificação estática, sonda e orçamento de custo por árvore"""
+    verificar_estatica(config.formula)
+    resultado = sondar(config)
+    if resultado['status'] == 'indisponivel':
+        return resultado
+    if resultado['status'] != 'ok':
+        raise FormulaRejeitada(resultado['mensagem'])
+    orcamento = _configuracao('ECOSYSTEM_SERVICES_ORCAMENTO_US', ORCAMENTO_PADRAO_US)
+    if resultado['us_por_arvore'] > orcamento:
+        raise FormulaRejeitada(
+            f'Custo de {resultado["us_por_arvore"]:.0f} µs por árvore acima do orçamento de {orcamento} µs'
+        )
+    _registrar(chave_formula(config), None)
+    return resultado
+
+
+# ==================== ESTADO EM EXECUÇÃO ====================
+
+def chave_formula(config):
+    """Hash da versão (fórmula + coeficientes), guardado na instância enquanto ela não muda"""
+    marcador = (config.formula, id(config.coeficientes))
+    guardada = config.__dict__.get('_chave_guarda')
+    if guardada is not None and guardada[0] == marcador:
+        return guardada[1]
+    coeficientes = config.coeficientes if config.coeficientes else {}
+    texto = repr((config.formula, sorted(coeficientes.items())))
+    chave = hashlib.sha1(texto.encode('utf-8')).hexdigest()
+    config.__dict__['_chave_guarda'] = (marcador, chave)
+    return chave
+
+
+def _registrar(chave, motivo):
+    _estado_local[chave] = motivo
+    cache.set(CHAVE_ESTADO.format(chave), motivo or '', None)
+
+
+def motivo_degradacao(config):
+    """Motivo pelo qual a versão está degradada (ou None se pode ser avaliada)
+
+    Lê o estado registrado pela sonda ou por uma avaliação que excedeu os
+    limites; uma versão ainda sem estado passa apenas pela verificação
+    estática (a sonda não roda no caminho das requisições).
+    """
+    if _em_sonda:
+        return None
+    coeficientes = config.coeficientes if config.coeficientes else {}
+    if any(isinstance(valor, np.ndarray) for valor in coeficientes.values()):
+        # Coeficientes amostrados (incerteza.py): quem chama verifica a configuração original
+        return None
+    chave = chave_formula(config)
+    if chave in _estado_local:
+        return _estado_local[chave]
+
+    guardado = cache.get(CHAVE_ESTADO.format(chave))
+    if guardado is not None:
+        _estado_local[chave] = guardado or None
+        return guardado or None
+
+    try:
+        verificar_estatica(config.formula)
+    except FormulaRejeitada as e:
+        logger.warning('Serviço %s degradado: %s', config.codigo, e)
+        _registrar(chave, str(e))
+        return str(e)
+    # Só neste processo: a sonda ainda pode registrar o estado compartilhado
+    _estado_local[chave] = None
+    return None
+
+
+def _sondar_versao(config):
+    """Verificação estática e sonda da versão, com o resultado registrado; retorna o motivo ou None"""
+    motivo = None
+    try:
+        verificar_estatica(config.formula)
+        resultado = sondar(config)
+        if resultado['status'] == 'indisponivel':
+            # Sem registrar: a versão é sondada no próximo processo que puder
+            return None
+        if resultado['status'] in ('timeout', 'memoria'):
+            motivo = resultado['mensagem']
+    except FormulaRejeitada as e:
+        motivo = str(e)
+    if motivo:
+        logger.warning('Serviço %s degradado: %s', config.codigo, motivo)
+    _registrar(chave_formula(config), motivo)
+    return motivo
+
+
+def sondar_servicos(servicos):
+    """Sonda no processo atual as versões ainda não sondadas; retorna {codigo: motivo} das degradadas
+
+    Deve ser chamada antes de trabalhos em lote e antes de criar um pool de
+    processos, cujos workers (daemon) não podem executar a sonda.
+    """
+    degradados = {}
+    for servico in servicos:
+        guardado = cache.get(CHAVE_ESTADO.format(chave_formula(servico)))
+        motivo = _sondar_versao(servico) if guardado is None else guardado or None
+        if motivo:
+            degradados[servico.codigo] = motivo
+    return degradados
+
+
+# ==================== LIMITES NA AVALIAÇÃO ====================
+
+def tempo_limite(arvores):
+    """Tempo limite (s) de uma avaliação real sobre `arvores` árvores"""
+    orcamento = _configuracao('ECOSYSTEM_SERVICES_ORCAMENTO_US', ORCAMENTO_PADRAO_US)
+    base = _configuracao('ECOSYSTEM_SERVICES_TEMPO_LIMITE', TEMPO_LIMITE_PADRAO)
+    return base + arvores * orcamento * FOLGA_ORCAMENTO / 1e6
+
+
+def excedeu_tempo(config, inicio, arvores=1):
+    """Degrada a versão se a avaliação iniciada em `inicio` (perf_counter) passou do tempo limite
+
+    Retorna True quando a versão foi degradada. Na sonda o limite é do
+    processo pai e nada é registrado aqui.
+    """
+    decorrido = time.perf_counter() - inicio
+    # Caminho rápido: abaixo da parte fixa do limite não há o que calcular
+    if decorrido <= _configuracao('ECOSYSTEM_SERVICES_TEMPO_LIMITE', TEMPO_LIMITE_PADRAO):
+        return False
+    limite = tempo_limite(arvores)
+    if decorrido <= limite:
+        return False
+    return degradar(config, f'Avaliação de {arvores} árvore(s) levou {decorrido:.2f}s (limite de {limite:.2f}s)')
+
+
+def degradar(config, motivo):
+    """Marca a versão como degradada após exceder um limite na avaliação real
+
+    Retorna False dentro da sonda, onde quem chama deve propagar a exceção
+    para que ela seja reportada ao processo pai.
+    """
+    if _em_sonda:
+        return False
+    logger.warning('Serviço %s degradado: %s', config.codigo, motivo)
+    _registrar(chave_formula(config), str(motivo))
+    return True
@@ -0,0 +1,190 @@
+"""
+Intervalos de incerteza (Monte Carlo) para os totais dos serviços ecossistêmicos.
+
+Os coeficientes de `EcosystemServiceConfig` são estimativas pontuais. Cada
+coeficiente pode ter uma distribuição em `distribuicoes`; a análise sorteia
+N amostras dos coeficientes e avalia a fórmula vetorizada sobre a matriz
+amostras x árvores (coeficientes com forma (N, 1), colunas do inventário
+com forma (árvores,)), em blocos de árvores dimensionados para caber no
+orçamento de memória. Para cada amostra são somados o total da cidade e o
+total de cada bairro, e os percentis p5/p50/p95 são calculados sobre as
+amostras.
+
+Formatos aceitos em `distribuicoes` (o valor central padrão é o próprio
+coeficiente):
+
+    {"tipo": "normal", "desvio": 0.05, "media": -0.9}
+    {"tipo": "lognormal", "sigma": 0.1, "mediana": 0.05}
+    {"tipo": "uniforme", "min": 3, "max": 5}
+    {"tipo": "triangular", "min": 3, "max": 5, "moda": 4}
+"""
+import copy
+
+import numpy as np
+from django.conf import settings
+
+from . import geo, guarda
+from .batch import DadosLote, calcular_lote, campos_extras, dependencias_servicos
+from .crescimento import SEM_BAIRRO
+from .formulas import FormulaNaoVetorizavel
+
+PERCENTIS = (5, 50, 95)
+MEMORIA_PADRAO_MB = 256
+# Arrays temporários do tamanho amostras x árvores criados ao avaliar uma fórmula típica
+FATOR_TEMPORARIOS = 8
+
+TIPOS = {
+    'normal': ('desvio',),
+    'lognormal': ('sigma',),
+    'uniforme': ('min', 'max'),
+    'triangular': ('min', 'max'),
+}
+
+
+def validar_distribuicoes(distribuicoes, coeficientes):
+    """Levanta ValueError se alguma distribuição estiver mal definida"""
+    if not distribuicoes:
+        return
+    if not isinstance(distribuicoes, dict):
+        raise ValueError('As distribuições devem ser um objeto JSON por coeficiente')
+    coeficientes = coeficientes or {}
+    for chave, distribuicao in distribuicoes.items():
+        if chave not in coeficientes:
+            raise ValueError(f'{chave}: coeficiente inexistente')
+        if not isinstance(distribuicao, dict) or distribuicao.get('tipo') not in TIPOS:
+            raise ValueError(f'{chave}: "tipo" deve ser um de {", ".join(TIPOS)}')
+        for parametro in TIPOS[distribuicao['tipo']]:
+            if not isinstance(distribuicao.get(parametro), (int, float)):
+                raise ValueError(f'{chave}: parâmetro numérico "{parametro}" obrigatório')
+        if distribuicao['tipo'] in ('uniforme', 'triangular') and distribuicao['min'] > distribuicao['max']:
+            raise ValueError(f'{chave}: "min" maior que "max"')
+        if distribuicao['tipo'] in ('normal', 'lognormal') and distribuicao[TIPOS[distribuicao['tipo']][0]] < 0:
+            raise ValueError(f'{chave}: desvio negativo')
+
+
+def _amostrar(distribuicao, central, n, rng):
+    tipo = distribuicao['tipo']
+    if tipo == 'normal':
+        return rng.normal(distribuicao.get('media', central), distribuicao['desvio'], n)
+    if tipo == 'lognormal':
+        return distribuicao.get('mediana', central) * np.exp(rng.normal(0.0, distribuicao['sigma'], n))
+    if tipo == 'uniforme':
+        return rng.uniform(distribuicao['min'], distribuicao['max'], n)
+    moda = distribuicao.get('moda', central)
+    return rng.triangular(distribuicao['min'], min(max(moda, distribuicao['min']), distribuicao['max']),
+                          distribuicao['max'], n)
+
+
+def amostrar_coeficientes(servico, amostras, rng):
+    """Coeficientes com distribuição viram colunas (amostras, 1); os demais continuam escalares"""
+    coeficientes = dict(servico.coeficientes or {})
+    for chave, distribuicao in (servico.distribuicoes or {}).items():
+        coeficientes[chave] = _amostrar(distribuicao, coeficientes.get(chave), amostras, rng)[:, None]
+    return coeficientes
+
+
+def _resumo(amostras_totais, servico):
+    """Percentis físicos e monetários de um vetor de totais por amostra"""
+    p = np.percentile(amostras_totais, PERCENTIS, axis=0)
+    resumo = {}
+    for percentil, valor in zip(PERCENTIS, p):
+        resumo[f'p{percentil}'] = round(float(valor), 4)
+        resumo[f'p{percentil}_monetario'] = servico.calcular_valor_monetario(float(valor))
+    return resumo
+
+
+class ResultadoMonteCarlo:
+    """Totais por amostra da cidade e de cada bairro para cada serviço"""
+
+    def __init__(self, amostras, servicos, totais, totais_bairro, nomes_bairros, nao_vetorizaveis):
+        self.amostras = amostras
+        self.servicos = servicos
+        # codigo -> array (amostras,) com o total da cidade em cada amostra
+        self.totais = totais
+        # codigo -> array (amostras, bairros) com o total de cada bairro em cada amostra
+        self.totais_bairro = totais_bairro
+        self.nomes_bairros = nomes_bairros
+        self.nao_vetorizaveis = nao_vetorizaveis
+
+    def por_servico(self):
+        """{codigo: {p5, p50, p95, p5_monetario, ...}} para o total da cidade"""
+        return {
+            servico.codigo: {'unidade': servico.unidade_medida, **_resumo(self.totais[servico.codigo], servico)}
+            for servico in self.servicos if servico.codigo in self.totais
+        }
+
+    def por_bairro(self):
+        """{bairro: {codigo: {p5, p50, p95, ...}}}"""
+        resultado = {}
+        for servico in self.servicos:
+            if servico.codigo not in self.totais_bairro:
+                continue
+            matriz = self.totais_bairro[servico.codigo]
+            percentis = np.percentile(matriz, PERCENTIS, axis=0)
+            for j, nome in enumerate(self.nomes_bairros):
+                if not matriz[:, j].any():
+                    continue
+                resultado.setdefault(nome, {})[servico.codigo] = {
+                    f'p{percentil}': round(float(valor), 4) for percentil, valor in zip(PERCENTIS, percentis[:, j])
+                }
+        return resultado
+
+
+def tamanho_bloco(amostras, memoria_mb):
+    """Árvores por bloco para que a matriz amostras x árvores e seus temporários caibam no orçamento"""
+    return max(1, int(memoria_mb * 1024 * 1024 // (amostras * 8 * FATOR_TEMPORARIOS)))
+
+
+def monte_carlo(queryset, servicos, amostras=1000, semente=None, memoria_mb=None, cidade=None):
+    """Sorteia os coeficientes e retorna a distribuição dos totais por serviço e por bairro da `cidade`"""
+    if memoria_mb is None:
+        memoria_mb = getattr(settings, 'ECOSYSTEM_SERVICES_MONTE_CARLO_MEMORIA_MB', MEMORIA_PADRAO_MB)
+    rng = np.random.default_rng(semente)
+    servicos = [servico for servico in servicos if servico.ativo and not guarda.motivo_degradacao(servico)]
+    campos = sorted(set(campos_extras(dependencias_servicos(servicos))) | {'latitude', 'longitude'})
+    dados = DadosLote.de(queryset, campos)
+
+    # Ordena as árvores por bairro: em cada bloco os bairros ficam contíguos (somas com reduceat)
+    nomes = geo.nomes_bairros(cidade) + [SEM_BAIRRO]
+    bairro = geo.bairro_dos_pontos(dados.colunas['latitude'], dados.colunas['longitude'], cidade)
+    bairro[bairro < 0] = len(nomes) - 1
+    ordem = np.argsort(bairro, kind='stable')
+    bairro = bairro[ordem]
+    dados = dados.linhas(ordem)
+    dados.origem = None  # sem cálculo árvore a árvore: coeficientes amostrados são arrays
+
+    variantes = []
+    for servico in servicos:
+        variante = copy.copy(servico)
+        variante.coeficientes = amostrar_coeficientes(servico, amostras, rng)
+        variantes.append((servico, variante))
+
+    totais = {servico.codigo: np.zeros(amostras) for servico in servicos}
+    totais_bairro = {servico.codigo: np.zeros((amostras, len(nomes))) for servico in servicos}
+    nao_vetorizaveis = []
+
+    bloco = tamanho_bloco(amostras, memoria_mb)
+    for inicio in range(0, len(dados), bloco):
+        fim = min(inicio + bloco, len(dados))
+        sub = dados.linhas(np.arange(inicio, fim))
+        bairros_bloco = bairro[inicio:fim]
+        inicios = np.flatnonzero(np.r_[True, bairros_bloco[1:] != bairros_bloco[:-1]])
+
+        for servico, variante in variantes:
+            if servico in nao_vetorizaveis:
+                continue
+            try:
+                valores = calcular_lote(variante, sub, memoizar=False)
+            except FormulaNaoVetorizavel:
+                nao_vetorizaveis.append(servico)
+                continue
+            # (1, árvores) quando nenhum coeficiente tem distribuição: o total é o mesmo em todas as amostras
+            valores = valores.reshape(-1, fim - inicio)
+            totais[servico.codigo] += valores.sum(axis=1)
+            totais_bairro[servico.codigo][:, bairros_bloco[inicios]] += np.add.reduceat(valores, inicios, axis=1)
+
+    for servico in nao_vetorizaveis:
+        del totais[servico.codigo]
+        del totais_bairro[servico.codigo]
+
+    return ResultadoMonteCarlo(amostras, servicos, totais, totais_bairro, nomes, nao_vetorizaveis)
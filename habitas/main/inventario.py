@@ -0,0 +1,73 @@
+"""
+Leitura do inventário de árvores exportado da prefeitura (trees_all.csv) e
+versão do inventário usada para invalidar resultados derivados em cache.
+"""
+import csv
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+
+CSV_INVENTARIO = settings.BASE_DIR.parent / 'trees_all.csv'
+
+
+def ler_inventario_csv(caminho=CSV_INVENTARIO):
+    """Lê o CSV do inventário e retorna uma lista de dicts com os campos de Tree
+
+    Linhas com DAP, altura ou coordenadas inválidas (ex.: "-") são ignoradas,
+    como em scripts/salvar_banco.py.
+    """
+    registros = []
+    with open(caminho, encoding='utf-8') as arquivo:
+        leitor = csv.reader(arquivo, delimiter=';')
+        next(leitor, None)  # pular cabeçalho
+        for linha in leitor:
+            try:
+                registros.append({
+                    'N_placa': int(linha[0]),
+                    'nome_popular': linha[1].strip(),
+                    'nome_cientifico': linha[2].strip(),
+                    'dap': int(linha[3].split(' ')[0]),
+                    'altura': float(linha[4].split(' ')[0].replace(',', '.')),
+                    'latitude': float(linha[6].replace(',', '.')),
+                    'longitude': float(linha[7].replace(',', '.')),
+                    'laudo': linha[8],
+                    'imagem': linha[9],
+                })
+            except (ValueError, IndexError):
+                continue
+    return registros
+
+
+# ==================== VERSÃO DO INVENTÁRIO ====================
+
+CHAVE_VERSAO = 'inventario:versao:{}'
+
+
+def versao_inventario(cidade=None):
+    """Identifica o estado atual do inventário da cidade (ou inteiro), para chaves de cache de resultados derivados
+
+    Combina um carimbo no cache do Django, trocado pelos sinais de Tree a cada
+    inserção, alteração ou remoção, com a contagem e o maior id das árvores
+    (que também mudam em cargas em massa que não disparam sinais). Alterações
+    em uma cidade não invalidam os resultados das demais.
+    """
+    from .models import Tree
+
+    chave = CHAVE_VERSAO.format('todas' if cidade is None else cidade.pk)
+    carimbo = cache.get(chave)
+    if carimbo is None:
+        carimbo = uuid.uuid4().hex
+        if not cache.add(chave, carimbo, None):
+            carimbo = cache.get(chave, carimbo)
+    arvores = Tree.objects.all() if cidade is None else Tree.objects.filter(city=cidade)
+    resumo = arvores.aggregate(n=Count('id'), maior=Max('id'))
+    return f"{carimbo}:{resumo['n']}:{resumo['maior']}"
+
+
+def invalidar_inventario(city_id=None):
+    """Publica um carimbo novo: resultados derivados do inventário (e da cidade) em cache deixam de valer"""
+    cache.set(CHAVE_VERSAO.format('todas'), uuid.uuid4().hex, None)
+    if city_id is not None:
+        cache.set(CHAVE_VERSAO.format(city_id), uuid.uuid4().hex, None)
@@ -0,0 +1,177 @@
+"""
+Ladrilhos PNG da camada de árvores do mapa (/tiles/trees/<z>/<x>/<y>.png).
+
+Alternativa ao envio dos pontos ao navegador: cada ladrilho Web Mercator de
+256 px é desenhado no servidor com os marcadores das árvores, nas cores do
+mapa (verde, ou amarelo quando a árvore tem posts), de modo que o custo no
+cliente não depende do tamanho do inventário. Os marcadores são carimbados
+em uma matriz RGBA com numpy e o PNG é gerado pelo Pillow.
+
+Os ladrilhos ficam em disco (settings.MAPA_LADRILHOS_DIR) em
+<cidade>/<versão>/<filtros>/<z>/<x>/<y>.png: a versão combina a do
+inventário da cidade (ver inventario.versao_inventario) com a dos posts, e
+os filtros são o resumo de mapa.chave_filtros. Qualquer alteração nas
+árvores ou nos posts muda a versão e os ladrilhos são redesenhados sob
+demanda; o comando seed_map_tiles desenha os dos níveis de zoom da cidade
+de antemão e remove as versões antigas.
+
+As árvores são selecionadas pelo quadkey, preenchido pelos sinais, pelas
+cargas em lote e pelo seed_map_tiles (grade.preencher_quadkeys); o desenho
+de um ladrilho não grava nada no banco.
+"""
+import hashlib
+import io
+import math
+import shutil
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Exists, Max, OuterRef, Q
+from PIL import Image
+
+from . import grade
+from .inventario import versao_inventario
+from .mapa import chave_filtros
+from .models import Post, Tree
+
+TAMANHO = 256
+# Mesmo raio (m) e contorno (px) dos L.circle do mapa
+RAIO_M = 5
+CONTORNO_PX = 1.5
+VERDE = (0, 128, 0)
+AMARELO = (255, 255, 0)
+OPACIDADE_PREENCHIMENTO = 128
+METROS_POR_PIXEL_EQUADOR = 156543.03392
+ZOOM_MAXIMO = grade.NIVEL_QUADKEY
+# Tempo (s) que o navegador reutiliza um ladrilho antes de revalidar pelo ETag
+MAX_AGE = 60
+
+CHAVE_VERSAO = 'mapa:ladrilhos:versao:{}'
+# A versão também é invalidada pelos sinais; o prazo cobre cargas sem sinais
+TEMPO_VERSAO = 60
+
+
+def diretorio():
+    return Path(getattr(settings, 'MAPA_LADRILHOS_DIR', settings.BASE_DIR / '.tiles_cache'))
+
+
+def versao_ladrilhos(cidade):
+    """Versão do inventário e dos posts da cidade, em cache por TEMPO_VERSAO segundos"""
+    chave = CHAVE_VERSAO.format(cidade.pk)
+    versao = cache.get(chave)
+    if versao is None:
+        posts = Post.objects.filter(tree__city=cidade).aggregate(n=Count('id'), maior=Max('id'))
+        versao = hashlib.md5(
+            f"{versao_inventario(cidade)}:{posts['n']}:{posts['maior']}".encode()
+        ).hexdigest()[:16]
+        cache.set(chave, versao, TEMPO_VERSAO)
+    return versao
+
+
+def invalidar_ladrilhos(city_id):
+    """Árvores ou posts da cidade mudaram: os ladrilhos passam a ser desenhados em uma nova versão"""
+    cache.delete(CHAVE_VERSAO.format(city_id))
+
+
+def caminho(filtros, z, x, y, versao=None):
+    cidade = filtros['city']
+    return (
+        diretorio() / str(cidade.pk) / (versao or versao_ladrilhos(cidade)) / chave_filtros(filtros)
+        / str(z) / str(x) / f'{y}.png'
+    )
+
+
+def _raio_px(latitude, z):
+    """Raio total (preenchimento + contorno) dos marcadores em pixels no zoom z"""
+    metros_por_pixel = METROS_POR_PIXEL_EQUADOR * math.cos(math.radians(latitude)) / 2 ** z
+    return RAIO_M / metros_por_pixel + CONTORNO_PX
+
+
+def _carimbo(raio):
+    """Deslocamentos (dx, dy) do disco de `raio` px e máscara do contorno (fora do preenchimento)"""
+    alcance = math.ceil(raio)
+    dy, dx = np.mgrid[-alcance:alcance + 1, -alcance:alcance + 1]
+    distancia = np.hypot(dx, dy)
+    dentro = distancia <= max(raio, 0.75)
+    contorno = distancia[dentro] > raio - 2 * CONTORNO_PX
+    return dx[dentro], dy[dentro], contorno
+
+
+def _desenhar(imagem, px, py, cor, carimbo):
+    """Carimba os marcadores (coordenadas em pixels do ladrilho) na matriz RGBA"""
+    dx, dy, contorno = carimbo
+    if len(px) == 0:
+        return
+    colunas = np.round(px).astype(np.int64)[:, None] + dx[None, :]
+    linhas = np.round(py).astype(np.int64)[:, None] + dy[None, :]
+    alfa = np.where(contorno, 255, OPACIDADE_PREENCHIMENTO)[None, :].repeat(len(px), axis=0)
+    visiveis = (colunas >= 0) & (colunas < TAMANHO) & (linhas >= 0) & (linhas < TAMANHO)
+    linhas, colunas, alfa = linhas[visiveis], colunas[visiveis], alfa[visiveis]
+    imagem[linhas, colunas, :3] = cor
+    # Contorno prevalece sobre o preenchimento de marcadores vizinhos
+    np.maximum.at(imagem[:, :, 3], (linhas, colunas), alfa.astype(np.uint8))
+
+
+def renderizar(filtros, z, x, y):
+    """PNG (bytes) do ladrilho (z, x, y) com as árvores da seleção"""
+    sul, oeste, norte, leste = grade.limites_ladrilho(x, y, z)
+    raio = _raio_px((sul + norte) / 2, z)
+    # Árvores um pouco fora do ladrilho também aparecem nas bordas
+    margem = math.ceil(raio) / TAMANHO
+    sul, norte = sul - (norte - sul) * margem, norte + (norte - sul) * margem
+    oeste, leste = oeste - (leste - oeste) * margem, leste + (leste - oeste) * margem
+
+    arvores = Tree.objects.filter(
+        **filtros, latitude__gte=sul, latitude__lte=norte, longitude__gte=oeste, longitude__lte=leste
+    )
+    nivel = min(z, grade.NIVEL_QUADKEY)
+    # Faixas do quadkey: a consulta usa o índice por cidade e quadkey
+    faixas = Q()
+    for prefixo in grade.prefixos_no_retangulo(sul, oeste, norte, leste, nivel):
+        faixas |= Q(quadkey__gte=prefixo, quadkey__lt=prefixo + '4')
+    linhas = np.array(list(
+        arvores.filter(faixas).annotate(tem_posts=Exists(Post.objects.filter(tree=OuterRef('pk'))))
+        .values_list('latitude', 'longitude', 'tem_posts')
+    ), dtype=float).reshape(-1, 3)
+
+    imagem = np.zeros((TAMANHO, TAMANHO, 4), dtype=np.uint8)
+    if len(linhas):
+        px, py = grade.posicoes(linhas[:, 0], linhas[:, 1], z)
+        px, py = (px - x) * TAMANHO, (py - y) * TAMANHO
+        com_posts = linhas[:, 2] > 0
+        carimbo = _carimbo(raio)
+        # Amarelo por cima: árvores com posts continuam visíveis em áreas densas
+        _desenhar(imagem, px[~com_posts], py[~com_posts], VERDE, carimbo)
+        _desenhar(imagem, px[com_posts], py[com_posts], AMARELO, carimbo)
+
+    saida = io.BytesIO()
+    Image.fromarray(imagem, 'RGBA').save(saida, format='PNG')
+    return saida.getvalue()
+
+
+def ladrilho(filtros, z, x, y, versao=None):
+    """PNG do ladrilho, lido do disco ou desenhado e gravado (na versão atual ou na informada)"""
+    arquivo = caminho(filtros, z, x, y, versao)
+    if arquivo.exists():
+        return arquivo.read_bytes()
+    conteudo = renderizar(filtros, z, x, y)
+    arquivo.parent.mkdir(parents=True, exist_ok=True)
+    # Gravação atômica: outro processo pode estar lendo o mesmo ladrilho
+    temporario = arquivo.with_suffix(f'.{hashlib.md5(conteudo).hexdigest()[:8]}.tmp')
+    temporario.write_bytes(conteudo)
+    temporario.replace(arquivo)
+    return conteudo
+
+
+def remover_versoes_antigas(cidade):
+    """Apaga do disco os ladrilhos das versões anteriores da cidade; retorna quantas versões"""
+    atual = versao_ladrilhos(cidade)
+    pasta = diretorio() / str(cidade.pk)
+    if not pasta.exists():
+        return 0
+    antigas = [versao for versao in pasta.iterdir() if versao.is_dir() and versao.name != atual]
+    for versao in antigas:
+        shutil.rmtree(versao, ignore_errors=True)
+    return len(antigas)
@@ -0,0 +1,136 @@
+"""
+Comando Django para medir o custo por árvore das fórmulas de serviços ecossistêmicos.
+
+Compara o caminho antigo (fórmula reinterpretada a cada chamada) com o
+caminho atual (fórmula compilada uma vez por versão), usando o inventário
+real de trees_all.csv, e reporta o ganho da memoização por entradas
+distintas (dap, altura, espécie): quantas combinações distintas existem e a
+taxa de acerto da tabela LRU no cálculo em lote.
+
+Uso:
+    python manage.py benchmark_formulas
+    python manage.py benchmark_formulas --limite 2000
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from main.batch import DadosLote, calcular_lote, linhas_distintas, matriz_entrada
+from main.coeficientes import tabela_coeficientes
+from main.formulas import invalidar_formula, obter_formula_compilada
+from main.memo import memo_servicos
+from main.inventario import CSV_INVENTARIO, ler_inventario_csv
+from main.models import EcosystemServiceConfig, Species, Tree
+
+
+class Command(BaseCommand):
+    help = 'Mede o custo por árvore de EcosystemServiceConfig.calcular antes e depois do cache de fórmulas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--csv', default=str(CSV_INVENTARIO), help='Caminho do inventário (trees_all.csv)')
+        parser.add_argument('--limite', type=int, default=0, help='Número máximo de árvores (0 = todas)')
+
+    def handle(self, *args, **options):
+        """Executa o benchmark"""
+        servicos = list(EcosystemServiceConfig.objects.filter(ativo=True))
+        if not servicos:
+            self.stdout.write(
+                self.style.WARNING('⚠️  Nenhum serviço configurado. Execute: python manage.py init_ecosystem_services')
+            )
+            return
+
+        arvores = self._carregar_arvores(options['csv'], options['limite'])
+        self.stdout.write(f'Inventário: {len(arvores)} árvores, {len(servicos)} serviços ativos\n')
+
+        # A comparação antes/depois mede apenas o cache de fórmulas (calcular não é memoizado)
+        total_antes = 0.0
+        total_depois = 0.0
+        for servico in servicos:
+            # Antes: a fórmula é recompilada em toda chamada (equivale ao eval da string)
+            inicio = time.perf_counter()
+            for arvore in arvores:
+                invalidar_formula(servico.pk)
+                servico.calcular(arvore)
+            antes = time.perf_counter() - inicio
+
+            # Depois: a fórmula é compilada na primeira chamada e reutilizada
+            invalidar_formula(servico.pk)
+            inicio = time.perf_counter()
+            for arvore in arvores:
+                servico.calcular(arvore)
+            depois = time.perf_counter() - inicio
+
+            total_antes += antes
+            total_depois += depois
+            self._reportar(servico.codigo, antes, depois, len(arvores))
+
+        self.stdout.write('')
+        self._reportar('TOTAL', total_antes, total_depois, len(arvores), estilo=self.style.SUCCESS)
+
+        if memo_servicos.habilitado:
+            self._reportar_memo(servicos, arvores)
+
+    def _carregar_arvores(self, caminho, limite):
+        """Monta instâncias de Tree (não salvas) a partir do CSV, com a espécie já resolvida"""
+        especies = {especie.name.lower(): especie for especie in Species.objects.all()}
+        registros = ler_inventario_csv(caminho)
+        if limite:
+            registros = registros[:limite]
+        return [
+            Tree(
+                dap=registro['dap'],
+                altura=registro['altura'],
+                species=especies.get(registro['nome_cientifico'].lower()),
+            )
+            for registro in registros
+        ]
+
+    def _reportar_memo(self, servicos, arvores):
+        """Entradas distintas por serviço e taxa de acerto da memoização"""
+        self.stdout.write('\nMemoização por entradas distintas:')
+        for servico in servicos:
+            dados = DadosLote.para_servicos(arvores, [servico])
+            tabela = tabela_coeficientes(servico)
+            matriz = matriz_entrada(
+                dados, obter_formula_compilada(servico).dependencias, tabela.por_especie, tabela.por_cidade
+            )
+            if matriz is None:
+                self.stdout.write(f'{servico.codigo:<22} não memoizável (acesso dinâmico ou campo não numérico)')
+                continue
+            distintas = len(linhas_distintas(matriz)[0])
+            self.stdout.write(
+                f'{servico.codigo:<22} {distintas:6d} entradas distintas para {len(arvores)} árvores '
+                f'({len(arvores) / distintas:.1f} árvores por entrada)'
+            )
+
+        self.stdout.write('')
+        for rodada in ('fria', 'quente'):
+            if rodada == 'fria':
+                memo_servicos.limpar()
+            else:
+                memo_servicos.acertos = memo_servicos.faltas = 0
+            dados = DadosLote.para_servicos(arvores, servicos)
+            inicio = time.perf_counter()
+            for servico in servicos:
+                calcular_lote(servico, dados)
+            tempo = time.perf_counter() - inicio
+            self._reportar_taxa(f'lote ({rodada})', tempo * 1e3, 'ms')
+
+    def _reportar_taxa(self, nome, tempo, unidade):
+        estatisticas = memo_servicos.estatisticas()
+        self.stdout.write(self.style.SUCCESS(
+            f'{nome:<22} acertos: {estatisticas["acertos"]:7d}   faltas: {estatisticas["faltas"]:7d}   '
+            f'taxa: {estatisticas["taxa_acerto"]:6.1%}   entradas: {estatisticas["entradas"]:6d}   '
+            f'{tempo:8.2f} {unidade}'
+        ))
+
+    def _reportar(self, nome, antes, depois, n_arvores, estilo=None):
+        """Escreve o custo por árvore (µs) antes/depois e o ganho"""
+        por_arvore_antes = antes / n_arvores * 1e6
+        por_arvore_depois = depois / n_arvores * 1e6
+        ganho = antes / depois if depois else float('inf')
+        linha = (
+            f'{nome:<22} antes: {por_arvore_antes:8.2f} µs/árvore   '
+            f'depois: {por_arvore_depois:8.2f} µs/árvore   ({ganho:.1f}x)'
+        )
+        self.stdout.write(estilo(linha) if estilo else linha)
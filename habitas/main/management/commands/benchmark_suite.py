@@ -0,0 +1,428 @@
+"""
+Comando Django para medir os caminhos críticos da aplicação em inventários de vários tamanhos.
+
+Para cada tamanho (por padrão 15 mil, 100 mil e 1 milhão de árvores) o
+inventário da cidade é ampliado com cópias das árvores existentes
+(coordenadas levemente deslocadas, via bulk_create) dentro de uma transação
+que é desfeita ao final: o banco não é alterado. Em cada tamanho são medidos:
+
+    calcular      EcosystemServiceConfig.calcular de cada serviço ativo em uma amostra de árvores
+    servicos      Tree.get_all_ecosystem_services na mesma amostra
+    index         renderização completa da view index (mapa)
+    api_arvores   resposta completa (transmitida) de /api/trees/, as árvores em JSON
+    api_pontos    marcadores do mapa no formato colunar binário (/api/trees/pontos/)
+    api_estatisticas  estatísticas do painel do mapa somadas no servidor (/api/trees/estatisticas/);
+                  a primeira execução soma e as demais leem do cache
+    api_agrupamentos  agrupamentos do mapa da cidade inteira em zoom 12 (/api/trees/agrupamentos/);
+                  a primeira execução soma a grade e as demais a leem do cache
+    species_list  lista de espécies do filtro do mapa
+    importacao    importação do admin (TreeResource) de linhas de trees_all.csv
+
+Cada alvo é executado uma vez para aquecer (tempo registrado em
+`primeira_s`) e depois `--repeticoes` vezes; são registrados a mediana e o
+mínimo do tempo de parede, o número de consultas SQL de uma execução e o pico
+de memória Python (tracemalloc) de uma execução extra.
+
+O resultado pode ser gravado em JSON (com o commit, versões e banco) e
+comparado com o de outro commit.
+
+Uso:
+    python manage.py benchmark_suite
+    python manage.py benchmark_suite --tamanhos 15000 100000 --alvos calcular index
+    python manage.py benchmark_suite --json bench.json
+    python manage.py benchmark_suite --comparar bench_anterior.json --falhar-regressao
+"""
+
+import json
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+import django
+import numpy as np
+import tablib
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.utils import timezone
+from main import cidades, geo, grade, registry, views
+from main.admin import TreeResource
+from main.inventario import CSV_INVENTARIO, invalidar_inventario, ler_inventario_csv
+from main.memo import memo_servicos
+from main.perfil import perfil_servicos
+from main.models import Tree
+
+ALVOS = (
+    'calcular', 'servicos', 'index', 'api_arvores', 'api_pontos', 'api_estatisticas', 'api_agrupamentos',
+    'species_list', 'importacao',
+)
+TAMANHOS_PADRAO = (15_000, 100_000, 1_000_000)
+# Campos copiados das árvores existentes ao ampliar o inventário
+CAMPOS_COPIA = (
+    'N_placa', 'nome_popular', 'nome_cientifico', 'dap', 'altura', 'latitude', 'longitude',
+    'plantado_por', 'species_id', 'city_id', 'bairro',
+)
+DESLOCAMENTO_GRAUS = 0.0002  # desvio padrão (~20 m) das coordenadas das cópias
+LOTE_CARGA = 50_000
+ZOOM_AGRUPAMENTOS = 12  # cidade inteira na tela
+# Placas das linhas importadas: acima das do inventário real, para serem inserções
+DESLOCAMENTO_PLACA = 10_000_000
+SEMENTE = 42
+# Metadados que precisam coincidir para que duas execuções sejam comparáveis
+PARAMETROS_COMPARAVEIS = ('banco', 'cidade', 'servicos_ativos', 'amostra', 'linhas_importacao')
+
+
+class _ContadorConsultas:
+    """Conta as consultas SQL executadas (sem depender do log de consultas do DEBUG, limitado a 9000)"""
+
+    def __init__(self):
+        self.consultas = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.consultas += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = 'Mede tempo, consultas e memória de calcular, serviços, index, API do mapa, species_list e importação'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--tamanhos', type=int, nargs='+', default=list(TAMANHOS_PADRAO), metavar='N',
+            help='Tamanhos do inventário da cidade (padrão: 15000 100000 1000000)'
+        )
+        parser.add_argument('--alvos', nargs='+', choices=ALVOS, default=list(ALVOS), help='Alvos medidos')
+        parser.add_argument('--cidade', metavar='SLUG', help='Cidade (padrão: settings.CIDADE_PADRAO)')
+        parser.add_argument('--repeticoes', type=int, default=3, help='Execuções medidas por alvo (padrão: 3)')
+        parser.add_argument(
+            '--amostra', type=int, default=20_000,
+            help='Árvores avaliadas em calcular e servicos (padrão: 20000)'
+        )
+        parser.add_argument(
+            '--index-max', type=int, default=200_000, metavar='N',
+            help='Não renderiza o index acima de N árvores (0 = sem limite; padrão: 200000)'
+        )
+        parser.add_argument(
+            '--linhas-importacao', type=int, default=1000, metavar='N',
+            help='Linhas de trees_all.csv importadas pelo TreeResource (padrão: 1000)'
+        )
+        parser.add_argument('--csv', default=str(CSV_INVENTARIO), help='Caminho do inventário (trees_all.csv)')
+        parser.add_argument('--json', metavar='ARQUIVO', help='Grava os resultados em JSON')
+        parser.add_argument('--comparar', metavar='ARQUIVO', help='JSON de uma execução anterior para comparação')
+        parser.add_argument(
+            '--limite-regressao', type=float, default=10.0, metavar='PCT',
+            help='Aumento de tempo (%%) considerado regressão na comparação (padrão: 10)'
+        )
+        parser.add_argument(
+            '--falhar-regressao', action='store_true',
+            help='Termina com erro se a comparação encontrar regressões'
+        )
+
+    def handle(self, *args, **options):
+        """Executa o benchmark"""
+        if options['repeticoes'] < 1:
+            raise CommandError('--repeticoes deve ser pelo menos 1')
+        cidade = cidades.cidade_do_comando(options['cidade'])
+        if not Tree.objects.filter(city=cidade).exists():
+            raise CommandError(f'A cidade {cidade.nome} não tem árvores para ampliar')
+        anterior = self._ler_anterior(options['comparar']) if options['comparar'] else None
+
+        servicos = registry.servicos_ativos()
+        if not servicos:
+            self.stdout.write(
+                self.style.WARNING('⚠️  Nenhum serviço configurado. Execute: python manage.py init_ecosystem_services')
+            )
+        registros_importacao = ler_inventario_csv(options['csv'])[:options['linhas_importacao']]
+
+        relatorio = {
+            'meta': self._metadados(cidade, options, len(servicos)),
+            'resultados': [],
+        }
+        # O perfilamento das fórmulas fica desligado para não somar o benchmark às estatísticas de produção
+        perfil_habilitado = perfil_servicos.habilitado
+        perfil_servicos.habilitado = False
+        try:
+            for tamanho in sorted(options['tamanhos']):
+                with transaction.atomic():
+                    inicio = time.perf_counter()
+                    arvores = self._ampliar(cidade, tamanho)
+                    # Cópias entram sem sinais: resultados em cache de outra execução deixam de valer
+                    invalidar_inventario(cidade.pk)
+                    carga = time.perf_counter() - inicio
+                    self.stdout.write(self.style.SUCCESS(
+                        f'\n✓ Inventário de {cidade.nome}: {arvores} árvores (carga {carga:.1f} s)'
+                    ))
+                    contexto = {
+                        'cidade': cidade,
+                        'servicos': servicos,
+                        'amostra': self._amostra(cidade, options['amostra']),
+                        'importacao': registros_importacao,
+                    }
+                    for alvo in options['alvos']:
+                        resultado = {'tamanho': tamanho, 'arvores': arvores, 'alvo': alvo}
+                        if alvo == 'index' and options['index_max'] and arvores > options['index_max']:
+                            resultado['pulado'] = f'inventário acima de --index-max ({options["index_max"]})'
+                        else:
+                            resultado.update(self._executar(alvo, contexto, options['repeticoes']))
+                        relatorio['resultados'].append(resultado)
+                        self._reportar(resultado)
+                    transaction.set_rollback(True)
+        finally:
+            perfil_servicos.habilitado = perfil_habilitado
+            memo_servicos.limpar()
+
+        regressoes = []
+        if anterior is not None:
+            regressoes = self._comparar(anterior, relatorio, options['limite_regressao'])
+
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as arquivo:
+                json.dump(relatorio, arquivo, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'\n✓ Resultados gravados em {options["json"]}'))
+
+        if regressoes and options['falhar_regressao']:
+            raise CommandError(f'{len(regressoes)} regressão(ões): {", ".join(regressoes)}')
+
+    # ==================== PREPARAÇÃO ====================
+
+    def _metadados(self, cidade, options, n_servicos):
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            'commit': commit,
+            'data': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'numpy': np.__version__,
+            'banco': connection.vendor,
+            'cidade': cidade.slug,
+            'servicos_ativos': n_servicos,
+            'repeticoes': options['repeticoes'],
+            'amostra': options['amostra'],
+            'linhas_importacao': options['linhas_importacao'],
+        }
+
+    def _ampliar(self, cidade, tamanho):
+        """Completa o inventário da cidade até `tamanho` árvores com cópias deslocadas das existentes
+
+        Tamanhos menores que o inventário atual usam o inventário inteiro. As
+        cópias entram por bulk_create (sem sinais), já com cidade, bairro e quadkey.
+        """
+        atual = Tree.objects.filter(city=cidade).count()
+        faltam = tamanho - atual
+        if faltam <= 0:
+            return atual
+        modelos = list(Tree.objects.filter(city=cidade).order_by('id').values(*CAMPOS_COPIA))
+        rng = np.random.default_rng(SEMENTE)
+        for inicio in range(0, faltam, LOTE_CARGA):
+            n = min(LOTE_CARGA, faltam - inicio)
+            escolhidas = rng.integers(len(modelos), size=n)
+            deslocamentos = rng.normal(0, DESLOCAMENTO_GRAUS, size=(n, 2))
+            latitude = np.array([modelos[i]['latitude'] for i in escolhidas.tolist()]) + deslocamentos[:, 0]
+            longitude = np.array([modelos[i]['longitude'] for i in escolhidas.tolist()]) + deslocamentos[:, 1]
+            chaves = grade.quadkeys(latitude, longitude)
+            Tree.objects.bulk_create([
+                Tree(**{**modelos[i], 'latitude': lat, 'longitude': lon, 'quadkey': chave})
+                for i, lat, lon, chave in zip(escolhidas.tolist(), latitude.tolist(), longitude.tolist(), chaves)
+            ], batch_size=2000)
+        return tamanho
+
+    def _amostra(self, cidade, tamanho):
+        """Árvores sorteadas (com a espécie carregada) para os cálculos árvore a árvore"""
+        ids = np.fromiter(Tree.objects.filter(city=cidade).values_list('id', flat=True), dtype=np.int64)
+        if tamanho < len(ids):
+            ids = np.random.default_rng(SEMENTE).choice(ids, size=tamanho, replace=False)
+        arvores = Tree.objects.select_related('species').in_bulk(ids.tolist())
+        return [arvores[i] for i in sorted(arvores)]
+
+    def _ler_anterior(self, caminho):
+        try:
+            with open(caminho, encoding='utf-8') as arquivo:
+                return json.load(arquivo)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Não foi possível ler {caminho}: {e}')
+
+    # ==================== ALVOS ====================
+
+    def _calcular(self, contexto):
+        for servico in contexto['servicos']:
+            for arvore in contexto['amostra']:
+                servico.calcular(arvore)
+
+    def _servicos(self, contexto):
+        for arvore in contexto['amostra']:
+            arvore.get_all_ecosystem_services()
+
+    def _index(self, contexto):
+        requisicao = RequestFactory().get('/', {'cidade': contexto['cidade'].slug})
+        requisicao.user = AnonymousUser()
+        resposta = views.index(requisicao)
+        if resposta.status_code != 200:
+            raise CommandError(f'index respondeu {resposta.status_code}')
+
+    def _api_arvores(self, contexto):
+        requisicao = RequestFactory().get('/api/trees/', {'cidade': contexto['cidade'].slug})
+        requisicao.user = AnonymousUser()
+        for _ in views.api_arvores(requisicao).streaming_content:
+            pass
+
+    def _api_pontos(self, contexto):
+        requisicao = RequestFactory().get('/api/trees/pontos/', {'cidade': contexto['cidade'].slug})
+        requisicao.user = AnonymousUser()
+        views.api_pontos(requisicao)
+
+    def _api_estatisticas(self, contexto):
+        requisicao = RequestFactory().get('/api/trees/estatisticas/', {'cidade': contexto['cidade'].slug})
+        requisicao.user = AnonymousUser()
+        resposta = views.api_estatisticas(requisicao)
+        if resposta.status_code != 200:
+            raise CommandError(f'api_estatisticas respondeu {resposta.status_code}')
+
+    def _api_agrupamentos(self, contexto):
+        cidade = contexto['cidade']
+        poligonos = geo.limite_cidade(cidade)
+        bbox = ','.join(str(valor) for valor in (
+            min(p.lon_min for p in poligonos), min(p.lat_min for p in poligonos),
+            max(p.lon_max for p in poligonos), max(p.lat_max for p in poligonos),
+        ))
+        requisicao = RequestFactory().get(
+            '/api/trees/agrupamentos/', {'cidade': cidade.slug, 'bbox': bbox, 'zoom': ZOOM_AGRUPAMENTOS}
+        )
+        requisicao.user = AnonymousUser()
+        resposta = views.api_agrupamentos(requisicao)
+        if resposta.status_code != 200:
+            raise CommandError(f'api_agrupamentos respondeu {resposta.status_code}')
+
+    def _species_list(self, contexto):
+        list(views.lista_especies(contexto['cidade']))
+
+    def _importacao(self, contexto):
+        """Importa as linhas como novas árvores e desfaz a importação (savepoint)"""
+        campos = TreeResource.Meta.fields
+        dados = tablib.Dataset(headers=campos)
+        for registro in contexto['importacao']:
+            dados.append([
+                registro['N_placa'] + DESLOCAMENTO_PLACA if campo == 'N_placa' else registro[campo]
+                for campo in campos
+            ])
+        with transaction.atomic():
+            resultado = TreeResource().import_data(dados, dry_run=False, raise_errors=True)
+            transaction.set_rollback(True)
+        if resultado.has_validation_errors():
+            raise CommandError('A importação de teste tem erros de validação')
+
+    def _unidades(self, alvo, contexto):
+        """Número de avaliações de uma execução, para o custo por unidade"""
+        if alvo == 'calcular':
+            return len(contexto['amostra']) * len(contexto['servicos'])
+        if alvo == 'servicos':
+            return len(contexto['amostra'])
+        if alvo == 'importacao':
+            return len(contexto['importacao'])
+        return None
+
+    # ==================== MEDIÇÃO ====================
+
+    def _executar(self, alvo, contexto, repeticoes):
+        """Aquecimento, execuções medidas (tempo e consultas) e uma execução sob tracemalloc"""
+        funcao = getattr(self, f'_{alvo}')
+
+        inicio = time.perf_counter()
+        funcao(contexto)
+        primeira = time.perf_counter() - inicio
+
+        tempos = []
+        consultas = []
+        for _ in range(repeticoes):
+            contador = _ContadorConsultas()
+            with connection.execute_wrapper(contador):
+                inicio = time.perf_counter()
+                funcao(contexto)
+                tempos.append(time.perf_counter() - inicio)
+            consultas.append(contador.consultas)
+
+        tracemalloc.start()
+        try:
+            funcao(contexto)
+            _, pico = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        resultado = {
+            'tempo_s': round(statistics.median(tempos), 6),
+            'tempo_min_s': round(min(tempos), 6),
+            'primeira_s': round(primeira, 6),
+            'consultas': consultas[0],
+            'memoria_pico_mb': round(pico / 2 ** 20, 3),
+        }
+        unidades = self._unidades(alvo, contexto)
+        if unidades:
+            resultado['unidades'] = unidades
+            resultado['us_por_unidade'] = round(resultado['tempo_s'] / unidades * 1e6, 3)
+        return resultado
+
+    # ==================== RELATÓRIO ====================
+
+    def _reportar(self, resultado):
+        if 'pulado' in resultado:
+            self.stdout.write(self.style.WARNING(f'  {resultado["alvo"]:<18} pulado: {resultado["pulado"]}'))
+            return
+        linha = (
+            f'  {resultado["alvo"]:<18}{resultado["tempo_s"] * 1e3:>11.1f} ms   '
+            f'(mín {resultado["tempo_min_s"] * 1e3:.1f}, 1ª {resultado["primeira_s"] * 1e3:.1f})   '
+            f'{resultado["consultas"]:>6} consultas   {resultado["memoria_pico_mb"]:>9.1f} MB'
+        )
+        if 'us_por_unidade' in resultado:
+            linha += f'   {resultado["us_por_unidade"]:.2f} µs/unidade'
+        self.stdout.write(linha)
+
+    def _comparar(self, anterior, atual, limite):
+        """Variação de tempo, consultas e memória em relação à execução anterior; retorna as regressões"""
+        base = {
+            (r['tamanho'], r['alvo']): r for r in anterior.get('resultados', []) if 'pulado' not in r
+        }
+        self.stdout.write(
+            f'\nComparação com {anterior.get("meta", {}).get("commit") or "execução anterior"} '
+            f'(regressão: tempo > +{limite:g}% ou mais consultas):'
+        )
+        diferentes = [
+            parametro for parametro in PARAMETROS_COMPARAVEIS
+            if anterior.get('meta', {}).get(parametro) != atual['meta'][parametro]
+        ]
+        if diferentes:
+            self.stdout.write(self.style.WARNING(
+                f'⚠️  Parâmetros diferentes da execução anterior ({", ".join(diferentes)}): '
+                'comparação aproximada'
+            ))
+        regressoes = []
+        for resultado in atual['resultados']:
+            chave = (resultado['tamanho'], resultado['alvo'])
+            antes = base.get(chave)
+            if antes is None or 'pulado' in resultado:
+                continue
+            variacao = (resultado['tempo_s'] / antes['tempo_s'] - 1) * 100 if antes['tempo_s'] else 0.0
+            consultas = resultado['consultas'] - antes['consultas']
+            memoria = resultado['memoria_pico_mb'] - antes['memoria_pico_mb']
+            linha = (
+                f'  {resultado["alvo"]:<18}{resultado["tamanho"]:>9}   tempo {variacao:+7.1f}%   '
+                f'consultas {consultas:+6d}   memória {memoria:+9.1f} MB'
+            )
+            if variacao > limite or consultas > 0:
+                regressoes.append(f'{resultado["alvo"]}@{resultado["tamanho"]}')
+                self.stdout.write(self.style.ERROR(f'{linha}   ❌'))
+            elif variacao < -limite:
+                self.stdout.write(self.style.SUCCESS(f'{linha}   ✓'))
+            else:
+                self.stdout.write(linha)
+        if not regressoes:
+            self.stdout.write(self.style.SUCCESS('✅ Nenhuma regressão'))
+        return regressoes
@@ -0,0 +1,68 @@
+"""
+Comando Django para exibir a área de copa e a cobertura de copa por bairro.
+
+A área de copa é a união dos círculos de copa (diâmetro = dap *
+DIAMETER_RATIO, o mesmo modelo da chuva interceptada), sem contar duas vezes
+as copas sobrepostas; a cobertura é a razão entre essa área e a área do
+bairro (static/js/bairros.js). Ver main/copa.py.
+
+Uso:
+    python manage.py canopy_cover
+    python manage.py canopy_cover --resolucao 0.5 --sem-cache
+    python manage.py canopy_cover --json cobertura.json
+    python manage.py canopy_cover --cidade sao-jose-dos-campos
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from main import cidades, copa
+from main.crescimento import SEM_BAIRRO
+
+
+class Command(BaseCommand):
+    help = 'Exibe a área de copa (união das copas) e a porcentagem de cobertura por bairro'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cidade', metavar='SLUG', help='Cidade (padrão: settings.CIDADE_PADRAO)')
+        parser.add_argument(
+            '--resolucao', type=float, metavar='METROS',
+            help=f'Lado das células da grade (padrão: settings.COPA_RESOLUCAO_M ou {copa.RESOLUCAO_PADRAO})'
+        )
+        parser.add_argument('--sem-cache', action='store_true', help='Recalcula mesmo com resultado em cache')
+        parser.add_argument('--json', metavar='ARQUIVO', help='Grava o resultado em JSON')
+
+    def handle(self, *args, **options):
+        """Exibe a cobertura"""
+        if options['resolucao'] is not None and options['resolucao'] <= 0:
+            raise CommandError('--resolucao deve ser positiva')
+        cidade = cidades.cidade_do_comando(options['cidade'])
+        resultado = copa.cobertura_por_bairro(cidade, options['resolucao'], usar_cache=not options['sem_cache'])
+        self.stdout.write(f'Cidade: {cidade.nome}\n')
+
+        self.stdout.write(f'{"bairro":<32}{"árvores":>9}{"área (ha)":>12}{"copa (m²)":>12}{"cobertura":>11}')
+        for bairro, valores in sorted(resultado['bairros'].items(), key=lambda item: -item[1]['cobertura_pct']):
+            if not valores['arvores'] and not valores['copa_m2']:
+                continue
+            self.stdout.write(
+                f'{bairro:<32}{valores["arvores"]:>9}{valores["area_m2"] / 10000:>12.1f}'
+                f'{valores["copa_m2"]:>12.1f}{valores["cobertura_pct"]:>10.3f}%'
+            )
+        total = resultado['total']
+        self.stdout.write(
+            f'\n{"Total":<32}{total["arvores"]:>9}{total["area_m2"] / 10000:>12.1f}'
+            f'{total["copa_m2"]:>12.1f}{total["cobertura_pct"]:>10.3f}%'
+        )
+        fora = resultado[SEM_BAIRRO]
+        if fora['arvores'] or fora['copa_m2']:
+            self.stdout.write(self.style.WARNING(
+                f'⚠️  {SEM_BAIRRO}: {fora["arvores"]} árvores, {fora["copa_m2"]:.1f} m² de copa'
+            ))
+        self.stdout.write(self.style.SUCCESS(
+            f'\n✓ Resolução {resultado["resolucao_m"]} m, calculado em {resultado["tempo_s"]:.2f}s'
+        ))
+
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as arquivo:
+                json.dump(resultado, arquivo, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'✓ Cobertura gravada em {options["json"]}'))
@@ -0,0 +1,80 @@
+"""
+Comando Django para verificar que a avaliação em lote (vetorizada) das fórmulas
+coincide com o cálculo árvore a árvore (EcosystemServiceConfig.calcular).
+
+Compara, em uma amostra do inventário, os serviços ativos e um conjunto de
+fórmulas de referência com as construções reescritas pela variante
+vetorizada (`and`/`or` devolvendo operandos, `x if cond else y`, `not`,
+`is None`, comparações encadeadas e a espécie usada como condição ou
+valor), que incluem árvores sem espécie e com DAP/altura nulos. O lote é
+avaliado sem memoização. O comando termina com código de saída diferente de
+zero quando há divergências.
+
+Uso:
+    python manage.py compare_batch_formulas
+    python manage.py compare_batch_formulas --limite 5000 --piores 10
+"""
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from main import registry
+from main.batch import DadosLote, calcular_lote
+from main.models import EcosystemServiceConfig, Tree
+
+# Fórmulas com as construções que a variante vetorizada reescreve
+FORMULAS_REFERENCIA = (
+    'dap or 1',
+    'altura and dap',
+    '(tree.species and tree.species.bio_index or 1) * dap',
+    'dap * 2 if tree.species else altura',
+    '0 if not tree.species else dap',
+    'altura if tree.species is None else dap',
+    'dap if 10 < dap < 40 else 0',
+    '(tree.species.bio_index or 0.5) * biomassa if tree.species else 0',
+    'tree.species or 1',
+    'not tree.species and altura or dap',
+)
+
+
+class Command(BaseCommand):
+    help = 'Compara calcular_lote com EcosystemServiceConfig.calcular em uma amostra do inventário'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limite', type=int, default=2000, help='Número de árvores da amostra (0 = todas)')
+        parser.add_argument('--piores', type=int, default=5, help='Árvores divergentes exibidas por fórmula')
+
+    def handle(self, *args, **options):
+        arvores = Tree.objects.select_related('species').order_by('id')
+        if options['limite']:
+            arvores = arvores[:options['limite']]
+        arvores = list(arvores)
+        if not arvores:
+            self.stdout.write(self.style.WARNING('⚠️  Nenhuma árvore no inventário'))
+            return
+
+        configs = list(registry.servicos_ativos()) + [
+            EcosystemServiceConfig(codigo=f'referencia_{i}', nome=formula, formula=formula, ativo=True)
+            for i, formula in enumerate(FORMULAS_REFERENCIA, 1)
+        ]
+        self.stdout.write(f'Amostra: {len(arvores)} árvores, {len(configs)} fórmulas\n')
+
+        divergentes = sum(self._comparar(config, arvores, options['piores']) for config in configs)
+
+        if divergentes:
+            raise CommandError(f'{divergentes} fórmulas com divergências entre o lote e o cálculo por árvore')
+        self.stdout.write(self.style.SUCCESS('✅ Lote e cálculo por árvore coincidem em todas as fórmulas'))
+
+    def _comparar(self, config, arvores, piores):
+        """Compara os dois caminhos para uma fórmula; retorna 1 se houver divergência"""
+        lote = calcular_lote(config, DadosLote.para_servicos(arvores, [config]), memoizar=False)
+        escalar = np.array([config.calcular(arvore) for arvore in arvores], dtype=float)
+        diferentes = np.flatnonzero(~np.isclose(lote, escalar, rtol=0, atol=1e-9))
+        if not len(diferentes):
+            self.stdout.write(self.style.SUCCESS(f'  ✓ {config.codigo}: {config.formula}'))
+            return 0
+        self.stdout.write(self.style.ERROR(
+            f'  ❌ {config.codigo}: {config.formula} ({len(diferentes)} de {len(arvores)} árvores)'
+        ))
+        for i in diferentes[:piores]:
+            self.stdout.write(f'      árvore {arvores[i].id}: lote={lote[i]} por árvore={escalar[i]}')
+        return 1
@@ -0,0 +1,97 @@
+"""
+Comando Django para exibir os índices de diversidade de espécies por bairro.
+
+Riqueza, Shannon e Simpson vêm da tabela de contagens de espécies mantida
+pelos sinais de Tree (ver main/diversidade.py). Após cargas em massa que não
+disparam sinais (bulk_create, update, SQL direto), reconstrua a tabela.
+
+Uso:
+    python manage.py diversity_indices
+    python manage.py diversity_indices --plantado-por DCTA --bairros "Jardim Aquarius" Centro
+    python manage.py diversity_indices --reconstruir
+    python manage.py diversity_indices --verificar --json diversidade.json
+    python manage.py diversity_indices --cidade sao-jose-dos-campos
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from main import cidades, diversidade
+from main.models import Tree
+
+
+class Command(BaseCommand):
+    help = 'Exibe riqueza, Shannon e Simpson por bairro a partir da tabela de contagens de espécies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cidade', metavar='SLUG', help='Cidade (padrão: settings.CIDADE_PADRAO)')
+        parser.add_argument('--bairros', nargs='+', metavar='BAIRRO', help='Apenas estes bairros')
+        parser.add_argument('--plantado-por', help='Filtra por organização de plantio (contém)')
+        parser.add_argument('--species', type=int, metavar='ID', help='Filtra por espécie')
+        parser.add_argument(
+            '--reconstruir', action='store_true',
+            help='Recria a tabela de contagens a partir do inventário antes de exibir'
+        )
+        parser.add_argument(
+            '--verificar', action='store_true',
+            help='Compara a tabela de contagens com um GROUP BY sobre o inventário'
+        )
+        parser.add_argument('--json', metavar='ARQUIVO', help='Grava os índices em JSON')
+
+    def handle(self, *args, **options):
+        """Exibe os índices"""
+        if options['reconstruir']:
+            linhas = diversidade.reconstruir_contagens()
+            self.stdout.write(self.style.SUCCESS(f'✓ Tabela de contagens reconstruída ({linhas} linhas)'))
+
+        cidade = cidades.cidade_do_comando(options['cidade'])
+        self.stdout.write(f'Cidade: {cidade.nome}\n')
+        filtros = {
+            'cidade': cidade,
+            'bairros': options['bairros'],
+            'plantado_por': options['plantado_por'],
+            'species': options['species'],
+        }
+        selecao = diversidade.indices_selecao(**filtros)
+        por_bairro = diversidade.indices_por_bairro(**filtros)
+
+        self.stdout.write(f'{"bairro":<32}{"árvores":>9}{"riqueza":>9}{"Shannon":>9}{"Simpson":>9}')
+        for bairro, valores in sorted(por_bairro.items(), key=lambda item: -item[1]['shannon']):
+            self.stdout.write(
+                f'{bairro:<32}{valores["arvores"]:>9}{valores["riqueza"]:>9}'
+                f'{valores["shannon"]:>9.3f}{valores["simpson"]:>9.3f}'
+            )
+        self.stdout.write(
+            f'\n{"Seleção":<32}{selecao["arvores"]:>9}{selecao["riqueza"]:>9}'
+            f'{selecao["shannon"]:>9.3f}{selecao["simpson"]:>9.3f}'
+        )
+
+        if options['verificar']:
+            self._verificar(filtros, por_bairro)
+
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as arquivo:
+                json.dump({'selecao': selecao, 'por_bairro': por_bairro}, arquivo, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'\n✓ Índices gravados em {options["json"]}'))
+
+    def _verificar(self, filtros, por_bairro):
+        """Falha se a tabela incremental divergir de um GROUP BY sobre as árvores"""
+        arvores = Tree.objects.filter(city=filtros['cidade'])
+        if filtros['bairros']:
+            arvores = arvores.filter(bairro__in=[
+                diversidade.SEM_BAIRRO_TABELA if b == diversidade.SEM_BAIRRO else b for b in filtros['bairros']
+            ])
+        if filtros['plantado_por']:
+            arvores = arvores.filter(plantado_por__icontains=filtros['plantado_por'])
+        if filtros['species']:
+            arvores = arvores.filter(species_id=filtros['species'])
+        esperado = diversidade.indices_queryset_por_bairro(arvores)
+        divergentes = sorted(
+            bairro for bairro in set(esperado) | set(por_bairro) if esperado.get(bairro) != por_bairro.get(bairro)
+        )
+        if divergentes:
+            raise CommandError(
+                f'Tabela de contagens divergente em {len(divergentes)} bairro(s): {", ".join(divergentes[:10])}. '
+                'Execute: python manage.py diversity_indices --reconstruir'
+            )
+        self.stdout.write(self.style.SUCCESS('\n✅ Tabela de contagens confere com o inventário'))
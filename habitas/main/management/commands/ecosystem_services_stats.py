@@ -0,0 +1,68 @@
+"""
+Comando Django para exibir as estatísticas de execução das fórmulas de serviços ecossistêmicos.
+
+Mostra, por serviço e por caminho de cálculo (árvore a árvore ou em lote),
+chamadas, árvores, tempo total, latência média e percentis, erros e retornos
+0 por falha, ordenados pelo tempo total (ver main/perfil.py). As estatísticas
+são acumuladas por todos os processos que compartilham o cache do Django.
+
+Uso:
+    python manage.py ecosystem_services_stats
+    python manage.py ecosystem_services_stats --json estatisticas.json
+    python manage.py ecosystem_services_stats --reset
+"""
+
+import json
+
+from django.core.management.base import BaseCommand
+from main.perfil import CAMINHOS, PERCENTIS, perfil_servicos
+
+
+class Command(BaseCommand):
+    help = 'Exibe chamadas, latência, erros e retornos 0 das fórmulas de cada serviço'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', metavar='ARQUIVO', help='Grava as estatísticas em JSON')
+        parser.add_argument('--reset', action='store_true', help='Zera as estatísticas acumuladas')
+
+    def handle(self, *args, **options):
+        """Exibe (ou zera) as estatísticas"""
+        if options['reset']:
+            perfil_servicos.limpar()
+            self.stdout.write(self.style.SUCCESS('✓ Estatísticas zeradas'))
+            return
+
+        perfil_servicos.publicar()
+        resumos = {
+            codigo: {caminho: contadores.resumo() for caminho, contadores in perfil_servicos.estatisticas(codigo).items()}
+            for codigo in perfil_servicos.codigos()
+        }
+        if not resumos:
+            self.stdout.write(self.style.WARNING('⚠️  Nenhuma estatística registrada ainda'))
+            return
+
+        total_ms = sum(resumo[caminho]['tempo_total_ms'] for resumo in resumos.values() for caminho in CAMINHOS)
+        percentis = ''.join(f'{f"p{p} (µs)":>11}' for p in PERCENTIS)
+        self.stdout.write(
+            f'{"serviço":<22}{"caminho":<8}{"chamadas":>10}{"árvores":>11}{"total (ms)":>13}{"%":>7}'
+            f'{"média (µs)":>12}{percentis}{"erros":>8}{"zeros":>8}'
+        )
+        ordem = sorted(resumos, key=lambda codigo: -sum(r['tempo_total_ms'] for r in resumos[codigo].values()))
+        for codigo in ordem:
+            for caminho in CAMINHOS:
+                resumo = resumos[codigo][caminho]
+                if not resumo['chamadas']:
+                    continue
+                fracao = resumo['tempo_total_ms'] / total_ms * 100 if total_ms else 0.0
+                valores = ''.join(f'{resumo[f"p{p}_us"]:>11.1f}' for p in PERCENTIS)
+                linha = (
+                    f'{codigo:<22}{caminho:<8}{resumo["chamadas"]:>10}{resumo["arvores"]:>11}'
+                    f'{resumo["tempo_total_ms"]:>13.1f}{fracao:>6.1f}%{resumo["media_us"]:>12.1f}{valores}'
+                    f'{resumo["erros"]:>8}{resumo["zeros"]:>8}'
+                )
+                self.stdout.write(self.style.ERROR(linha) if resumo['erros'] else linha)
+
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as arquivo:
+                json.dump(resumos, arquivo, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'\n✓ Estatísticas gravadas em {options["json"]}'))
@@ -0,0 +1,92 @@
+"""
+Comando Django para estimar intervalos de incerteza dos totais dos serviços ecossistêmicos.
+
+Os coeficientes com distribuição configurada (campo `distribuicoes` de
+EcosystemServiceConfig) são sorteados e as fórmulas são avaliadas em lote
+sobre o inventário de uma cidade para cada amostra (ver main/incerteza.py).
+
+Uso:
+    python manage.py ecosystem_services_uncertainty
+    python manage.py ecosystem_services_uncertainty --amostras 5000 --semente 42
+    python manage.py ecosystem_services_uncertainty --memoria-mb 128 --json incerteza.json
+    python manage.py ecosystem_services_uncertainty --cidade sao-jose-dos-campos
+"""
+
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from main import cidades, registry
+from main.incerteza import monte_carlo
+from main.models import Tree
+
+
+class Command(BaseCommand):
+    help = 'Calcula p5/p50/p95 dos totais de cada serviço (cidade e bairros) por Monte Carlo'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cidade', metavar='SLUG', help='Cidade (padrão: settings.CIDADE_PADRAO)')
+        parser.add_argument('--amostras', type=int, default=1000, help='Número de amostras (padrão: 1000)')
+        parser.add_argument('--semente', type=int, default=None, help='Semente do gerador (resultados reprodutíveis)')
+        parser.add_argument(
+            '--memoria-mb', type=int, default=None,
+            help='Orçamento de memória da matriz amostras x árvores (padrão: settings)'
+        )
+        parser.add_argument(
+            '--services', nargs='+', metavar='CODIGO',
+            help='Códigos dos serviços (padrão: todos os ativos)'
+        )
+        parser.add_argument('--json', metavar='ARQUIVO', help='Grava os percentis da cidade e dos bairros em JSON')
+
+    def handle(self, *args, **options):
+        """Executa a simulação"""
+        if options['amostras'] <= 0 or (options['memoria_mb'] is not None and options['memoria_mb'] <= 0):
+            raise CommandError('--amostras e --memoria-mb devem ser positivos')
+
+        cidade = cidades.cidade_do_comando(options['cidade'])
+        servicos = registry.servicos_ativos()
+        if options['services']:
+            por_codigo = {servico.codigo: servico for servico in servicos}
+            desconhecidos = sorted(set(options['services']) - set(por_codigo))
+            if desconhecidos:
+                raise CommandError(f'Serviço(s) ativo(s) não encontrado(s): {", ".join(desconhecidos)}')
+            servicos = [por_codigo[codigo] for codigo in options['services']]
+        if not servicos:
+            self.stdout.write(
+                self.style.WARNING('⚠️  Nenhum serviço ativo. Execute: python manage.py init_ecosystem_services')
+            )
+            return
+
+        inicio = time.perf_counter()
+        resultado = monte_carlo(
+            Tree.objects.filter(city=cidade), servicos,
+            amostras=options['amostras'], semente=options['semente'], memoria_mb=options['memoria_mb'],
+            cidade=cidade,
+        )
+        self.stdout.write(f'{options["amostras"]} amostras em {time.perf_counter() - inicio:.1f}s\n')
+
+        for servico in resultado.nao_vetorizaveis:
+            self.stdout.write(self.style.WARNING(f'⚠️  {servico.codigo}: fórmula não vetorizável, ignorado'))
+        for servico in servicos:
+            if not servico.distribuicoes and servico not in resultado.nao_vetorizaveis:
+                self.stdout.write(f'   {servico.codigo}: sem distribuições configuradas (valor pontual)')
+
+        self.stdout.write('')
+        for codigo, resumo in resultado.por_servico().items():
+            self.stdout.write(
+                f'{codigo:<22} p5: {resumo["p5"]:14.2f}   p50: {resumo["p50"]:14.2f}   '
+                f'p95: {resumo["p95"]:14.2f} {resumo["unidade"]}   '
+                f'(R$ {resumo["p5_monetario"]:.2f} – R$ {resumo["p95_monetario"]:.2f})'
+            )
+
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as arquivo:
+                json.dump({
+                    'amostras': options['amostras'],
+                    'semente': options['semente'],
+                    'cidade': resultado.por_servico(),
+                    'por_bairro': resultado.por_bairro(),
+                }, arquivo, ensure_ascii=False)
+            self.stdout.write(self.style.SUCCESS(f'\n✓ Resultado gravado em {options["json"]}'))
+
+        self.stdout.write(self.style.SUCCESS(f'\n✅ Simulação concluída em {time.perf_counter() - inicio:.1f}s'))
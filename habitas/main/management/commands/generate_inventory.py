@@ -0,0 +1,288 @@
+"""
+Comando Django para gerar um inventário sintético de árvores para testes de escala.
+
+As árvores sintéticas reproduzem o inventário real de trees_all.csv: cada
+uma sorteia um registro do CSV (espécie, nome popular, DAP e altura, que
+assim mantêm a mistura de espécies e a correlação entre DAP, altura e
+espécie) e aplica uma variação log-normal ao DAP e à altura. As coordenadas
+são sorteadas em torno das árvores reais (ou uniformemente no retângulo do
+município, com --distribuicao uniforme) e rejeitadas fora do limite da
+cidade (CITY_LIMIT de city.js). Cidade, bairro e quadkey já são gravados
+na inserção.
+
+Posts, laudos e notificações são gerados na proporção indicada por árvore
+(ex.: --posts 0.05 = 5 posts a cada 100 árvores), em árvores sorteadas.
+Tudo é inserido com bulk_create em lotes, sem sinais: ao final a tabela de
+contagens de espécies é reconstruída e a versão do inventário da cidade é
+trocada. Os valores dos serviços ecossistêmicos das árvores novas são
+calculados sob demanda ou com recompute_ecosystem_services.
+
+Uso:
+    python manage.py generate_inventory 100000
+    python manage.py generate_inventory 1000000 --posts 0.02 --laudos 0.005 --notificacoes 0.01
+    python manage.py generate_inventory 50000 --cidade sao-jose-dos-campos --distribuicao uniforme --semente 7
+"""
+
+import math
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from main import cidades, diversidade, geo, grade
+from main.inventario import CSV_INVENTARIO, invalidar_inventario, ler_inventario_csv
+from main.models import CustomUser, Laudo, Notificacao, Post, Species, Tree
+
+DISTRIBUICOES = ('inventario', 'uniforme')
+METROS_POR_GRAU = 111_000.0
+# Desvio padrão do logaritmo da variação aplicada ao DAP e à altura de cada registro sorteado
+VARIACAO_MEDIDAS = 0.15
+# Rodadas de sorteio por lote até todas as coordenadas caírem dentro do município
+TENTATIVAS_COORDENADAS = 50
+AUTORES_POSTS = ('Ana', 'Bruno', 'Carla', 'Diego', 'Elisa', 'Fábio', 'Gabriela', 'Heitor')
+TEXTOS_POSTS = (
+    'Árvore florida nesta semana.',
+    'Galho seco sobre a calçada.',
+    'Muitos pássaros fazendo ninho.',
+    'Raízes levantando o passeio.',
+    'Sombra ótima para o ponto de ônibus.',
+)
+USUARIO_TECNICO = 'sintetico_tecnico'
+USUARIO_CIDADAO = 'sintetico_cidadao'
+
+
+class Command(BaseCommand):
+    help = 'Gera árvores, posts, laudos e notificações sintéticos a partir da distribuição de trees_all.csv'
+
+    def add_arguments(self, parser):
+        parser.add_argument('quantidade', type=int, help='Número de árvores a gerar')
+        parser.add_argument('--cidade', metavar='SLUG', help='Cidade (padrão: settings.CIDADE_PADRAO)')
+        parser.add_argument('--csv', default=str(CSV_INVENTARIO), help='Caminho do inventário (trees_all.csv)')
+        parser.add_argument('--posts', type=float, default=0.05, metavar='RAZAO', help='Posts por árvore')
+        parser.add_argument('--laudos', type=float, default=0.01, metavar='RAZAO', help='Laudos por árvore')
+        parser.add_argument(
+            '--notificacoes', type=float, default=0.02, metavar='RAZAO', help='Notificações por árvore'
+        )
+        parser.add_argument(
+            '--distribuicao', choices=DISTRIBUICOES, default='inventario',
+            help='Coordenadas em torno das árvores reais (inventario) ou uniformes no município'
+        )
+        parser.add_argument(
+            '--dispersao', type=float, default=300.0, metavar='METROS',
+            help='Desvio padrão do deslocamento em torno das árvores reais (padrão: 300 m)'
+        )
+        parser.add_argument(
+            '--plantado-por', default='SINTETICO',
+            help='Valor de plantado_por das árvores geradas (padrão: SINTETICO, para filtrá-las depois)'
+        )
+        parser.add_argument('--lote', type=int, default=50_000, help='Árvores por lote de inserção')
+        parser.add_argument('--semente', type=int, help='Semente do gerador aleatório (resultado reprodutível)')
+
+    def handle(self, *args, **options):
+        """Gera o inventário"""
+        quantidade = options['quantidade']
+        if quantidade < 1:
+            raise CommandError('A quantidade deve ser positiva')
+        if min(options['posts'], options['laudos'], options['notificacoes']) < 0:
+            raise CommandError('As razões de posts, laudos e notificações não podem ser negativas')
+
+        cidade = cidades.cidade_do_comando(options['cidade'])
+        rng = np.random.default_rng(options['semente'])
+        registros = self._registros(options['csv'])
+        self.stdout.write(
+            f'Cidade: {cidade.nome}\nDistribuição: {len(registros)} registros de {options["csv"]}, '
+            f'{len({r["nome_cientifico"] for r in registros})} espécies\n'
+        )
+
+        inicio = time.perf_counter()
+        maior_id = Tree.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        nomes = geo.nomes_bairros(cidade)
+        centros = self._centros(registros, cidade, options)
+        geradas = 0
+        while geradas < quantidade:
+            n = min(options['lote'], quantidade - geradas)
+            with transaction.atomic():
+                Tree.objects.bulk_create(
+                    self._arvores(n, registros, centros, cidade, nomes, rng, options), batch_size=2000
+                )
+            geradas += n
+            self.stdout.write(f'  {geradas}/{quantidade} árvores ({time.perf_counter() - inicio:.1f} s)')
+
+        novas = np.fromiter(
+            Tree.objects.filter(city=cidade, id__gt=maior_id).values_list('id', flat=True), dtype=np.int64
+        )
+        self._relacionados(novas, rng, options)
+
+        linhas = diversidade.reconstruir_contagens()
+        invalidar_inventario(cidade.pk)
+        self.stdout.write(self.style.SUCCESS(
+            f'\n✓ {len(novas)} árvores geradas em {time.perf_counter() - inicio:.1f} s '
+            f'(tabela de contagens reconstruída: {linhas} linhas)'
+        ))
+        self.stdout.write(
+            'Para materializar os serviços ecossistêmicos: python manage.py recompute_ecosystem_services'
+        )
+
+    # ==================== ÁRVORES ====================
+
+    def _registros(self, caminho):
+        """Registros do CSV com a espécie resolvida e medidas válidas
+
+        Nomes científicos com sinônimos ("Morus sp, Morus nigra") usam a
+        espécie do primeiro nome, como no inventário carregado.
+        """
+        especies = {especie.name.lower(): especie.pk for especie in Species.objects.all()}
+
+        def especie(nome):
+            nome = nome.lower()
+            return especies.get(nome, especies.get(nome.split(',')[0].strip()))
+
+        registros = [
+            {**registro, 'species_id': especie(registro['nome_cientifico'])}
+            for registro in ler_inventario_csv(caminho)
+            if registro['dap'] > 0 and registro['altura'] > 0
+        ]
+        if not registros:
+            raise CommandError(f'Nenhum registro válido em {caminho}')
+        return registros
+
+    def _arvores(self, n, registros, centros, cidade, nomes, rng, options):
+        """Um lote de instâncias de Tree (não salvas) com cidade, bairro e quadkey"""
+        escolhidos = rng.integers(len(registros), size=n)
+        variacao = rng.lognormal(0, VARIACAO_MEDIDAS, size=(n, 2))
+        latitude, longitude = self._coordenadas(n, centros, cidade, rng, options)
+        bairros = geo.bairro_dos_pontos(latitude, longitude, cidade)
+        chaves = grade.quadkeys(latitude, longitude)
+        arvores = []
+        for k, i in enumerate(escolhidos.tolist()):
+            registro = registros[i]
+            arvores.append(Tree(
+                N_placa=0,
+                nome_popular=registro['nome_popular'],
+                nome_cientifico=registro['nome_cientifico'],
+                dap=max(1, round(registro['dap'] * variacao[k, 0])),
+                altura=max(0.5, round(registro['altura'] * variacao[k, 1], 1)),
+                latitude=float(latitude[k]),
+                longitude=float(longitude[k]),
+                plantado_por=options['plantado_por'],
+                species_id=registro['species_id'],
+                city=cidade,
+                bairro=nomes[bairros[k]] if bairros[k] >= 0 else diversidade.SEM_BAIRRO_TABELA,
+                quadkey=chaves[k],
+            ))
+        return arvores
+
+    def _centros(self, registros, cidade, options):
+        """Coordenadas das árvores reais dentro do município, em torno das quais as sintéticas são sorteadas"""
+        if options['distribuicao'] != 'inventario':
+            return None
+        lat = np.array([registro['latitude'] for registro in registros])
+        lon = np.array([registro['longitude'] for registro in registros])
+        dentro = geo.dentro_da_cidade(lat, lon, cidade)
+        if not dentro.any():
+            raise CommandError(
+                f'Nenhuma árvore do CSV fica dentro de {cidade.nome}. Use --distribuicao uniforme'
+            )
+        return lat[dentro], lon[dentro]
+
+    def _coordenadas(self, n, centros, cidade, rng, options):
+        """Coordenadas dentro do limite do município, por rejeição"""
+        poligonos = geo.limite_cidade(cidade)
+        if not poligonos:
+            raise CommandError(f'A cidade {cidade.nome} não tem limite em {cidade.arquivo_limite}')
+        lat_min = min(p.lat_min for p in poligonos)
+        lat_max = max(p.lat_max for p in poligonos)
+        lon_min = min(p.lon_min for p in poligonos)
+        lon_max = max(p.lon_max for p in poligonos)
+        desvio = options['dispersao'] / METROS_POR_GRAU
+
+        latitude = np.full(n, np.nan)
+        longitude = np.full(n, np.nan)
+        pendentes = np.arange(n)
+        for _ in range(TENTATIVAS_COORDENADAS):
+            m = len(pendentes)
+            if centros is not None:
+                centro = rng.integers(len(centros[0]), size=m)
+                lat = centros[0][centro] + rng.normal(0, desvio, m)
+                lon = centros[1][centro] + rng.normal(0, desvio / math.cos(math.radians(cidade.latitude)), m)
+            else:
+                lat = rng.uniform(lat_min, lat_max, m)
+                lon = rng.uniform(lon_min, lon_max, m)
+            dentro = geo.dentro_da_cidade(lat, lon, cidade)
+            latitude[pendentes[dentro]] = lat[dentro]
+            longitude[pendentes[dentro]] = lon[dentro]
+            pendentes = pendentes[~dentro]
+            if not len(pendentes):
+                return latitude, longitude
+        raise CommandError(f'Não foi possível sortear coordenadas dentro do limite de {cidade.nome}')
+
+    # ==================== POSTS, LAUDOS E NOTIFICAÇÕES ====================
+
+    def _usuario(self, username, user_type):
+        usuario, criado = CustomUser.objects.get_or_create(
+            username=username,
+            defaults={'user_type': user_type, 'aprovacao_status': CustomUser.ApprovalStatus.APROVADO},
+        )
+        if criado:
+            usuario.set_unusable_password()
+            usuario.save(update_fields=['password'])
+        return usuario
+
+    def _sortear(self, arvores, razao, rng):
+        """Árvores (com repetição) que recebem os registros relacionados, na razão por árvore"""
+        quantidade = int(round(len(arvores) * razao))
+        return rng.choice(arvores, size=quantidade).tolist() if quantidade and len(arvores) else []
+
+    def _relacionados(self, arvores, rng, options):
+        lote = options['lote']
+
+        posts = self._sortear(arvores, options['posts'], rng)
+        for inicio in range(0, len(posts), lote):
+            Post.objects.bulk_create([
+                Post(
+                    tree_id=tree_id,
+                    author=AUTORES_POSTS[rng.integers(len(AUTORES_POSTS))],
+                    content=TEXTOS_POSTS[rng.integers(len(TEXTOS_POSTS))],
+                    specialized=bool(rng.random() < 0.1),
+                )
+                for tree_id in posts[inicio:inicio + lote]
+            ], batch_size=2000)
+
+        laudos = self._sortear(arvores, options['laudos'], rng)
+        if laudos:
+            tecnico = self._usuario(USUARIO_TECNICO, CustomUser.UserType.TECNICO)
+            estados = Laudo.LaudoStatus.values
+            for inicio in range(0, len(laudos), lote):
+                Laudo.objects.bulk_create([
+                    Laudo(
+                        tree_id=tree_id,
+                        autor=tecnico,
+                        titulo=f'Laudo sintético da árvore {tree_id}',
+                        descricao='Laudo gerado para teste de escala.',
+                        arquivo='laudos/sintetico.pdf',
+                        status=estados[rng.integers(len(estados))],
+                    )
+                    for tree_id in laudos[inicio:inicio + lote]
+                ], batch_size=2000)
+
+        notificacoes = self._sortear(arvores, options['notificacoes'], rng)
+        if notificacoes:
+            cidadao = self._usuario(USUARIO_CIDADAO, CustomUser.UserType.CIDADAO)
+            tipos = Notificacao.TipoNotificacao.values
+            estados = Notificacao.StatusNotificacao.values
+            for inicio in range(0, len(notificacoes), lote):
+                Notificacao.objects.bulk_create([
+                    Notificacao(
+                        tree_id=tree_id,
+                        autor=cidadao,
+                        tipo=tipos[rng.integers(len(tipos))],
+                        titulo=f'Notificação sintética da árvore {tree_id}',
+                        descricao='Notificação gerada para teste de escala.',
+                        status=estados[rng.integers(len(estados))],
+                    )
+                    for tree_id in notificacoes[inicio:inicio + lote]
+                ], batch_size=2000)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'✓ {len(posts)} posts, {len(laudos)} laudos e {len(notificacoes)} notificações'
+        ))
@@ -0,0 +1,105 @@
+"""
+Comando Django para projetar o crescimento das árvores e os serviços ecossistêmicos futuros.
+
+DAP e altura do inventário de uma cidade são projetados pelas curvas de crescimento
+das espécies e os serviços ativos são reavaliados em lote para cada ano do
+horizonte (ver main/crescimento.py).
+
+Uso:
+    python manage.py project_growth
+    python manage.py project_growth --anos 30 --agrupar bairro
+    python manage.py project_growth --anos 10 --services co2_armazenado --json projecao.json
+    python manage.py project_growth --cidade sao-jose-dos-campos
+"""
+
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from main import cidades, registry
+from main.crescimento import fluxo_anual, projetar_crescimento
+from main.models import Tree
+
+
+class Command(BaseCommand):
+    help = 'Projeta DAP/altura pelas curvas de crescimento e acumula os serviços por árvore, bairro e plantado_por'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cidade', metavar='SLUG', help='Cidade (padrão: settings.CIDADE_PADRAO)')
+        parser.add_argument('--anos', type=int, default=30, help='Horizonte da projeção em anos (padrão: 30)')
+        parser.add_argument(
+            '--services', nargs='+', metavar='CODIGO',
+            help='Códigos dos serviços a projetar (padrão: todos os ativos)'
+        )
+        parser.add_argument(
+            '--agrupar', choices=['bairro', 'plantado_por'], default='plantado_por',
+            help='Agrupamento exibido no terminal (o JSON inclui ambos)'
+        )
+        parser.add_argument('--json', metavar='ARQUIVO', help='Grava o resultado completo (inclusive por árvore) em JSON')
+
+    def handle(self, *args, **options):
+        """Executa a projeção"""
+        if options['anos'] <= 0:
+            raise CommandError('--anos deve ser positivo')
+
+        cidade = cidades.cidade_do_comando(options['cidade'])
+        servicos = registry.servicos_ativos()
+        if options['services']:
+            por_codigo = {servico.codigo: servico for servico in servicos}
+            desconhecidos = sorted(set(options['services']) - set(por_codigo))
+            if desconhecidos:
+                raise CommandError(f'Serviço(s) ativo(s) não encontrado(s): {", ".join(desconhecidos)}')
+            servicos = [por_codigo[codigo] for codigo in options['services']]
+        if not servicos:
+            self.stdout.write(
+                self.style.WARNING('⚠️  Nenhum serviço ativo. Execute: python manage.py init_ecosystem_services')
+            )
+            return
+
+        inicio = time.perf_counter()
+        resultado = projetar_crescimento(
+            Tree.objects.filter(city=cidade), servicos, anos=options['anos'], cidade=cidade
+        )
+        tempo = time.perf_counter() - inicio
+
+        self.stdout.write(
+            f'Projeção de {len(resultado.ids)} árvores por {options["anos"]} anos em {tempo:.1f}s\n'
+        )
+        for servico in resultado.nao_vetorizaveis:
+            self.stdout.write(self.style.WARNING(f'⚠️  {servico.codigo}: fórmula não vetorizável, ignorado'))
+
+        projetados = [servico for servico in servicos if servico.codigo in resultado.acumulado]
+        for servico in projetados:
+            totais = resultado.totais_por_ano[servico.codigo]
+            acumulado = resultado.acumulado[servico.codigo].sum()
+            if fluxo_anual(servico):
+                tipo, unidade = 'soma anual', servico.unidade_medida.strip()[:-len('/ano')]
+            else:
+                tipo, unidade = 'ganho de estoque', servico.unidade_medida
+            self.stdout.write(
+                f'{servico.codigo:<22} ano 0: {totais[0]:14.2f}   ano {options["anos"]}: {totais[-1]:14.2f}   '
+                f'acumulado ({tipo}): {acumulado:14.2f} {unidade}'
+            )
+
+        grupos = resultado.por_bairro() if options['agrupar'] == 'bairro' else resultado.por_plantado_por()
+        self.stdout.write(f'\nAcumulado por {options["agrupar"]}:')
+        primeiro = projetados[0].codigo if projetados else None
+        for grupo, valores in sorted(grupos.items(), key=lambda item: -item[1].get(primeiro, 0)):
+            detalhes = '   '.join(f'{codigo}: {valor:.2f}' for codigo, valor in valores.items())
+            self.stdout.write(f'  {grupo:<30} {detalhes}')
+
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as arquivo:
+                json.dump({
+                    'anos': options['anos'],
+                    'totais_por_ano': {
+                        codigo: [round(valor, 4) for valor in totais.tolist()]
+                        for codigo, totais in resultado.totais_por_ano.items()
+                    },
+                    'por_bairro': resultado.por_bairro(),
+                    'por_plantado_por': resultado.por_plantado_por(),
+                    'por_arvore': resultado.por_arvore(),
+                }, arquivo, ensure_ascii=False)
+            self.stdout.write(self.style.SUCCESS(f'\n✓ Resultado gravado em {options["json"]}'))
+
+        self.stdout.write(self.style.SUCCESS(f'\n✅ Projeção concluída em {time.perf_counter() - inicio:.1f}s'))
@@ -0,0 +1,139 @@
+"""
+Comando Django para recalcular os valores materializados dos serviços ecossistêmicos.
+
+O inventário é dividido em faixas de chave primária e cada faixa é avaliada
+em lote (numpy) em um pool de processos. O processo principal sonda antes as
+fórmulas (ver main/guarda.py) e grava os resultados na tabela
+EcosystemServiceValue com bulk upsert.
+
+Uso:
+    python manage.py recompute_ecosystem_services
+    python manage.py recompute_ecosystem_services --services co2_armazenado chuva_interceptada
+    python manage.py recompute_ecosystem_services --chunk-size 20000 --workers 4
+"""
+
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from main import guarda
+from main.batch import DadosLote, calcular_lote
+from main.materializacao import salvar_valores
+from main.models import EcosystemServiceConfig, EcosystemServiceValue, Tree
+
+
+def _inicializar_worker():
+    """Prepara o Django no worker (necessário quando o pool usa spawn, ex.: Windows)"""
+    import django
+
+    django.setup()
+    connections.close_all()
+
+
+def _calcular_faixa(args):
+    """Avalia os serviços para as árvores com pk entre pk_inicio e pk_fim (executa no worker)"""
+    pk_inicio, pk_fim, servicos = args
+    dados = DadosLote.para_servicos(Tree.objects.filter(id__gte=pk_inicio, id__lte=pk_fim), servicos)
+    valores = {servico.pk: calcular_lote(servico, dados) for servico in servicos}
+    return pk_inicio, pk_fim, dados.ids, valores
+
+
+class Command(BaseCommand):
+    help = 'Recalcula em paralelo os serviços ecossistêmicos ativos para todo o inventário'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--services', nargs='+', metavar='CODIGO',
+            help='Códigos dos serviços a recalcular (padrão: todos os ativos)'
+        )
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Árvores por faixa de pk')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Processos no pool (padrão: número de CPUs)'
+        )
+
+    def handle(self, *args, **options):
+        """Executa o recálculo"""
+        if options['chunk_size'] <= 0 or options['workers'] <= 0:
+            raise CommandError('--chunk-size e --workers devem ser positivos')
+
+        servicos = self._selecionar_servicos(options['services'])
+        if not servicos:
+            self.stdout.write(
+                self.style.WARNING('⚠️  Nenhum serviço ativo. Execute: python manage.py init_ecosystem_services')
+            )
+            return
+
+        # Os workers do pool não podem criar o processo da sonda: cada versão é sondada aqui
+        for codigo, motivo in guarda.sondar_servicos(servicos).items():
+            self.stdout.write(self.style.WARNING(f'⚠️  {codigo} degradado (valor 0): {motivo}'))
+
+        faixas = self._faixas(options['chunk_size'])
+        total_arvores = sum(quantidade for _, _, quantidade in faixas)
+        self.stdout.write(
+            f'Recalculando {len(servicos)} serviço(s) para {total_arvores} árvores '
+            f'em {len(faixas)} faixa(s) com {options["workers"]} worker(s)'
+        )
+
+        inicio = time.perf_counter()
+        tarefas = [(pk_inicio, pk_fim, servicos) for pk_inicio, pk_fim, _ in faixas]
+        processadas = 0
+        for n, (pk_inicio, pk_fim, ids, valores) in enumerate(self._executar(tarefas, options['workers']), 1):
+            with transaction.atomic():
+                for servico in servicos:
+                    salvar_valores(servico, ids, valores[servico.pk])
+            processadas += len(ids)
+            self.stdout.write(
+                f'  [{n}/{len(faixas)}] pk {pk_inicio}–{pk_fim}: {processadas}/{total_arvores} árvores '
+                f'({time.perf_counter() - inicio:.1f}s)'
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'\n✅ {processadas} árvores × {len(servicos)} serviço(s) recalculados '
+                f'em {time.perf_counter() - inicio:.1f}s'
+            )
+        )
+
+    def _selecionar_servicos(self, codigos):
+        """Retorna os serviços ativos a recalcular; serviços inativos têm os valores removidos"""
+        if not codigos:
+            return list(EcosystemServiceConfig.objects.filter(ativo=True).order_by('ordem_exibicao'))
+
+        encontrados = {s.codigo: s for s in EcosystemServiceConfig.objects.filter(codigo__in=codigos)}
+        desconhecidos = sorted(set(codigos) - set(encontrados))
+        if desconhecidos:
+            raise CommandError(f'Serviço(s) não encontrado(s): {", ".join(desconhecidos)}')
+
+        servicos = []
+        for codigo in codigos:
+            servico = encontrados[codigo]
+            if servico.ativo:
+                servicos.append(servico)
+            else:
+                EcosystemServiceValue.objects.filter(servico=servico).delete()
+                self.stdout.write(
+                    self.style.WARNING(f'↻ {codigo} está inativo: valores materializados removidos')
+                )
+        return servicos
+
+    def _faixas(self, tamanho):
+        """Divide o inventário em faixas contíguas de pk com até `tamanho` árvores"""
+        ids = list(Tree.objects.order_by('id').values_list('id', flat=True))
+        return [
+            (ids[i], ids[min(i + tamanho, len(ids)) - 1], len(ids[i:i + tamanho]))
+            for i in range(0, len(ids), tamanho)
+        ]
+
+    def _executar(self, tarefas, workers):
+        """Gera os resultados das faixas à medida que ficam prontos"""
+        if workers == 1 or len(tarefas) <= 1:
+            yield from map(_calcular_faixa, tarefas)
+            return
+
+        # Cada worker abre a própria conexão; conexões herdadas no fork não podem ser reutilizadas
+        connections.close_all()
+        with multiprocessing.Pool(processes=min(workers, len(tarefas)), initializer=_inicializar_worker) as pool:
+            yield from pool.imap_unordered(_calcular_faixa, tarefas)
@@ -0,0 +1,75 @@
+"""
+Comando Django para desenhar de antemão os ladrilhos PNG da camada de árvores do mapa.
+
+Desenha, na versão atual do inventário da cidade e sem filtros, os
+ladrilhos dos níveis de zoom informados (padrão: 12 a 16) que contêm
+árvores, obtidos pelos prefixos distintos de Tree.quadkey; os demais
+(vazios ou só com a borda de marcadores vizinhos) são desenhados sob
+demanda por /tiles/trees/<z>/<x>/<y>.png. Ao final remove do disco os
+ladrilhos das versões anteriores da cidade.
+
+Uso:
+    python manage.py seed_map_tiles
+    python manage.py seed_map_tiles --cidade sao-jose-dos-campos --zoom-min 10 --zoom-max 17
+    python manage.py seed_map_tiles --forcar
+"""
+
+import shutil
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.functions import Substr
+from main import cidades, grade, ladrilhos
+from main.models import Tree
+
+
+class Command(BaseCommand):
+    help = 'Desenha em disco os ladrilhos PNG da camada de árvores dos níveis de zoom informados'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cidade', metavar='SLUG', help='Cidade (padrão: settings.CIDADE_PADRAO)')
+        parser.add_argument('--zoom-min', type=int, default=12, help='Menor nível de zoom (padrão: 12)')
+        parser.add_argument('--zoom-max', type=int, default=16, help='Maior nível de zoom (padrão: 16)')
+        parser.add_argument(
+            '--forcar', action='store_true', help='Redesenha também os ladrilhos já gravados na versão atual'
+        )
+
+    def handle(self, *args, **options):
+        zoom_min, zoom_max = options['zoom_min'], options['zoom_max']
+        if not 0 <= zoom_min <= zoom_max <= ladrilhos.ZOOM_MAXIMO:
+            raise CommandError(f'Use 0 <= --zoom-min <= --zoom-max <= {ladrilhos.ZOOM_MAXIMO}')
+        cidade = cidades.cidade_do_comando(options['cidade'])
+        filtros = {'city': cidade}
+
+        pendentes = grade.preencher_quadkeys(Tree.objects.filter(city=cidade))
+        if pendentes:
+            self.stdout.write(f'Quadkey calculado para {pendentes} árvores')
+        # Uma única versão em todo o comando, ainda que a do cache expire no meio
+        versao = ladrilhos.versao_ladrilhos(cidade)
+        if options['forcar']:
+            shutil.rmtree(ladrilhos.diretorio() / str(cidade.pk) / versao, ignore_errors=True)
+        self.stdout.write(f'Cidade: {cidade.nome}\nVersão: {versao}')
+
+        total = 0
+        for z in range(zoom_min, zoom_max + 1):
+            inicio = time.perf_counter()
+            prefixos = (
+                Tree.objects.filter(city=cidade)
+                .annotate(prefixo=Substr('quadkey', 1, z))
+                .values_list('prefixo', flat=True).distinct()
+            ) if z else ['']
+            desenhados = 0
+            for prefixo in prefixos:
+                x, y = grade.ladrilho(prefixo)
+                if not ladrilhos.caminho(filtros, z, x, y, versao).exists():
+                    ladrilhos.ladrilho(filtros, z, x, y, versao)
+                    desenhados += 1
+            total += desenhados
+            self.stdout.write(self.style.SUCCESS(
+                f'  ✓ zoom {z}: {desenhados} ladrilhos desenhados ({time.perf_counter() - inicio:.1f} s)'
+            ))
+
+        removidas = ladrilhos.remover_versoes_antigas(cidade)
+        if removidas:
+            self.stdout.write(f'{removidas} versões antigas removidas de {ladrilhos.diretorio()}')
+        self.stdout.write(self.style.SUCCESS(f'✅ {total} ladrilhos desenhados em {ladrilhos.diretorio()}'))
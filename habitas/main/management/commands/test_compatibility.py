@@ -1,120 +1,216 @@
 """
-Comando Django para testar compatibilidade entre cálculos antigos e novos.
+Comando Django para verificar a compatibilidade entre cálculos antigos e novos
+em todo o inventário.
+
+Para cada árvore, os valores das propriedades antigas (@property de Tree:
+stored_co2, stormwater_intercepted, conserved_energy, biodiversity) são
+comparados com as fórmulas configuradas no banco, avaliadas em lote
+(vetorizadas). O relatório traz, por serviço, o número de divergências, a
+maior diferença, a distribuição das diferenças e as piores árvores. O
+comando termina com código de saída diferente de zero quando há divergências,
+para uso em CI após migrações de fórmulas.
 
 Uso:
     python manage.py test_compatibility
+    python manage.py test_compatibility --services co2_armazenado --piores 20
+    python manage.py test_compatibility --por-arvore --tolerancia 1e-3 --json relatorio.json
 """
 
-from django.core.management.base import BaseCommand
-from main.models import Tree, EcosystemServiceConfig
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from main import registry
+from main.batch import DadosLote, calcular_lote
+from main.models import Tree
+
+# Serviço configurado -> propriedade antiga de Tree
+PROPRIEDADES_ANTIGAS = {
+    'co2_armazenado': 'stored_co2',
+    'chuva_interceptada': 'stormwater_intercepted',
+    'energia_conservada': 'conserved_energy',
+    'biodiversidade': 'biodiversity',
+}
+# Limites superiores das faixas de |diferença| exibidas na distribuição
+FAIXAS = (0.0, 1e-6, 1e-4, 1e-2, 1.0, float('inf'))
+TAMANHO_BLOCO = 5000
+
+
+def _valor_antigo(tree, propriedade):
+    """Valor da propriedade antiga (NaN se ela falhar, ex.: DAP vazio)"""
+    try:
+        return float(getattr(tree, propriedade))
+    except (TypeError, ValueError, ZeroDivisionError, OverflowError):
+        return float('nan')
+
+
+def _rotulo_faixa(i):
+    if i == 0:
+        return '= 0'
+    if FAIXAS[i] == float('inf'):
+        return f'> {FAIXAS[i - 1]:g}'
+    return f'≤ {FAIXAS[i]:g}'
+
+
+class Comparacao:
+    """Diferenças acumuladas de um serviço ao longo dos blocos"""
+
+    def __init__(self, servico):
+        self.servico = servico
+        self.ids = []
+        self.antigos = []
+        self.novos = []
+
+    def adicionar(self, ids, antigos, novos):
+        self.ids.append(ids)
+        self.antigos.append(antigos)
+        self.novos.append(novos)
+
+    def resumo(self, tolerancia, relativa, piores):
+        ids = np.concatenate(self.ids) if self.ids else np.zeros(0, dtype=np.int64)
+        antigos = np.concatenate(self.antigos) if self.antigos else np.zeros(0)
+        novos = np.concatenate(self.novos) if self.novos else np.zeros(0)
+
+        falhas_antigas = np.isnan(antigos)
+        diferenca = np.abs(np.where(falhas_antigas, 0.0, antigos) - novos)
+        divergentes = (diferenca > tolerancia + relativa * np.abs(np.nan_to_num(antigos))) & ~falhas_antigas
+
+        faixas = np.searchsorted(np.array(FAIXAS), diferenca[~falhas_antigas], side='left')
+        contagens = np.bincount(faixas, minlength=len(FAIXAS))
+        ordem = np.argsort(-np.where(falhas_antigas, -1.0, diferenca), kind='stable')[:piores]
+
+        return {
+            'servico': self.servico.codigo,
+            'arvores': int(len(ids)),
+            'divergencias': int(divergentes.sum()),
+            'falhas_antigas': int(falhas_antigas.sum()),
+            'diferenca_maxima': float(diferenca[~falhas_antigas].max()) if (~falhas_antigas).any() else 0.0,
+            'diferenca_media': float(diferenca[~falhas_antigas].mean()) if (~falhas_antigas).any() else 0.0,
+            'distribuicao': {_rotulo_faixa(i): int(contagem) for i, contagem in enumerate(contagens)},
+            'piores': [
+                {
+                    'tree_id': int(ids[i]),
+                    'antigo': float(antigos[i]),
+                    'novo': float(novos[i]),
+                    'diferenca': float(diferenca[i]),
+                }
+                for i in ordem if divergentes[i]
+            ],
+        }
 
 
 class Command(BaseCommand):
-    help = 'Testa compatibilidade entre métodos antigos (@property) e novos (BD dinâmico)'
+    help = 'Compara os métodos antigos (@property) com as fórmulas do BD em todas as árvores'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--services', nargs='+', metavar='CODIGO', choices=sorted(PROPRIEDADES_ANTIGAS),
+            help='Serviços a verificar (padrão: todos com propriedade antiga)'
+        )
+        parser.add_argument('--tolerancia', type=float, default=1e-4, help='Diferença absoluta aceita (padrão: 1e-4)')
+        parser.add_argument('--relativa', type=float, default=1e-9, help='Diferença relativa aceita (padrão: 1e-9)')
+        parser.add_argument('--piores', type=int, default=10, help='Árvores divergentes listadas por serviço (padrão: 10)')
+        parser.add_argument(
+            '--bloco', type=int, default=TAMANHO_BLOCO,
+            help=f'Árvores carregadas por bloco (padrão: {TAMANHO_BLOCO})'
+        )
+        parser.add_argument(
+            '--por-arvore', action='store_true',
+            help='Avalia as fórmulas novas árvore a árvore (EcosystemServiceConfig.calcular) em vez do lote'
+        )
+        parser.add_argument('--json', metavar='ARQUIVO', help='Grava o relatório completo em JSON')
 
     def handle(self, *args, **options):
-        """Executa o teste de compatibilidade"""
-        
-        # Pega uma árvore qualquer
-        tree = Tree.objects.first()
-        if not tree:
-            self.stdout.write(
-                self.style.ERROR('❌ Nenhuma árvore encontrada para teste')
+        """Executa a verificação"""
+        codigos = options['services'] or list(PROPRIEDADES_ANTIGAS)
+        servicos = []
+        for codigo in codigos:
+            servico = registry.servico_ativo(codigo)
+            if servico is None:
+                self.stdout.write(self.style.WARNING(f'⚠️  {codigo}: serviço não configurado ou inativo, ignorado'))
+            else:
+                servicos.append(servico)
+        if not servicos:
+            raise CommandError(
+                'Nenhum serviço configurado para comparar. Execute: python manage.py init_ecosystem_services'
             )
-            return
-        
-        self.stdout.write(f'Testando com árvore ID {tree.id}: {tree.nome_popular}')
-        
-        # Verifica se os serviços existem
-        if not EcosystemServiceConfig.objects.exists():
-            self.stdout.write(
-                self.style.WARNING('⚠️  Nenhum serviço configurado. Execute: python manage.py init_ecosystem_services')
+
+        total = Tree.objects.count()
+        if total == 0:
+            raise CommandError('Nenhuma árvore encontrada para teste')
+
+        modo = 'árvore a árvore' if options['por_arvore'] else 'em lote'
+        self.stdout.write(f'Verificando {total} árvores, {len(servicos)} serviço(s), fórmulas novas {modo}...\n')
+
+        inicio = time.perf_counter()
+        comparacoes = {servico.codigo: Comparacao(servico) for servico in servicos}
+        arvores = Tree.objects.select_related('species').order_by('id')
+        bloco = []
+        for tree in arvores.iterator(chunk_size=options['bloco']):
+            bloco.append(tree)
+            if len(bloco) >= options['bloco']:
+                self._comparar_bloco(bloco, servicos, comparacoes, options['por_arvore'])
+                bloco = []
+        if bloco:
+            self._comparar_bloco(bloco, servicos, comparacoes, options['por_arvore'])
+
+        resumos = [
+            comparacoes[servico.codigo].resumo(options['tolerancia'], options['relativa'], options['piores'])
+            for servico in servicos
+        ]
+        for resumo in resumos:
+            self._exibir(resumo)
+
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as arquivo:
+                json.dump({
+                    'tolerancia': options['tolerancia'],
+                    'relativa': options['relativa'],
+                    'modo': 'arvore' if options['por_arvore'] else 'lote',
+                    'servicos': resumos,
+                }, arquivo, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'\n✓ Relatório gravado em {options["json"]}'))
+
+        tempo = time.perf_counter() - inicio
+        divergencias = sum(resumo['divergencias'] for resumo in resumos)
+        if divergencias:
+            raise CommandError(
+                f'{divergencias} divergência(s) de compatibilidade em {len(resumos)} serviço(s) ({tempo:.1f}s)'
             )
-            return
-        
-        # Valores antigos (métodos diretos)
-        co2_antigo = tree.stored_co2
-        chuva_antiga = tree.stormwater_intercepted
-        energia_antiga = tree.conserved_energy
-        bio_antiga = tree.biodiversity
-        
-        # Valores novos (via BD)
-        try:
-            co2_novo = tree.get_ecosystem_service_value('co2_armazenado')
-        except Exception as e:
-            co2_novo = None
-            self.stdout.write(self.style.WARNING(f'Erro ao calcular CO₂: {e}'))
-        
-        try:
-            chuva_nova = tree.get_ecosystem_service_value('chuva_interceptada')
-        except Exception as e:
-            chuva_nova = None
-            self.stdout.write(self.style.WARNING(f'Erro ao calcular chuva: {e}'))
-        
-        try:
-            energia_nova = tree.get_ecosystem_service_value('energia_conservada')
-        except Exception as e:
-            energia_nova = None
-            self.stdout.write(self.style.WARNING(f'Erro ao calcular energia: {e}'))
-        
-        try:
-            bio_nova = tree.get_ecosystem_service_value('biodiversidade')
-        except Exception as e:
-            bio_nova = None
-            self.stdout.write(self.style.WARNING(f'Erro ao calcular biodiversidade: {e}'))
-        
-        # Compara
-        tolerancia = 0.0001
-        erros = []
-        
-        if co2_novo is not None:
-            if abs(co2_antigo - co2_novo) > tolerancia:
-                erros.append(f"CO₂: {co2_antigo} vs {co2_novo} (diferença: {abs(co2_antigo - co2_novo)})")
-            else:
-                self.stdout.write(
-                    self.style.SUCCESS(f'✓ CO₂: {co2_antigo} = {co2_novo}')
-                )
-        else:
-            erros.append("CO₂: Não foi possível calcular valor novo")
-        
-        if chuva_nova is not None:
-            if abs(chuva_antiga - chuva_nova) > tolerancia:
-                erros.append(f"Chuva: {chuva_antiga} vs {chuva_nova} (diferença: {abs(chuva_antiga - chuva_nova)})")
-            else:
-                self.stdout.write(
-                    self.style.SUCCESS(f'✓ Chuva: {chuva_antiga} = {chuva_nova}')
-                )
-        else:
-            erros.append("Chuva: Não foi possível calcular valor novo")
-        
-        if energia_nova is not None:
-            if abs(energia_antiga - energia_nova) > tolerancia:
-                erros.append(f"Energia: {energia_antiga} vs {energia_nova} (diferença: {abs(energia_antiga - energia_nova)})")
-            else:
-                self.stdout.write(
-                    self.style.SUCCESS(f'✓ Energia: {energia_antiga} = {energia_nova}')
-                )
-        else:
-            erros.append("Energia: Não foi possível calcular valor novo")
-        
-        if bio_nova is not None:
-            if abs(bio_antiga - bio_nova) > tolerancia:
-                erros.append(f"Biodiversidade: {bio_antiga} vs {bio_nova} (diferença: {abs(bio_antiga - bio_nova)})")
+        self.stdout.write(
+            self.style.SUCCESS(f'\n✅ Compatibilidade verificada em {total} árvores! ({tempo:.1f}s)')
+        )
+
+    def _comparar_bloco(self, bloco, servicos, comparacoes, por_arvore):
+        """Avalia um bloco de árvores pelos dois caminhos e guarda as diferenças"""
+        ids = np.array([tree.id for tree in bloco], dtype=np.int64)
+        dados = None if por_arvore else DadosLote.para_servicos(bloco, servicos)
+        for servico in servicos:
+            propriedade = PROPRIEDADES_ANTIGAS[servico.codigo]
+            antigos = np.array([_valor_antigo(tree, propriedade) for tree in bloco])
+            if por_arvore:
+                novos = np.array([servico.calcular(tree) for tree in bloco], dtype=float)
             else:
-                self.stdout.write(
-                    self.style.SUCCESS(f'✓ Biodiversidade: {bio_antiga} = {bio_nova}')
-                )
-        else:
-            erros.append("Biodiversidade: Não foi possível calcular valor novo")
-        
-        if erros:
-            self.stdout.write(
-                self.style.ERROR('\n❌ ERROS DE COMPATIBILIDADE:')
-            )
-            for erro in erros:
-                self.stdout.write(self.style.ERROR(f'  - {erro}'))
-        else:
+                novos = calcular_lote(servico, dados)
+            comparacoes[servico.codigo].adicionar(ids, antigos, novos)
+
+    def _exibir(self, resumo):
+        """Relatório de um serviço no terminal"""
+        estilo = self.style.ERROR if resumo['divergencias'] else self.style.SUCCESS
+        marcador = '❌' if resumo['divergencias'] else '✓'
+        self.stdout.write(estilo(
+            f'{marcador} {resumo["servico"]}: {resumo["divergencias"]} divergência(s) em {resumo["arvores"]} árvores'
+            f' (diferença máxima {resumo["diferenca_maxima"]:.6g}, média {resumo["diferenca_media"]:.6g})'
+        ))
+        if resumo['falhas_antigas']:
+            self.stdout.write(self.style.WARNING(
+                f'  ⚠️  {resumo["falhas_antigas"]} árvore(s) sem valor antigo (propriedade falhou), não comparadas'
+            ))
+        distribuicao = '   '.join(f'{faixa}: {contagem}' for faixa, contagem in resumo['distribuicao'].items())
+        self.stdout.write(f'  |diferença|  {distribuicao}')
+        for pior in resumo['piores']:
             self.stdout.write(
-                self.style.SUCCESS('\n✅ Compatibilidade verificada! Valores idênticos.')
+                f'  árvore {pior["tree_id"]:>8}   antigo: {pior["antigo"]:14.6f}   novo: {pior["novo"]:14.6f}'
+                f'   diferença: {pior["diferenca"]:.6g}'
             )
-
@@ -0,0 +1,476 @@
+"""
+Dados das árvores para o mapa (index.html).
+
+O HTML do mapa não traz mais as árvores: depois de carregar a página o mapa
+busca /api/trees/ com os mesmos filtros. As árvores são lidas em blocos por
+chave primária (paginação por chave, sem OFFSET) e cada bloco é serializado
+e enviado assim que fica pronto (StreamingHttpResponse), de modo que a
+memória do servidor depende do tamanho do bloco e não do inventário. Os
+serviços de cada bloco vêm da tabela materializada
+(materializacao.valores_materializados).
+
+Para desenhar os marcadores o mapa usa /api/trees/pontos/, um formato
+colunar binário (little-endian) bem menor que o JSON:
+
+    uint32  versão do formato (VERSAO_PONTOS)
+    uint32  tamanho em bytes dos metadados
+    bytes   metadados em JSON (UTF-8): n, limites de latitude e longitude,
+            dicionário de espécies (nomes científicos), códigos dos
+            serviços e a lista de colunas [nome, tipo] na ordem em que
+            seguem
+    colunas uma após a outra, n valores cada
+
+Latitude e longitude são quantizadas em uint16 dentro do retângulo das
+árvores (~0,5 m em uma cidade), a espécie é o índice no dicionário e cada
+serviço ativo é uma coluna float32 com o valor físico. Com `bbox` vêm só as
+árvores do retângulo; o mapa busca os da área visível para colorir os
+marcadores das árvores isoladas.
+
+Os detalhes de uma árvore (serviços, imagens, laudos, posts) são buscados
+ao clicar no marcador, em /api/trees/<id>/, e guardados no cache do Django
+por árvore e versão das configurações de serviços; os sinais de Tree, Post
+e Laudo descartam o detalhe da árvore alterada.
+
+As estatísticas do painel (árvores, espécies, comentários e serviços
+somados da seleção ou do bairro clicado) são agregados calculados no
+servidor, em /api/trees/estatisticas/; o mapa só busca os pontos da área
+visível.
+
+Em zoom de cidade o mapa desenha agrupamentos em vez das árvores:
+/api/trees/agrupamentos/ soma as árvores da seleção por célula da grade
+multirresolução (prefixo do quadkey, ver grade.py) do zoom, com contagem,
+centroide, espécie dominante e serviços somados, e nunca devolve mais que
+MAXIMO_CELULAS células.
+"""
+import hashlib
+import json
+import struct
+from functools import reduce
+from operator import or_
+
+import numpy as np
+from django.core.cache import cache
+from django.db.models import Count, F, Min, Q, Sum
+from django.db.models.functions import Substr, Trim
+
+from . import grade, registry
+from .inventario import versao_inventario
+from .materializacao import materializar_pendentes, matriz_valores, valores_materializados
+from .models import EcosystemServiceValue, Laudo, Post, Tree
+
+CAMPOS_MAPA = (
+    'id', 'N_placa', 'nome_popular', 'nome_cientifico', 'dap', 'altura', 'latitude', 'longitude',
+    'plantado_por', 'laudo', 'imagem',
+)
+TAMANHO_BLOCO = 2000
+
+
+def blocos_arvores(queryset, servicos, apos=None, limite=None, tamanho_bloco=TAMANHO_BLOCO):
+    """Gera listas de dicts (CAMPOS_MAPA, n_posts e services) em ordem de id, a partir do id `apos`"""
+    ultimo = apos
+    restantes = limite
+    while restantes is None or restantes > 0:
+        pagina = queryset if ultimo is None else queryset.filter(id__gt=ultimo)
+        tamanho = tamanho_bloco if restantes is None else min(tamanho_bloco, restantes)
+        arvores = list(pagina.order_by('id').values(*CAMPOS_MAPA)[:tamanho])
+        if not arvores:
+            return
+        primeiro, ultimo = arvores[0]['id'], arvores[-1]['id']
+        # Posts contados por faixa de id: árvores fora do filtro na faixa são simplesmente ignoradas
+        n_posts = dict(
+            Post.objects.filter(tree_id__gte=primeiro, tree_id__lte=ultimo)
+            .values('tree_id').annotate(n=Count('id')).order_by().values_list('tree_id', 'n')
+        )
+        servicos_por_arvore = valores_materializados(queryset.filter(id__gte=primeiro, id__lte=ultimo), servicos)
+        for arvore in arvores:
+            arvore['n_posts'] = n_posts.get(arvore['id'], 0)
+            arvore['services'] = servicos_por_arvore.get(arvore['id'], {})
+        yield arvores
+        if restantes is not None:
+            restantes -= len(arvores)
+
+
+def json_arvores(queryset, servicos, apos=None, limite=None):
+    """Partes (bytes) do JSON {"arvores": [...], "proximo": id da última árvore ou null}
+
+    `proximo` só é preenchido quando a página foi limitada por `limite` e
+    ainda há árvores depois dela.
+    """
+    yield b'{"arvores":['
+    separador = b''
+    ultimo = None
+    enviadas = 0
+    for arvores in blocos_arvores(queryset, servicos, apos, limite):
+        yield separador + ','.join(json.dumps(arvore, ensure_ascii=False) for arvore in arvores).encode()
+        separador = b','
+        ultimo = arvores[-1]['id']
+        enviadas += len(arvores)
+    proximo = None
+    if limite is not None and enviadas == limite and queryset.filter(id__gt=ultimo).exists():
+        proximo = ultimo
+    yield f'],"proximo":{json.dumps(proximo)}}}'.encode()
+
+
+# ==================== FORMATO COLUNAR ====================
+
+VERSAO_PONTOS = 2
+MAXIMO_UINT16 = np.iinfo(np.uint16).max
+TIPOS_COLUNAS = {'<u2': 'uint16', '<u4': 'uint32', '<f4': 'float32'}
+
+
+def _quantizar(valores, minimo, maximo):
+    extensao = maximo - minimo
+    if extensao <= 0:
+        return np.zeros(len(valores), dtype='<u2')
+    return np.round((valores - minimo) / extensao * MAXIMO_UINT16).astype('<u2')
+
+
+def _uint16(valores):
+    return np.clip(np.round(valores), 0, MAXIMO_UINT16).astype('<u2')
+
+
+def pontos_colunares(queryset, servicos):
+    """Payload binário dos marcadores do mapa (formato descrito no início do módulo)"""
+    servicos = list(servicos)
+    especies = {}
+    ids, coordenadas, indices_especie = [], [], []
+    linhas = queryset.order_by('id').values_list(
+        'id', 'latitude', 'longitude', 'nome_cientifico'
+    ).iterator(chunk_size=TAMANHO_BLOCO)
+    for tree_id, latitude, longitude, nome_cientifico in linhas:
+        ids.append(tree_id)
+        coordenadas.append((latitude, longitude))
+        indices_especie.append(especies.setdefault(nome_cientifico.strip(), len(especies)))
+    ids = np.array(ids, dtype=np.int64)
+    latitude, longitude = np.array(coordenadas, dtype=float).reshape(-1, 2).T
+
+    n_posts = np.zeros(len(ids))
+    contagens = np.array(list(
+        Post.objects.filter(tree__in=queryset.values('id'))
+        .values('tree_id').annotate(n=Count('id')).order_by().values_list('tree_id', 'n')
+    ), dtype=np.int64).reshape(-1, 2)
+    n_posts[np.searchsorted(ids, contagens[:, 0])] = contagens[:, 1]
+
+    limites = {
+        'lat_min': float(latitude.min()) if len(ids) else 0.0,
+        'lat_max': float(latitude.max()) if len(ids) else 0.0,
+        'lon_min': float(longitude.min()) if len(ids) else 0.0,
+        'lon_max': float(longitude.max()) if len(ids) else 0.0,
+    }
+    colunas = [
+        ('id', ids.astype('<u4')),
+        ('lat', _quantizar(latitude, limites['lat_min'], limites['lat_max'])),
+        ('lon', _quantizar(longitude, limites['lon_min'], limites['lon_max'])),
+        ('especie', np.array(indices_especie, dtype='<u2')),
+        ('n_posts', _uint16(n_posts)),
+    ]
+    valores = matriz_valores(queryset, servicos, ids)
+    for j, servico in enumerate(servicos):
+        colunas.append((servico.codigo, valores[:, j].astype('<f4')))
+
+    metadados = json.dumps({
+        'n': len(ids),
+        **limites,
+        'especies': list(especies),
+        'servicos': [servico.codigo for servico in servicos],
+        'colunas': [[nome, TIPOS_COLUNAS[coluna.dtype.str]] for nome, coluna in colunas],
+    }, ensure_ascii=False).encode()
+    return b''.join([struct.pack('<II', VERSAO_PONTOS, len(metadados)), metadados]
+                    + [coluna.tobytes() for _, coluna in colunas])
+
+
+# ==================== DETALHE DE UMA ÁRVORE ====================
+
+CHAVE_DETALHE = 'mapa:arvore:{}:{}'
+# Limita a vida de entradas de versões antigas das configurações, que não são mais lidas
+TEMPO_CACHE_DETALHE = 24 * 3600
+# Cache-Control padrão da resposta (s); depois disso o navegador revalida com o ETag
+MAX_AGE_DETALHE = 60
+
+
+def _versao_servicos(servicos):
+    """Resumo das versões das configurações ativas: muda quando qualquer uma muda"""
+    versoes = '|'.join(f'{servico.pk}:{servico.data_atualizacao.isoformat()}' for servico in servicos)
+    return hashlib.md5(versoes.encode()).hexdigest()[:12]
+
+
+def _caminhos(texto):
+    """Lista de caminhos de um campo separado por vírgulas (imagem, laudo)"""
+    return [caminho.strip() for caminho in (texto or '').split(',') if caminho.strip()]
+
+
+def detalhe_arvore(tree_id):
+    """Dados completos da árvore para o painel do mapa (None se ela não existe), em cache"""
+    servicos = registry.servicos_ativos()
+    chave = CHAVE_DETALHE.format(tree_id, _versao_servicos(servicos))
+    detalhe = cache.get(chave)
+    if detalhe is not None:
+        return detalhe
+
+    arvore = Tree.objects.select_related('species', 'city').filter(pk=tree_id).first()
+    if arvore is None:
+        return None
+    laudos_tecnicos = arvore.laudos_tecnicos.filter(status=Laudo.LaudoStatus.APROVADO).order_by('-data_validacao')
+    detalhe = {
+        'id': arvore.pk,
+        'N_placa': arvore.N_placa,
+        'nome_popular': arvore.nome_popular.strip(),
+        'nome_cientifico': arvore.nome_cientifico.strip(),
+        'especie': arvore.species.name if arvore.species else None,
+        'dap': arvore.dap,
+        'altura': arvore.altura,
+        'latitude': arvore.latitude,
+        'longitude': arvore.longitude,
+        'plantado_por': arvore.plantado_por,
+        'cidade': arvore.city.slug,
+        'bairro': arvore.bairro,
+        'imagens': _caminhos(arvore.imagem),
+        'laudos': _caminhos(arvore.laudo),
+        'laudos_tecnicos': [
+            {'id': laudo.pk, 'titulo': laudo.titulo, 'arquivo': laudo.arquivo.url if laudo.arquivo else None}
+            for laudo in laudos_tecnicos
+        ],
+        'n_posts': arvore.posts.count(),
+        'services': valores_materializados(Tree.objects.filter(pk=tree_id), servicos).get(arvore.pk, {}),
+    }
+    cache.set(chave, detalhe, TEMPO_CACHE_DETALHE)
+    return detalhe
+
+
+def invalidar_detalhe(tree_id):
+    """Descarta o detalhe da árvore em cache (árvore, posts ou laudos alterados)"""
+    cache.delete(CHAVE_DETALHE.format(tree_id, _versao_servicos(registry.servicos_ativos())))
+
+
+def invalidar_detalhes(tree_ids):
+    """Descarta o detalhe em cache de várias árvores (ex.: clima da cidade alterado)"""
+    versao = _versao_servicos(registry.servicos_ativos())
+    cache.delete_many([CHAVE_DETALHE.format(tree_id, versao) for tree_id in tree_ids])
+
+
+# ==================== AGRUPAMENTOS ====================
+
+# Níveis da grade abaixo de um ladrilho de 256 px: 2 ** 2 = 4 células de 64 px por lado
+NIVEIS_POR_LADRILHO = 2
+MAXIMO_CELULAS = 4000
+# Contagens, centroides e serviços da seleção inteira são somados uma vez no
+# nível NIVEL_BASE (células de ~150 m); os níveis até ele juntam essas células
+NIVEL_BASE = 18
+# Acima de NIVEL_BASE a soma é feita por bloco (célula NIVEIS_POR_BLOCO níveis acima)
+NIVEIS_POR_BLOCO = 4
+CHAVE_AGRUPAMENTOS = 'mapa:agrupamentos:{}:{}:{}:{}'
+TEMPO_CACHE_AGRUPAMENTOS = 24 * 3600
+
+
+def chave_filtros(filtros):
+    """Resumo estável dos filtros do mapa (argumentos de Tree.objects.filter) para chaves de cache"""
+    normalizados = {campo: getattr(valor, 'pk', valor) for campo, valor in filtros.items()}
+    return hashlib.md5(json.dumps(normalizados, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def nivel_agrupamento(zoom, sul, oeste, norte, leste):
+    """Nível da grade do zoom, reduzido até o retângulo ter no máximo MAXIMO_CELULAS células"""
+    nivel = max(1, min(zoom + NIVEIS_POR_LADRILHO, grade.NIVEL_QUADKEY))
+    while nivel > 1 and grade.celulas_no_retangulo(sul, oeste, norte, leste, nivel) > MAXIMO_CELULAS:
+        nivel -= 1
+    return nivel
+
+
+def _somas_servicos(arvores, servicos, nivel):
+    """(célula, servico_id) -> (soma dos valores físicos materializados, árvores com valor atual)"""
+    # Junção a partir das árvores (índice por árvore na tabela materializada), não por serviço
+    atuais = reduce(or_, (
+        Q(valores_servicos__servico=servico, valores_servicos__versao=servico.data_atualizacao)
+        for servico in servicos
+    ))
+    linhas = (
+        arvores.filter(atuais).annotate(celula=Substr('quadkey', 1, nivel), servico=F('valores_servicos__servico'))
+        .values('celula', 'servico').annotate(total=Sum('valores_servicos__valor_fisico'), n=Count('id'))
+        .order_by().values_list('celula', 'servico', 'total', 'n')
+    )
+    return {(celula, servico_id): (total, n) for celula, servico_id, total, n in linhas}
+
+
+def _dominantes(arvores, nivel):
+    """Espécie (nome científico) mais frequente de cada célula; empate: a primeira em ordem alfabética"""
+    frequencias = {}
+    linhas = arvores.annotate(celula=Substr('quadkey', 1, nivel)).values('celula', 'nome_cientifico').annotate(
+        n=Count('id')
+    ).order_by().values_list('celula', 'nome_cientifico', 'n')
+    for celula, nome_cientifico, n in linhas:
+        especies = frequencias.setdefault(celula, {})
+        nome_cientifico = nome_cientifico.strip()
+        especies[nome_cientifico] = especies.get(nome_cientifico, 0) + n
+    return {
+        celula: min(especies.items(), key=lambda item: (-item[1], item[0]))[0]
+        for celula, especies in frequencias.items()
+    }
+
+
+def _somar_celulas(arvores, servicos, nivel):
+    """Somas das árvores por célula de `nivel`: n, latitudes, longitudes, menor id e serviços"""
+    celulas = {}
+    linhas = arvores.annotate(celula=Substr('quadkey', 1, nivel)).values('celula').annotate(
+        n=Count('id'), latitude=Sum('latitude'), longitude=Sum('longitude'), primeira=Min('id')
+    ).order_by().values_list('celula', 'n', 'latitude', 'longitude', 'primeira')
+    for celula, n, latitude, longitude, primeira in linhas:
+        celulas[celula] = {'n': n, 'latitude': latitude, 'longitude': longitude, 'primeira': primeira, 'services': {}}
+
+    if servicos:
+        somas = _somas_servicos(arvores, servicos, nivel)
+        completas = all(
+            somas.get((celula, servico.pk), (0, 0))[1] == dados['n']
+            for celula, dados in celulas.items() for servico in servicos
+        )
+        if not completas:
+            # Árvores sem valor atual (bulk_create, configuração alterada): materializa e soma de novo
+            materializar_pendentes(arvores, servicos)
+            somas = _somas_servicos(arvores, servicos, nivel)
+        for celula, dados in celulas.items():
+            dados['services'] = {
+                servico.codigo: somas.get((celula, servico.pk), (0.0, 0))[0] for servico in servicos
+            }
+    return celulas
+
+
+def _juntar(celulas, nivel, faixa):
+    """Junta as células nas de `nivel` (menor ou igual) que as contêm e estão na faixa de ladrilhos"""
+    (x_min, x_max), (y_min, y_max) = faixa
+    juntas = {}
+    for celula, dados in celulas.items():
+        prefixo = celula[:nivel]
+        junta = juntas.get(prefixo)
+        if junta is None:
+            x, y = grade.ladrilho(prefixo)
+            if x_min <= x <= x_max and y_min <= y <= y_max:
+                juntas[prefixo] = {**dados, 'services': dict(dados['services'])}
+            else:
+                juntas[prefixo] = None
+            continue
+        junta['n'] += dados['n']
+        junta['latitude'] += dados['latitude']
+        junta['longitude'] += dados['longitude']
+        junta['primeira'] = min(junta['primeira'], dados['primeira'])
+        for codigo, valor in dados['services'].items():
+            junta['services'][codigo] += valor
+    return {prefixo: junta for prefixo, junta in juntas.items() if junta is not None}
+
+
+def agrupamentos(filtros, servicos, sul, oeste, norte, leste, zoom):
+    """Árvores da seleção (filtros do mapa) agrupadas nas células da grade do zoom que cobrem o retângulo
+
+    Cada célula traz a contagem, o centroide, a espécie dominante (nome
+    científico mais frequente), os valores físicos somados de cada serviço
+    e, se tem uma única árvore, o id dela. As somas ficam em cache por versão
+    do inventário da cidade, dos serviços e filtros: a grade de NIVEL_BASE da
+    seleção inteira e, acima dela, cada bloco de células.
+    """
+    servicos = list(servicos)
+    cidade = filtros['city']
+    selecao = Tree.objects.filter(**filtros)
+    prefixo_chave = CHAVE_AGRUPAMENTOS.format(
+        cidade.pk, versao_inventario(cidade), _versao_servicos(servicos), chave_filtros(filtros)
+    )
+
+    def em_cache(parte, calcular):
+        chave = f'{prefixo_chave}:{parte}'
+        valor = cache.get(chave)
+        if valor is None:
+            # Árvores inseridas sem sinais ainda sem quadkey (consulta pelo índice)
+            grade.preencher_quadkeys(selecao)
+            valor = calcular()
+            cache.set(chave, valor, TEMPO_CACHE_AGRUPAMENTOS)
+        return valor
+
+    nivel = nivel_agrupamento(zoom, sul, oeste, norte, leste)
+    faixa = grade.faixa_ladrilhos(sul, oeste, norte, leste, nivel)
+    if nivel <= NIVEL_BASE:
+        base = em_cache('base', lambda: _somar_celulas(selecao, servicos, NIVEL_BASE))
+        celulas = _juntar(base, nivel, faixa)
+        especies = em_cache(f'especies:{nivel}', lambda: _dominantes(selecao, nivel))
+    else:
+        celulas, especies = {}, {}
+        nivel_bloco = nivel - NIVEIS_POR_BLOCO
+        for bloco in grade.prefixos_no_retangulo(sul, oeste, norte, leste, nivel_bloco):
+            arvores = selecao.filter(quadkey__gte=bloco, quadkey__lt=bloco + '4')
+            somas, dominantes = em_cache(
+                f'bloco:{nivel}:{bloco}',
+                lambda: (_somar_celulas(arvores, servicos, nivel), _dominantes(arvores, nivel)),
+            )
+            celulas.update(_juntar(somas, nivel, faixa))
+            especies.update(dominantes)
+
+    resultado = []
+    for celula, dados in sorted(celulas.items()):
+        n = dados['n']
+        resultado.append({
+            'quadkey': celula,
+            'n': n,
+            'latitude': dados['latitude'] / n,
+            'longitude': dados['longitude'] / n,
+            'id': dados['primeira'] if n == 1 else None,
+            'especie': especies.get(celula),
+            'services': dados['services'],
+        })
+    return {'nivel': nivel, 'total': sum(celula['n'] for celula in resultado), 'celulas': resultado}
+
+
+# ==================== ESTATÍSTICAS ====================
+
+CHAVE_ESTATISTICAS = 'mapa:estatisticas:{}:{}:{}:{}'
+
+
+def _totais_materializados(arvores, servicos):
+    """servico_id -> (soma dos valores físicos materializados atuais, árvores com valor atual)"""
+    if not servicos:
+        return {}
+    atuais = reduce(or_, (Q(servico=servico, versao=servico.data_atualizacao) for servico in servicos))
+    linhas = (
+        EcosystemServiceValue.objects.filter(atuais, tree__in=arvores.values('id'))
+        .values('servico').annotate(total=Sum('valor_fisico'), n=Count('id'))
+        .order_by().values_list('servico', 'total', 'n')
+    )
+    return {servico_id: (total, n) for servico_id, total, n in linhas}
+
+
+def estatisticas(filtros, servicos):
+    """Totais da seleção (filtros do mapa) para o painel: árvores, espécies, comentários e serviços
+
+    As contagens e as somas dos valores materializados ficam em cache por
+    versão do inventário da cidade, dos serviços e filtros; os comentários
+    (posts) são contados a cada chamada.
+    """
+    servicos = list(servicos)
+    cidade = filtros['city']
+    selecao = Tree.objects.filter(**filtros)
+    chave = CHAVE_ESTATISTICAS.format(
+        cidade.pk, versao_inventario(cidade), _versao_servicos(servicos), chave_filtros(filtros)
+    )
+    totais = cache.get(chave)
+    if totais is None:
+        # Espécies como no payload de pontos: nomes científicos distintos, sem espaços nas pontas
+        totais = selecao.aggregate(arvores=Count('id'), especies=Count(Trim('nome_cientifico'), distinct=True))
+        somas = _totais_materializados(selecao, servicos)
+        if any(somas.get(servico.pk, (0.0, 0))[1] < totais['arvores'] for servico in servicos):
+            # Árvores sem valor atual (bulk_create, configuração alterada): materializa e soma de novo
+            materializar_pendentes(selecao, servicos)
+            somas = _totais_materializados(selecao, servicos)
+        totais['servicos'] = {
+            servico.codigo: float(somas.get(servico.pk, (0.0, 0))[0] or 0.0) for servico in servicos
+        }
+        cache.set(chave, totais, TEMPO_CACHE_AGRUPAMENTOS)
+
+    return {
+        'arvores': totais['arvores'],
+        'especies': totais['especies'],
+        'comentarios': Post.objects.filter(tree__in=selecao.values('id')).count(),
+        'servicos': {
+            servico.codigo: {
+                'nome': servico.nome,
+                'valor_fisico': totais['servicos'].get(servico.codigo, 0.0),
+                'valor_monetario': servico.calcular_valor_monetario(totais['servicos'].get(servico.codigo, 0.0)),
+                'unidade': servico.unidade_medida,
+            }
+            for servico in servicos
+        },
+    }
@@ -0,0 +1,188 @@
+"""
+Valores materializados dos serviços ecossistêmicos por árvore.
+
+A tabela `EcosystemServiceValue` guarda o valor de cada (árvore, serviço)
+junto com a versão (`data_atualizacao`) da configuração usada. O mapa e os
+relatórios leem dessa tabela em vez de avaliar as fórmulas a cada request.
+
+O recálculo é incremental:
+- salvar uma `Tree` recalcula apenas aquela árvore;
+- salvar uma `EcosystemServiceConfig` recalcula apenas aquele serviço, em
+  lote (numpy) para todas as árvores, com gravação via bulk upsert.
+"""
+import numpy as np
+from django.db import connection, transaction
+
+from . import registry
+from .batch import DadosLote, calcular_lote
+from .models import EcosystemServiceValue, Tree
+
+_tabela = EcosystemServiceValue._meta.db_table
+SQL_UPSERT = (
+    f'INSERT INTO {_tabela} (tree_id, servico_id, versao, valor_fisico, valor_monetario) '
+    f'VALUES (%s, %s, %s, %s, %s) '
+    f'ON CONFLICT (tree_id, servico_id) DO UPDATE SET '
+    f'versao = excluded.versao, valor_fisico = excluded.valor_fisico, '
+    f'valor_monetario = excluded.valor_monetario'
+)
+
+
+def _linhas(servico, ids, valores):
+    """Linhas do upsert de um serviço para as árvores informadas"""
+    monetarios = np.round(np.asarray(valores, dtype=float) * servico.valor_monetario_unitario, 2)
+    versao = connection.ops.adapt_datetimefield_value(servico.data_atualizacao)
+    return [
+        (int(tree_id), servico.pk, versao, float(valor), float(monetario))
+        for tree_id, valor, monetario in zip(ids, valores, monetarios)
+    ]
+
+
+def _gravar(linhas):
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.executemany(SQL_UPSERT, linhas)
+
+
+def salvar_valores(servico, ids, valores):
+    """Grava (upsert) os valores de um serviço para as árvores informadas
+
+    Usa um único executemany em vez de bulk_create: no SQLite o Django limita
+    cada INSERT a ~200 linhas, o que domina o tempo de recálculo do inventário.
+    O executemany roda em uma transação: em autocommit (ex.: a API do mapa
+    materializando um bloco) cada linha seria confirmada separadamente.
+    """
+    _gravar(_linhas(servico, ids, valores))
+
+
+def recalcular_servico(servico, queryset=None):
+    """Recalcula um serviço para todas as árvores (ou as do queryset) em lote"""
+    if not servico.ativo:
+        # Serviço desativado não aparece no mapa: remove os valores materializados
+        EcosystemServiceValue.objects.filter(servico=servico).delete()
+        return 0
+
+    if queryset is None:
+        queryset = Tree.objects.all()
+    dados = DadosLote.para_servicos(queryset, [servico])
+    salvar_valores(servico, dados.ids, calcular_lote(servico, dados))
+    return len(dados)
+
+
+def recalcular_arvore(tree):
+    """Recalcula todos os serviços ativos de uma única árvore
+
+    As linhas de todos os serviços são gravadas juntas (um executemany e uma
+    transação), não uma gravação por serviço: o sinal roda a cada árvore
+    salva, inclusive em cada linha da importação do admin.
+    """
+    linhas = []
+    for servico in registry.servicos_ativos():
+        linhas += _linhas(servico, [tree.pk], [servico.calcular(tree)])
+    if linhas:
+        _gravar(linhas)
+
+
+def _formatar(servico, valor_fisico, valor_monetario):
+    return {
+        'nome': servico.nome,
+        'valor_fisico': valor_fisico,
+        'valor_monetario': valor_monetario,
+        'unidade': servico.unidade_medida,
+        'codigo': servico.codigo,
+        'categoria': servico.categoria,
+    }
+
+
+def valores_materializados(queryset, servicos=None):
+    """Retorna dict tree_id -> serviços no mesmo formato de Tree.get_all_ecosystem_services
+
+    Lê tudo com uma consulta. Valores ausentes ou de versões antigas da
+    configuração (ex.: árvores criadas via bulk_create) são recalculados
+    em lote e gravados antes de retornar.
+    """
+    if servicos is None:
+        servicos = registry.servicos_ativos()
+    servicos = list(servicos)
+    por_pk = {servico.pk: servico for servico in servicos}
+
+    linhas = EcosystemServiceValue.objects.filter(
+        tree__in=queryset.values('id'), servico__in=list(por_pk)
+    ).values_list('tree_id', 'servico_id', 'versao', 'valor_fisico', 'valor_monetario')
+
+    resultado = {}
+    atualizados = {pk: set() for pk in por_pk}
+    for tree_id, servico_id, versao, valor_fisico, valor_monetario in linhas:
+        servico = por_pk[servico_id]
+        if versao != servico.data_atualizacao:
+            continue
+        atualizados[servico_id].add(tree_id)
+        resultado.setdefault(tree_id, {})[servico.codigo] = _formatar(servico, valor_fisico, valor_monetario)
+
+    total = queryset.count()
+    if any(len(atualizados[servico.pk]) < total for servico in servicos):
+        dados = DadosLote.para_servicos(queryset, servicos)
+        for servico in servicos:
+            pendentes = ~np.isin(dados.ids, list(atualizados[servico.pk]))
+            if not pendentes.any():
+                continue
+            ids = dados.ids[pendentes]
+            valores = calcular_lote(servico, dados)[pendentes]
+            salvar_valores(servico, ids, valores)
+            for tree_id, valor in zip(ids, valores):
+                valor = float(valor)
+                resultado.setdefault(int(tree_id), {})[servico.codigo] = _formatar(
+                    servico, valor, servico.calcular_valor_monetario(valor)
+                )
+
+    # Mantém a ordem de exibição dos serviços em cada árvore
+    ordem = [servico.codigo for servico in servicos]
+    return {
+        tree_id: {codigo: valores[codigo] for codigo in ordem if codigo in valores}
+        for tree_id, valores in resultado.items()
+    }
+
+
+def materializar_pendentes(queryset, servicos):
+    """Calcula e grava os valores ausentes ou de versões antigas dos serviços para as árvores do queryset"""
+    for servico in servicos:
+        atualizados = EcosystemServiceValue.objects.filter(servico=servico, versao=servico.data_atualizacao)
+        pendentes = queryset.exclude(id__in=atualizados.values('tree_id'))
+        if pendentes.exists():
+            dados = DadosLote.para_servicos(pendentes, [servico])
+            salvar_valores(servico, dados.ids, calcular_lote(servico, dados))
+
+
+def matriz_valores(queryset, servicos, ids):
+    """Valores físicos materializados em uma matriz len(ids) x len(servicos)
+
+    `ids` são os ids (em ordem crescente) das árvores do queryset. Como em
+    valores_materializados, valores ausentes ou de versões antigas são
+    recalculados em lote e gravados; a leitura é uma consulta por serviço,
+    sem montar dicionários por árvore.
+    """
+    servicos = list(servicos)
+    ids = np.asarray(ids, dtype=np.int64)
+    valores = np.zeros((len(ids), len(servicos)))
+    pendentes = {}
+    for j, servico in enumerate(servicos):
+        linhas = np.array(list(
+            EcosystemServiceValue.objects.filter(
+                tree__in=queryset.values('id'), servico=servico, versao=servico.data_atualizacao
+            ).values_list('tree_id', 'valor_fisico')
+        ), dtype=float).reshape(-1, 2)
+        posicoes = np.searchsorted(ids, linhas[:, 0].astype(np.int64))
+        valores[posicoes, j] = linhas[:, 1]
+        if len(posicoes) < len(ids):
+            atualizados = np.zeros(len(ids), dtype=bool)
+            atualizados[posicoes] = True
+            pendentes[j] = ~atualizados
+
+    if pendentes:
+        dados = DadosLote.para_servicos(queryset, [servicos[j] for j in pendentes])
+        posicoes = np.searchsorted(ids, dados.ids)
+        for j, faltando in pendentes.items():
+            servico = servicos[j]
+            selecao = faltando[posicoes]
+            calculados = calcular_lote(servico, dados)[selecao]
+            salvar_valores(servico, dados.ids[selecao], calculados)
+            valores[posicoes[selecao], j] = calculados
+    return valores
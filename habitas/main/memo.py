@@ -0,0 +1,117 @@
+"""
+Memoização dos resultados dos serviços ecossistêmicos por entrada distinta.
+
+`Tree.dap` é inteiro e a altura é medida com pouca resolução, então o
+inventário tem bem menos combinações distintas de (dap, altura, espécie) do
+que árvores. O resultado de cada combinação é guardado uma única vez por
+versão da configuração em uma tabela LRU limitada, usada apenas pelo
+cálculo em lote (`batch.calcular_lote`): cada lote avalia uma vez cada
+combinação distinta e consulta a tabela para as já vistas. O cálculo árvore
+a árvore (`EcosystemServiceConfig.calcular`) não é memoizado: o ganho
+medido com benchmark_formulas era desprezível.
+
+A chave de cada entrada é formada pela versão da configuração, pela validade
+da árvore (DAP e altura > 0) e pelos valores que a fórmula realmente lê (ver
+formulas.analisar_dependencias e batch.matriz_entrada);
+fórmulas com acesso dinâmico a `tree` não são memoizadas.
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import cidades
+
+TAMANHO_PADRAO = 100000
+
+
+class MemoLRU:
+    """Tabela chave -> valor limitada, descartando a entrada usada há mais tempo"""
+
+    def __init__(self, capacidade):
+        self.capacidade = capacidade
+        self.habilitado = capacidade > 0
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self.acertos = 0
+        self.faltas = 0
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def obter_varios(self, chaves):
+        """Lista com o valor memoizado (ou None) de cada chave, marcando-as como usadas recentemente"""
+        # Leitura sem lock: get/move_to_end são atômicos sob o GIL; uma entrada
+        # pode ter sido descartada por outra thread entre as duas chamadas
+        entradas = self._entradas
+        valores = [entradas.get(chave) for chave in chaves]
+        acertos = [chave for chave, valor in zip(chaves, valores) if valor is not None]
+        self.acertos += len(acertos)
+        self.faltas += len(chaves) - len(acertos)
+        for chave in acertos:
+            try:
+                entradas.move_to_end(chave)
+            except KeyError:
+                pass
+        return valores
+
+    def guardar_varios(self, pares):
+        with self._lock:
+            self._entradas.update(pares)
+            while len(self._entradas) > self.capacidade:
+                self._entradas.popitem(last=False)
+
+    def limpar(self):
+        """Remove todas as entradas e zera as estatísticas"""
+        with self._lock:
+            self._entradas.clear()
+            self.acertos = 0
+            self.faltas = 0
+
+    def estatisticas(self):
+        consultas = self.acertos + self.faltas
+        return {
+            'entradas': len(self._entradas),
+            'capacidade': self.capacidade,
+            'acertos': self.acertos,
+            'faltas': self.faltas,
+            'taxa_acerto': self.acertos / consultas if consultas else 0.0,
+        }
+
+
+memo_servicos = MemoLRU(getattr(settings, 'ECOSYSTEM_SERVICES_MEMO_TAMANHO', TAMANHO_PADRAO))
+
+
+def chave_versao(config):
+    """Identifica a versão da configuração (ou None se ela não puder ser memoizada)
+
+    Fórmula e coeficientes entram na chave para cobrir edições em memória
+    ainda não salvas; a chave fica guardada na instância enquanto data de
+    atualização, fórmula e dicionário de coeficientes forem os mesmos. O clima
+    das cidades também entra: alterá-lo não cria uma nova versão da
+    configuração, e a matriz de entrada só traz o id da cidade (ao mudar,
+    o registro recarrega as configurações, descartando a chave guardada).
+    """
+    if not memo_servicos.habilitado or config.pk is None:
+        return None
+    marcador = (config.data_atualizacao, config.formula, id(config.coeficientes))
+    guardada = config.__dict__.get('_chave_memo')
+    if guardada is not None and guardada[0] == marcador:
+        return guardada[1]
+    coeficientes = config.coeficientes if config.coeficientes else {}
+    clima = cidades.sobreposicoes_clima(coeficientes)
+    chave = (
+        config.pk, config.data_atualizacao, config.formula, repr(sorted(coeficientes.items())),
+        repr(sorted(clima.items())),
+    )
+    config.__dict__['_chave_memo'] = (marcador, chave)
+    return chave
+
+
+def usa_dap_altura(dependencias):
+    """Indica se o valor depende de DAP/altura além da validade (ambos > 0)"""
+    variaveis = dependencias.variaveis
+    return (
+        'dap' in variaveis or 'biomassa' in variaveis,
+        'altura' in variaveis or 'biomassa' in variaveis,
+    )
@@ -0,0 +1,30 @@
+# Generated by Django 4.1.2 on 2026-10-18 20:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_add_ecosystem_services'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EcosystemServiceValue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('versao', models.DateTimeField(verbose_name='Versão da Configuração')),
+                ('valor_fisico', models.FloatField(verbose_name='Valor Físico')),
+                ('valor_monetario', models.FloatField(verbose_name='Valor Monetário (R$)')),
+                ('servico', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='valores', to='main.ecosystemserviceconfig')),
+                ('tree', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='valores_servicos', to='main.tree')),
+            ],
+            options={
+                'verbose_name': 'Valor de Serviço Ecossistêmico',
+                'verbose_name_plural': 'Valores de Serviços Ecossistêmicos',
+                'unique_together': {('tree', 'servico')},
+            },
+        ),
+    ]
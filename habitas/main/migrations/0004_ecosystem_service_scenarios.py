@@ -0,0 +1,35 @@
+# Generated by Django 4.1.2 on 2026-10-18 20:25
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_ecosystem_service_values'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EcosystemServiceScenario',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nome', models.CharField(max_length=255, verbose_name='Nome do Cenário')),
+                ('formula', models.TextField(verbose_name='Fórmula Python')),
+                ('coeficientes', models.JSONField(default=dict, verbose_name='Coeficientes')),
+                ('valor_monetario_unitario', models.FloatField(default=0.0, verbose_name='Valor Monetário por Unidade (R$)')),
+                ('versao_base', models.DateTimeField(verbose_name='Versão da Configuração Comparada')),
+                ('resultado', models.JSONField(default=dict, verbose_name='Resultado')),
+                ('data_criacao', models.DateTimeField(auto_now_add=True)),
+                ('criado_por', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='cenarios_criados', to=settings.AUTH_USER_MODEL)),
+                ('servico', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cenarios', to='main.ecosystemserviceconfig')),
+            ],
+            options={
+                'verbose_name': 'Cenário de Serviço Ecossistêmico',
+                'verbose_name_plural': 'Cenários de Serviços Ecossistêmicos',
+                'ordering': ['-data_criacao'],
+            },
+        ),
+    ]
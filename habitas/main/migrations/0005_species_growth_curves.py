@@ -0,0 +1,28 @@
+# Generated by Django 4.1.2 on 2026-10-18 20:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_ecosystem_service_scenarios'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='species',
+            name='altura_maxima',
+            field=models.FloatField(blank=True, null=True, verbose_name='Altura Máxima (m)'),
+        ),
+        migrations.AddField(
+            model_name='species',
+            name='dap_maximo',
+            field=models.FloatField(blank=True, null=True, verbose_name='DAP Máximo (cm)'),
+        ),
+        migrations.AddField(
+            model_name='species',
+            name='taxa_crescimento',
+            field=models.FloatField(blank=True, null=True, verbose_name='Taxa de Crescimento (1/ano)'),
+        ),
+    ]
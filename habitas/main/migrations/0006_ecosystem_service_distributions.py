@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-18 20:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_species_growth_curves'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ecosystemserviceconfig',
+            name='distribuicoes',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Distribuições dos Coeficientes'),
+        ),
+    ]
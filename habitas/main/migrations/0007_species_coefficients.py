@@ -0,0 +1,29 @@
+# Generated by Django 4.1.2 on 2026-10-18 20:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_ecosystem_service_distributions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpeciesCoefficient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chave', models.CharField(max_length=100, verbose_name='Coeficiente')),
+                ('valor', models.FloatField(verbose_name='Valor')),
+                ('servico', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coeficientes_especie', to='main.ecosystemserviceconfig')),
+                ('species', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coeficientes_servicos', to='main.species')),
+            ],
+            options={
+                'verbose_name': 'Coeficiente por Espécie',
+                'verbose_name_plural': 'Coeficientes por Espécie',
+                'unique_together': {('servico', 'species', 'chave')},
+            },
+        ),
+    ]
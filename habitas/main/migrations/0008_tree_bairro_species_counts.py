@@ -0,0 +1,124 @@
+# Generated by Django 4.1.2 on 2026-10-18 20:39
+
+import json
+
+import numpy as np
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Cópia congelada de main.geo (bairros de static/js/bairros.js e teste de ponto em
+# polígono): a migração não depende do código atual do app
+ARQUIVO_BAIRROS = settings.BASE_DIR / 'static' / 'js' / 'bairros.js'
+ELEMENTOS_POR_BLOCO = 2_000_000
+
+
+def _bairros():
+    """Lista de (nome, [[anel (lon, lat), ...] por polígono]) na ordem do arquivo"""
+    texto = ARQUIVO_BAIRROS.read_text(encoding='utf-8')
+    geojson = json.loads(texto[texto.index('{'):texto.rindex('}') + 1])
+    resultado = []
+    for feature in geojson['features']:
+        nome = (feature.get('properties') or {}).get('bairro') or f"Bairro {feature.get('id', '').strip()}"
+        geometria = feature['geometry']
+        if geometria['type'] == 'Polygon':
+            poligonos = [geometria['coordinates']]
+        elif geometria['type'] == 'MultiPolygon':
+            poligonos = geometria['coordinates']
+        else:
+            poligonos = []
+        resultado.append((
+            nome.strip(), [[np.asarray(anel, dtype=float)[:, :2] for anel in aneis] for aneis in poligonos]
+        ))
+    return resultado
+
+
+def _dentro(lon, lat, aneis):
+    """Máscara dos pontos dentro do polígono (regra par-ímpar, em blocos de pontos)"""
+    dentro = np.zeros(len(lon), dtype=bool)
+    externo = aneis[0]
+    (lon_min, lat_min), (lon_max, lat_max) = externo.min(axis=0), externo.max(axis=0)
+    candidatos = np.flatnonzero((lon >= lon_min) & (lon <= lon_max) & (lat >= lat_min) & (lat <= lat_max))
+    tamanho_bloco = max(1, ELEMENTOS_POR_BLOCO // sum(len(anel) for anel in aneis))
+    for inicio in range(0, len(candidatos), tamanho_bloco):
+        bloco = candidatos[inicio:inicio + tamanho_bloco]
+        x, y = lon[bloco][:, None], lat[bloco][:, None]
+        paridade = np.zeros(len(bloco), dtype=bool)
+        for anel in aneis:
+            x1, y1 = anel[:, 0], anel[:, 1]
+            x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+            cruza = (y1 > y) != (y2 > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_intersecao = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            paridade ^= (np.count_nonzero(cruza & (x < x_intersecao), axis=1) % 2).astype(bool)
+        dentro[bloco] = paridade
+    return dentro
+
+
+def _nomes_dos_pontos(latitude, longitude):
+    """Nome do primeiro bairro (na ordem do arquivo) que contém cada ponto, ou ''"""
+    lat = np.asarray(latitude, dtype=float)
+    lon = np.asarray(longitude, dtype=float)
+    nomes = [''] * len(lat)
+    livres = np.ones(len(lat), dtype=bool)
+    for nome, poligonos in _bairros():
+        for aneis in poligonos:
+            for i in np.flatnonzero(_dentro(lon, lat, aneis) & livres):
+                nomes[i] = nome
+                livres[i] = False
+    return nomes
+
+
+def preencher_bairros_e_contagens(apps, schema_editor):
+    """Localiza o bairro das árvores existentes e monta a tabela de contagens"""
+    from django.db.models import Count
+
+    Tree = apps.get_model('main', 'Tree')
+    SpeciesCount = apps.get_model('main', 'SpeciesCount')
+
+    arvores = list(Tree.objects.only('id', 'latitude', 'longitude'))
+    if arvores:
+        nomes = _nomes_dos_pontos([a.latitude for a in arvores], [a.longitude for a in arvores])
+        for arvore, nome in zip(arvores, nomes):
+            arvore.bairro = nome
+        Tree.objects.bulk_update(arvores, ['bairro'], batch_size=500)
+
+    grupos = Tree.objects.values('bairro', 'plantado_por', 'species_id').annotate(n=Count('id')).order_by()
+    SpeciesCount.objects.bulk_create([
+        SpeciesCount(
+            bairro=grupo['bairro'], plantado_por=grupo['plantado_por'],
+            species_id=grupo['species_id'], contagem=grupo['n'],
+        )
+        for grupo in grupos
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_species_coefficients'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tree',
+            name='bairro',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=100),
+        ),
+        migrations.CreateModel(
+            name='SpeciesCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bairro', models.CharField(blank=True, max_length=100)),
+                ('plantado_por', models.CharField(max_length=100)),
+                ('contagem', models.PositiveIntegerField(default=0)),
+                ('species', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='contagens', to='main.species')),
+            ],
+            options={
+                'verbose_name': 'Contagem de Espécie',
+                'verbose_name_plural': 'Contagens de Espécies',
+                'unique_together': {('bairro', 'plantado_por', 'species')},
+            },
+        ),
+        migrations.RunPython(preencher_bairros_e_contagens, migrations.RunPython.noop),
+    ]
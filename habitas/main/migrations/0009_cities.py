@@ -0,0 +1,68 @@
+# Generated by Django 4.1.2 on 2026-10-18 21:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def criar_sao_jose_dos_campos(apps, schema_editor):
+    """Cria a cidade do inventário atual e atribui a ela as árvores e as contagens existentes"""
+    City = apps.get_model('main', 'City')
+    Tree = apps.get_model('main', 'Tree')
+    SpeciesCount = apps.get_model('main', 'SpeciesCount')
+
+    cidade, _ = City.objects.get_or_create(
+        slug='sao-jose-dos-campos',
+        defaults={
+            'nome': 'São José dos Campos',
+            'latitude': -23.205459913570404,
+            'longitude': -45.88184219354045,
+            'zoom': 15,
+            'arquivo_bairros': 'bairros.js',
+            'arquivo_limite': 'city.js',
+            'precipitacao': 1329,
+            'radiacao': 1661,
+        },
+    )
+    Tree.objects.filter(city__isnull=True).update(city=cidade)
+    SpeciesCount.objects.filter(city__isnull=True).update(city=cidade)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_tree_bairro_species_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='City',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nome', models.CharField(max_length=255, unique=True, verbose_name='Nome')),
+                ('slug', models.SlugField(max_length=100, unique=True, verbose_name='Identificador')),
+                ('latitude', models.FloatField(verbose_name='Latitude do Centro')),
+                ('longitude', models.FloatField(verbose_name='Longitude do Centro')),
+                ('zoom', models.PositiveSmallIntegerField(default=15, verbose_name='Zoom Inicial')),
+                ('arquivo_bairros', models.CharField(default='bairros.js', max_length=255, verbose_name='Arquivo de Bairros')),
+                ('arquivo_limite', models.CharField(default='city.js', max_length=255, verbose_name='Arquivo do Limite')),
+                ('precipitacao', models.FloatField(default=1329, verbose_name='Precipitação Anual (L/m²)')),
+                ('radiacao', models.FloatField(default=1661, verbose_name='Radiação Solar Anual (kWh/m²)')),
+            ],
+            options={
+                'verbose_name': 'Cidade',
+                'verbose_name_plural': 'Cidades',
+                'ordering': ['nome'],
+            },
+        ),
+        migrations.AddField(
+            model_name='tree',
+            name='city',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='arvores', to='main.city', verbose_name='Cidade'),
+        ),
+        migrations.AddField(
+            model_name='speciescount',
+            name='city',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='contagens', to='main.city'),
+        ),
+        migrations.RunPython(criar_sao_jose_dos_campos, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 4.1.2 on 2026-10-18 21:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """Torna a cidade obrigatória depois que 0009_cities a preencheu
+
+    Separada da migração de dados: no PostgreSQL alterar a tabela na mesma
+    transação do UPDATE das chaves estrangeiras falha com "pending trigger
+    events".
+    """
+
+    dependencies = [
+        ('main', '0009_cities'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tree',
+            name='city',
+            field=models.ForeignKey(blank=True, help_text='Se omitida, é localizada pelas coordenadas ao salvar', on_delete=django.db.models.deletion.PROTECT, related_name='arvores', to='main.city', verbose_name='Cidade'),
+        ),
+        migrations.AlterField(
+            model_name='speciescount',
+            name='city',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contagens', to='main.city'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='speciescount',
+            unique_together={('city', 'bairro', 'plantado_por', 'species')},
+        ),
+        migrations.AlterField(
+            model_name='tree',
+            name='bairro',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='tree',
+            index=models.Index(fields=['city', 'bairro'], name='tree_cidade_bairro'),
+        ),
+        migrations.AddIndex(
+            model_name='tree',
+            index=models.Index(fields=['city', 'species'], name='tree_cidade_especie'),
+        ),
+        migrations.AddIndex(
+            model_name='tree',
+            index=models.Index(fields=['city', 'plantado_por'], name='tree_cidade_plantado_por'),
+        ),
+        migrations.CreateModel(
+            name='CityCoefficient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chave', models.CharField(max_length=100, verbose_name='Coeficiente')),
+                ('valor', models.FloatField(verbose_name='Valor')),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coeficientes_servicos', to='main.city')),
+                ('servico', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coeficientes_cidade', to='main.ecosystemserviceconfig')),
+            ],
+            options={
+                'verbose_name': 'Coeficiente por Cidade',
+                'verbose_name_plural': 'Coeficientes por Cidade',
+                'unique_together': {('servico', 'city', 'chave')},
+            },
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 4.1.2 on 2026-10-18 21:28
+
+import math
+
+import numpy as np
+from django.db import migrations, models
+
+# Cópia congelada de main.grade.quadkeys: a migração não depende do código atual do app
+NIVEL_QUADKEY = 22
+LATITUDE_MAXIMA = 85.05112878
+
+
+def _quadkeys(latitude, longitude):
+    """Quadkeys (str) de NIVEL_QUADKEY dígitos dos pontos (ladrilhos Web Mercator)"""
+    latitude = np.clip(np.asarray(latitude, dtype=float), -LATITUDE_MAXIMA, LATITUDE_MAXIMA)
+    longitude = np.asarray(longitude, dtype=float)
+    lado = 2 ** NIVEL_QUADKEY
+    seno = np.sin(np.radians(latitude))
+    x = np.clip((longitude + 180) / 360 * lado, 0, lado - 1).astype(np.int64)
+    y = np.clip((0.5 - np.log((1 + seno) / (1 - seno)) / (4 * math.pi)) * lado, 0, lado - 1).astype(np.int64)
+    deslocamentos = np.arange(NIVEL_QUADKEY - 1, -1, -1)
+    digitos = ((x[:, None] >> deslocamentos) & 1) + 2 * ((y[:, None] >> deslocamentos) & 1)
+    return [bytes(linha).decode() for linha in (digitos + ord('0')).astype(np.uint8)]
+
+
+def preencher_quadkeys(apps, schema_editor):
+    """Calcula o quadkey das árvores existentes"""
+    Tree = apps.get_model('main', 'Tree')
+    linhas = list(Tree.objects.values_list('id', 'latitude', 'longitude'))
+    if not linhas:
+        return
+    ids, latitude, longitude = zip(*linhas)
+    conexao = schema_editor.connection
+    tabela = conexao.ops.quote_name(Tree._meta.db_table)
+    with conexao.cursor() as cursor:
+        cursor.executemany(
+            f'UPDATE {tabela} SET quadkey = %s WHERE id = %s', list(zip(_quadkeys(latitude, longitude), ids))
+        )
+
+
+def analisar_arvores(apps, schema_editor):
+    """Estatísticas do SQLite: sem elas o planejador prefere o índice por cidade às faixas de quadkey"""
+    if schema_editor.connection.vendor == 'sqlite':
+        Tree = apps.get_model('main', 'Tree')
+        schema_editor.execute(f'ANALYZE {schema_editor.quote_name(Tree._meta.db_table)}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_city_required'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tree',
+            name='quadkey',
+            field=models.CharField(blank=True, default='', max_length=22),
+        ),
+        migrations.RunPython(preencher_quadkeys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='tree',
+            index=models.Index(fields=['city', 'quadkey'], name='tree_cidade_quadkey'),
+        ),
+        migrations.RunPython(analisar_arvores, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,25 @@
 import math
 import json
+import logging
+import time
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.core.exceptions import ValidationError
 from django.core.validators import FileExtensionValidator
 
+from . import cidades, guarda, perfil, registry
+from .batch import DadosLote, calcular_lote
+from .coeficientes import tabela_coeficientes
+from .formulas import obter_formula_compilada
+
+logger = logging.getLogger(__name__)
+
 # Create your models here.
 BETA0 = -0.906586
 BETA1 = 1.60421
 BETA2 = 0.37162
 
+# Clima de São José dos Campos: valores padrão de City (ver cidades.py)
 PRECIPITATION = 1329  # Precipitação anual em São José dos Campos (L / m^2)
 DIAMETER_RATIO = 4  # Razão média entre diâmetro da copa e diâmetro do tronco
 
@@ -76,6 +87,30 @@ class CustomUser(AbstractUser):
         return f"{self.username} ({self.get_user_type_display()})"
 
 
+class City(models.Model):
+    """Município hospedado na instalação: centro do mapa, geometrias e clima"""
+    nome = models.CharField(max_length=255, unique=True, verbose_name="Nome")
+    slug = models.SlugField(max_length=100, unique=True, verbose_name="Identificador")
+    # Centro e zoom iniciais do mapa
+    latitude = models.FloatField(verbose_name="Latitude do Centro")
+    longitude = models.FloatField(verbose_name="Longitude do Centro")
+    zoom = models.PositiveSmallIntegerField(default=15, verbose_name="Zoom Inicial")
+    # Arquivos GeoJSON em static/js (mesmo formato de bairros.js e city.js)
+    arquivo_bairros = models.CharField(max_length=255, default="bairros.js", verbose_name="Arquivo de Bairros")
+    arquivo_limite = models.CharField(max_length=255, default="city.js", verbose_name="Arquivo do Limite")
+    # Substituem os coeficientes PRECIPITATION e RADIATION nas fórmulas das árvores da cidade
+    precipitacao = models.FloatField(default=PRECIPITATION, verbose_name="Precipitação Anual (L/m²)")
+    radiacao = models.FloatField(default=RADIATION, verbose_name="Radiação Solar Anual (kWh/m²)")
+
+    class Meta:
+        ordering = ['nome']
+        verbose_name = 'Cidade'
+        verbose_name_plural = 'Cidades'
+
+    def __str__(self):
+        return self.nome
+
+
 class Tree(models.Model):
     N_placa = models.FloatField(default=0)
     nome_popular = models.CharField(max_length=255)
@@ -89,6 +124,24 @@ class Tree(models.Model):
     imagem = models.URLField(max_length=255, blank=True)
     plantado_por = models.CharField(max_length=100, default="DCTA")
     species = models.ForeignKey('Species', null=True, on_delete=models.SET_NULL)
+    # Cidade da árvore; quando omitida (blank) é localizada ao salvar pelo sinal pre_save (ver cidades.py)
+    city = models.ForeignKey(
+        City, on_delete=models.PROTECT, blank=True, related_name='arvores', verbose_name="Cidade",
+        help_text="Se omitida, é localizada pelas coordenadas ao salvar",
+    )
+    # Bairro que contém (latitude, longitude), preenchido ao salvar (ver geo.py)
+    bairro = models.CharField(max_length=100, blank=True, default="")
+    # Célula da grade multirresolução que contém a árvore, preenchida ao salvar (ver grade.py)
+    quadkey = models.CharField(max_length=22, blank=True, default="")
+
+    class Meta:
+        # Toda consulta do mapa e dos agregados é restrita a uma cidade
+        indexes = [
+            models.Index(fields=['city', 'bairro'], name='tree_cidade_bairro'),
+            models.Index(fields=['city', 'species'], name='tree_cidade_especie'),
+            models.Index(fields=['city', 'plantado_por'], name='tree_cidade_plantado_por'),
+            models.Index(fields=['city', 'quadkey'], name='tree_cidade_quadkey'),
+        ]
 
     @property
     def stored_co2(self) -> float:
@@ -110,14 +163,17 @@ class Tree(models.Model):
         if self.dap <= 0:
             return 0
 
-        return math.pi * ((self.dap * DIAMETER_RATIO) / (2 * 100)) ** 2 * PRECIPITATION
+        return math.pi * ((self.dap * DIAMETER_RATIO) / (2 * 100)) ** 2 * cidades.clima(self.city_id, 'PRECIPITATION')
 
     @property
     def conserved_energy(self) -> float:
         if self.dap <= 0:
             return 0
 
-        return math.pi * ((self.dap * DIAMETER_RATIO) / (2 * 100)) ** 2 * RADIATION * ENERGY_RATIO
+        return (
+            math.pi * ((self.dap * DIAMETER_RATIO) / (2 * 100)) ** 2
+            * cidades.clima(self.city_id, 'RADIATION') * ENERGY_RATIO
+        )
 
     @property
     def biodiversity(self) -> float:
@@ -127,10 +183,10 @@ class Tree(models.Model):
     
     def get_ecosystem_service_value(self, codigo_servico):
         """Obtém o valor de um serviço ecossistêmico específico via configuração dinâmica"""
-        try:
-            config = EcosystemServiceConfig.objects.get(codigo=codigo_servico, ativo=True)
+        config = registry.servico_ativo(codigo_servico)
+        if config is not None:
             return config.calcular(self)
-        except EcosystemServiceConfig.DoesNotExist:
+        else:
             # Fallback para métodos antigos (compatibilidade)
             if codigo_servico == 'co2_armazenado':
                 return self.stored_co2
@@ -144,7 +200,7 @@ class Tree(models.Model):
     
     def get_all_ecosystem_services(self):
         """Retorna dict com todos os serviços ecossistêmicos ativos"""
-        servicos = EcosystemServiceConfig.objects.filter(ativo=True).order_by('ordem_exibicao')
+        servicos = registry.servicos_ativos()
         resultado = {}
         for servico in servicos:
             valor_fisico = servico.calcular(self)
@@ -177,6 +233,14 @@ class Post(models.Model):
 class Species(models.Model):
     name = models.TextField()
     bio_index = models.FloatField()
+    
+    # Curva de crescimento (von Bertalanffy) usada na projeção; vazio = padrão em crescimento.py
+    dap_maximo = models.FloatField(null=True, blank=True, verbose_name="DAP Máximo (cm)")
+    altura_maxima = models.FloatField(null=True, blank=True, verbose_name="Altura Máxima (m)")
+    taxa_crescimento = models.FloatField(null=True, blank=True, verbose_name="Taxa de Crescimento (1/ano)")
+    
+    def __str__(self):
+        return self.name
 
 
 class Laudo(models.Model):
@@ -297,6 +361,10 @@ class EcosystemServiceConfig(models.Model):
     # Exemplo: {"BETA0": -0.906586, "BETA1": 1.60421, "BETA2": 0.37162, "PRECIPITATION": 1329}
     coeficientes = models.JSONField(default=dict, verbose_name="Coeficientes")
     
+    # Distribuições opcionais dos coeficientes para a análise de incerteza (Monte Carlo)
+    # Exemplo: {"BETA0": {"tipo": "normal", "desvio": 0.05}, "DIAMETER_RATIO": {"tipo": "uniforme", "min": 3, "max": 5}}
+    distribuicoes = models.JSONField(default=dict, blank=True, verbose_name="Distribuições dos Coeficientes")
+    
     # Valoração monetária
     valor_monetario_unitario = models.FloatField(default=0.0, verbose_name="Valor Monetário por Unidade (R$)")
     unidade_medida = models.CharField(max_length=50, default="unidade", verbose_name="Unidade de Medida")
@@ -339,11 +407,38 @@ class EcosystemServiceConfig(models.Model):
         status = "✓" if self.ativo else "✗"
         return f"{status} {self.nome}"
     
+    def clean(self):
+        """Valida as distribuições dos coeficientes e o custo da fórmula (ver guarda.py)"""
+        from .incerteza import validar_distribuicoes
+        
+        try:
+            validar_distribuicoes(self.distribuicoes, self.coeficientes)
+        except ValueError as e:
+            raise ValidationError({'distribuicoes': str(e)})
+        
+        if self.formula:
+            try:
+                guarda.validar_formula(self)
+            except guarda.FormulaRejeitada as e:
+                raise ValidationError({'formula': str(e)})
+    
     def calcular(self, tree):
         """Calcula o valor do serviço para uma árvore"""
         if not self.ativo:
             return 0.0
+        if not perfil.perfil_servicos.habilitado:
+            return self._calcular(tree)[0]
         
+        inicio = time.perf_counter()
+        resultado, falha = self._calcular(tree)
+        perfil.perfil_servicos.registrar(
+            self.codigo, 'arvore', time.perf_counter() - inicio,
+            erros=int(falha == 'erro'), zeros=int(falha is not None),
+        )
+        return resultado
+    
+    def _calcular(self, tree):
+        """Retorna (valor, falha); falha é None, 'zero' (0 por falha matemática/degradação) ou 'erro'"""
         try:
             import math
             
@@ -353,18 +448,26 @@ class EcosystemServiceConfig(models.Model):
             # Validação: DAP e altura devem ser > 0 para cálculos com log
             # Retorna 0 imediatamente se dados inválidos
             if dap <= 0 or altura <= 0:
-                return 0.0
+                return 0.0, None
+            
+            # Versão reprovada pela sonda (tempo ou memória excessivos): não avalia
+            if guarda.motivo_degradacao(self):
+                return 0.0, 'zero'
             
-            # Calcula biomassa se necessário (para novos serviços)
-            if dap > 0 and altura > 0:
+            compilada = obter_formula_compilada(self)
+            # Coeficientes globais com as sobreposições da espécie (ver coeficientes.py)
+            tabela = tabela_coeficientes(self)
+            
+            # Calcula biomassa só quando a fórmula a usa (análise estática da fórmula)
+            if compilada.dependencias.usa_biomassa:
                 biomassa = math.exp(
                     -0.906586 + 1.60421 * math.log(dap) + 0.37162 * math.log(altura)
                 ) / 1000  # em toneladas
             else:
-                biomassa = 0.0
+                biomassa = None
             
             # Prepara contexto - IMPORTANTE: manter compatibilidade com código atual
-            coeficientes = self.coeficientes if self.coeficientes else {}
+            coeficientes = tabela.para_arvore(tree.species_id, tree.city_id)
             context = {
                 'math': math,
                 'dap': dap,
@@ -380,30 +483,44 @@ class EcosystemServiceConfig(models.Model):
             for key, value in coeficientes.items():
                 context[key] = value
             
-            # Avalia a fórmula com tratamento de erros matemáticos
+            # Avalia a fórmula (compilada uma vez por versão) com tempo limite e tratamento de erros matemáticos
             try:
-                resultado = eval(self.formula, {"__builtins__": {}}, context)
+                inicio = time.perf_counter()
+                resultado = eval(compilada.codigo, {"__builtins__": {}}, context)
+                if guarda.excedeu_tempo(self, inicio):
+                    # Versão degradada: esta e as próximas avaliações valem 0
+                    return 0.0, 'zero'
+                falha = None
                 # Validação do resultado
                 if not isinstance(resultado, (int, float)) or math.isnan(resultado) or math.isinf(resultado):
-                    return 0.0
+                    resultado = 0.0
+                    falha = 'zero'
                 # Arredondamento igual ao código original
-                return round(float(resultado), 4)
+                resultado = round(float(resultado), 4)
+                return resultado, falha
             except (ValueError, ZeroDivisionError, OverflowError) as math_error:
                 # Erro matemático (log de número <= 0, divisão por zero, overflow)
                 # Retorna 0 silenciosamente - não loga para não poluir console
-                return 0.0
+                return 0.0, 'zero'
             
         except (ValueError, ZeroDivisionError, OverflowError) as math_error:
             # Erro matemático capturado no nível externo também
             # Silenciosamente retorna 0
-            return 0.0
-        except Exception as e:
-            # Apenas loga erros não-matemáticos para debug
-            print(f"Erro ao calcular {self.nome} para árvore {tree.id}: {e}")
-            import traceback
-            traceback.print_exc()
-            return 0.0
-    
+            return 0.0, 'zero'
+        except MemoryError:
+            # Na sonda (guarda.py) a exceção é reportada ao processo pai; na avaliação real a versão é degradada
+            if not guarda.degradar(self, 'Limite de memória excedido na avaliação'):
+                raise
+            return 0.0, 'zero'
+        except Exception:
+            # Apenas loga erros não-matemáticos para debug (contados em perfil.py)
+            logger.exception('Erro ao calcular %s para árvore %s', self.nome, tree.id)
+            return 0.0, 'erro'
+    
+    def calcular_batch(self, trees):
+        """Calcula o valor do serviço para várias árvores de uma vez (array numpy na mesma ordem)"""
+        return calcular_lote(self, DadosLote.para_servicos(trees, [self]))
+
     def calcular_valor_monetario(self, valor_fisico):
         """Calcula o valor monetário do serviço"""
         return round(valor_fisico * self.valor_monetario_unitario, 2)
@@ -430,3 +547,125 @@ class EcosystemServiceHistory(models.Model):
     
     def __str__(self):
         return f"{self.servico.nome} - {self.acao} - {self.data.strftime('%d/%m/%Y %H:%M')}"
+
+
+class EcosystemServiceValue(models.Model):
+    """Valor materializado de um serviço ecossistêmico para uma árvore"""
+    tree = models.ForeignKey(Tree, on_delete=models.CASCADE, related_name='valores_servicos')
+    servico = models.ForeignKey(
+        EcosystemServiceConfig,
+        on_delete=models.CASCADE,
+        related_name='valores'
+    )
+    # data_atualizacao da configuração usada no cálculo
+    versao = models.DateTimeField(verbose_name="Versão da Configuração")
+    valor_fisico = models.FloatField(verbose_name="Valor Físico")
+    valor_monetario = models.FloatField(verbose_name="Valor Monetário (R$)")
+    
+    class Meta:
+        unique_together = ('tree', 'servico')
+        verbose_name = 'Valor de Serviço Ecossistêmico'
+        verbose_name_plural = 'Valores de Serviços Ecossistêmicos'
+    
+    def __str__(self):
+        return f"{self.servico.codigo} - árvore {self.tree_id}: {self.valor_fisico}"
+
+
+class SpeciesCount(models.Model):
+    """Número de árvores de cada espécie por cidade, bairro e plantado_por (mantido pelos sinais de Tree)"""
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name='contagens')
+    bairro = models.CharField(max_length=100, blank=True)
+    plantado_por = models.CharField(max_length=100)
+    species = models.ForeignKey(Species, null=True, on_delete=models.CASCADE, related_name='contagens')
+    contagem = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('city', 'bairro', 'plantado_por', 'species')
+        verbose_name = 'Contagem de Espécie'
+        verbose_name_plural = 'Contagens de Espécies'
+
+    def __str__(self):
+        return f"{self.bairro or 'Fora dos bairros'} / {self.plantado_por} - {self.species_id}: {self.contagem}"
+
+
+class SpeciesCoefficient(models.Model):
+    """Valor de um coeficiente do serviço específico de uma espécie (sobrepõe o valor global)"""
+    servico = models.ForeignKey(
+        EcosystemServiceConfig,
+        on_delete=models.CASCADE,
+        related_name='coeficientes_especie'
+    )
+    species = models.ForeignKey(Species, on_delete=models.CASCADE, related_name='coeficientes_servicos')
+    chave = models.CharField(max_length=100, verbose_name="Coeficiente")
+    valor = models.FloatField(verbose_name="Valor")
+
+    class Meta:
+        unique_together = ('servico', 'species', 'chave')
+        verbose_name = 'Coeficiente por Espécie'
+        verbose_name_plural = 'Coeficientes por Espécie'
+
+    def __str__(self):
+        return f"{self.servico.codigo} - {self.species.name}: {self.chave} = {self.valor}"
+
+    def clean(self):
+        """O coeficiente precisa existir na configuração (valor global usado pelas demais espécies)"""
+        if self.servico_id and self.chave not in (self.servico.coeficientes or {}):
+            raise ValidationError({'chave': f'O serviço não tem o coeficiente "{self.chave}"'})
+
+
+class CityCoefficient(models.Model):
+    """Valor de um coeficiente do serviço específico de uma cidade (sobrepõe o valor global e o clima da cidade)"""
+    servico = models.ForeignKey(
+        EcosystemServiceConfig,
+        on_delete=models.CASCADE,
+        related_name='coeficientes_cidade'
+    )
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name='coeficientes_servicos')
+    chave = models.CharField(max_length=100, verbose_name="Coeficiente")
+    valor = models.FloatField(verbose_name="Valor")
+
+    class Meta:
+        unique_together = ('servico', 'city', 'chave')
+        verbose_name = 'Coeficiente por Cidade'
+        verbose_name_plural = 'Coeficientes por Cidade'
+
+    def __str__(self):
+        return f"{self.servico.codigo} - {self.city.nome}: {self.chave} = {self.valor}"
+
+    def clean(self):
+        """O coeficiente precisa existir na configuração (valor global usado pelas demais cidades)"""
+        if self.servico_id and self.chave not in (self.servico.coeficientes or {}):
+            raise ValidationError({'chave': f'O serviço não tem o coeficiente "{self.chave}"'})
+
+
+class EcosystemServiceScenario(models.Model):
+    """Cenário "e se": fórmula/coeficientes em rascunho simulados sobre o inventário"""
+    servico = models.ForeignKey(
+        EcosystemServiceConfig,
+        on_delete=models.CASCADE,
+        related_name='cenarios'
+    )
+    nome = models.CharField(max_length=255, verbose_name="Nome do Cenário")
+    formula = models.TextField(verbose_name="Fórmula Python")
+    coeficientes = models.JSONField(default=dict, verbose_name="Coeficientes")
+    valor_monetario_unitario = models.FloatField(default=0.0, verbose_name="Valor Monetário por Unidade (R$)")
+    # data_atualizacao da configuração em vigor usada na comparação
+    versao_base = models.DateTimeField(verbose_name="Versão da Configuração Comparada")
+    # Totais atual/cenário/diferença, por espécie e comparação com o histórico
+    resultado = models.JSONField(default=dict, verbose_name="Resultado")
+    criado_por = models.ForeignKey(
+        CustomUser,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='cenarios_criados'
+    )
+    data_criacao = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['-data_criacao']
+        verbose_name = 'Cenário de Serviço Ecossistêmico'
+        verbose_name_plural = 'Cenários de Serviços Ecossistêmicos'
+    
+    def __str__(self):
+        return f"{self.servico.nome} - {self.nome} ({self.data_criacao.strftime('%d/%m/%Y %H:%M')})"
@@ -0,0 +1,191 @@
+"""
+Estatísticas de execução das fórmulas de serviços ecossistêmicos.
+
+Cada serviço acumula, separadamente para o cálculo árvore a árvore
+(`EcosystemServiceConfig.calcular`) e para o cálculo em lote
+(`batch.calcular_lote`): número de chamadas, árvores avaliadas, tempo total,
+histograma de latência (faixas logarítmicas, de onde saem os percentis),
+erros e retornos 0 por falha (erro matemático, resultado inválido ou versão
+degradada).
+
+Os contadores ficam no processo e são somados periodicamente ao cache do
+Django (compartilhado entre os workers), de onde o admin e o comando
+`ecosystem_services_stats` leem. A soma no cache não é atômica: em
+publicações simultâneas de workers diferentes alguns contadores podem se
+perder, o que é aceitável para perfilamento.
+"""
+import atexit
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+CAMINHOS = ('arvore', 'lote')
+# Histograma de latência: FAIXAS_POR_DECADA faixas por potência de 10, de 0,1 µs a 100 s
+FAIXAS_POR_DECADA = 4
+DECADA_MINIMA = -1
+NUM_FAIXAS = FAIXAS_POR_DECADA * 9
+PERCENTIS = (50, 90, 99)
+INTERVALO_PUBLICACAO = 5.0
+CHAVE_CACHE = 'ecosystem_services:perfil:{}'
+CHAVE_CODIGOS = 'ecosystem_services:perfil:codigos'
+
+
+def _faixa(segundos):
+    if segundos <= 0:
+        return 0
+    indice = int(math.floor((math.log10(segundos * 1e6) - DECADA_MINIMA) * FAIXAS_POR_DECADA))
+    return min(max(indice, 0), NUM_FAIXAS - 1)
+
+
+def limite_faixa(indice):
+    """Limite superior (em segundos) de uma faixa do histograma"""
+    return 10 ** ((indice + 1) / FAIXAS_POR_DECADA + DECADA_MINIMA) / 1e6
+
+
+class Contadores:
+    """Contadores de um caminho de cálculo de um serviço"""
+
+    __slots__ = ('chamadas', 'arvores', 'tempo_total', 'histograma', 'erros', 'zeros')
+
+    def __init__(self):
+        self.chamadas = 0
+        self.arvores = 0
+        self.tempo_total = 0.0
+        self.histograma = [0] * NUM_FAIXAS
+        self.erros = 0
+        self.zeros = 0
+
+    def registrar(self, segundos, arvores=1, erros=0, zeros=0):
+        self.chamadas += 1
+        self.arvores += arvores
+        self.tempo_total += segundos
+        self.histograma[_faixa(segundos)] += 1
+        self.erros += erros
+        self.zeros += zeros
+
+    def somar(self, outro):
+        self.chamadas += outro.chamadas
+        self.arvores += outro.arvores
+        self.tempo_total += outro.tempo_total
+        self.histograma = [a + b for a, b in zip(self.histograma, outro.histograma)]
+        self.erros += outro.erros
+        self.zeros += outro.zeros
+
+    def percentil(self, p):
+        """Latência (s) abaixo da qual estão p% das chamadas (limite superior da faixa)"""
+        if not self.chamadas:
+            return 0.0
+        alvo = self.chamadas * p / 100
+        acumulado = 0
+        for indice, contagem in enumerate(self.histograma):
+            acumulado += contagem
+            if acumulado >= alvo:
+                return limite_faixa(indice)
+        return limite_faixa(NUM_FAIXAS - 1)
+
+    def para_dict(self):
+        return {campo: getattr(self, campo) for campo in self.__slots__}
+
+    @classmethod
+    def de_dict(cls, dados):
+        contadores = cls()
+        for campo in cls.__slots__:
+            if campo in dados:
+                setattr(contadores, campo, dados[campo])
+        if len(contadores.histograma) != NUM_FAIXAS:
+            contadores.histograma = [0] * NUM_FAIXAS
+        return contadores
+
+    def resumo(self):
+        """Valores exibidos no admin e no comando (tempos em ms)"""
+        return {
+            'chamadas': self.chamadas,
+            'arvores': self.arvores,
+            'tempo_total_ms': round(self.tempo_total * 1000, 3),
+            'media_us': round(self.tempo_total / self.chamadas * 1e6, 2) if self.chamadas else 0.0,
+            **{f'p{p}_us': round(self.percentil(p) * 1e6, 2) for p in PERCENTIS},
+            'erros': self.erros,
+            'zeros': self.zeros,
+        }
+
+
+class Perfil:
+    """Contadores ainda não publicados no cache, por serviço e caminho"""
+
+    def __init__(self):
+        self.habilitado = getattr(settings, 'ECOSYSTEM_SERVICES_PERFIL', True)
+        self._pendentes = {}
+        self._lock = threading.Lock()
+        self._ultima_publicacao = time.monotonic()
+
+    def registrar(self, codigo, caminho, segundos, arvores=1, erros=0, zeros=0):
+        with self._lock:
+            por_caminho = self._pendentes.get(codigo)
+            if por_caminho is None:
+                por_caminho = self._pendentes[codigo] = {nome: Contadores() for nome in CAMINHOS}
+            por_caminho[caminho].registrar(segundos, arvores, erros, zeros)
+        if time.monotonic() - self._ultima_publicacao >= INTERVALO_PUBLICACAO:
+            self.publicar()
+
+    def contar(self, codigo, caminho, erros=0, zeros=0):
+        """Soma erros/retornos 0 sem registrar uma chamada (ex.: dentro de um lote já cronometrado)"""
+        with self._lock:
+            por_caminho = self._pendentes.get(codigo)
+            if por_caminho is None:
+                por_caminho = self._pendentes[codigo] = {nome: Contadores() for nome in CAMINHOS}
+            por_caminho[caminho].erros += erros
+            por_caminho[caminho].zeros += zeros
+
+    def publicar(self):
+        """Soma os contadores pendentes aos do cache e os zera"""
+        with self._lock:
+            pendentes, self._pendentes = self._pendentes, {}
+            self._ultima_publicacao = time.monotonic()
+        if not pendentes:
+            return
+        codigos = set(cache.get(CHAVE_CODIGOS) or ())
+        for codigo, por_caminho in pendentes.items():
+            atuais = _ler(codigo)
+            for caminho, contadores in por_caminho.items():
+                atuais[caminho].somar(contadores)
+            cache.set(CHAVE_CACHE.format(codigo), {nome: c.para_dict() for nome, c in atuais.items()}, None)
+            codigos.add(codigo)
+        cache.set(CHAVE_CODIGOS, sorted(codigos), None)
+
+    def estatisticas(self, codigo):
+        """Contadores publicados somados aos pendentes deste processo: {caminho: Contadores}"""
+        atuais = _ler(codigo)
+        with self._lock:
+            pendentes = self._pendentes.get(codigo, {})
+            for caminho, contadores in pendentes.items():
+                atuais[caminho].somar(contadores)
+        return atuais
+
+    def codigos(self):
+        with self._lock:
+            locais = set(self._pendentes)
+        return sorted(set(cache.get(CHAVE_CODIGOS) or ()) | locais)
+
+    def limpar(self, codigo=None):
+        """Zera as estatísticas de um serviço (ou de todos)"""
+        codigos = [codigo] if codigo else self.codigos()
+        with self._lock:
+            for item in codigos:
+                self._pendentes.pop(item, None)
+        for item in codigos:
+            cache.delete(CHAVE_CACHE.format(item))
+        restantes = [] if codigo is None else [item for item in self.codigos() if item != codigo]
+        cache.set(CHAVE_CODIGOS, restantes, None)
+
+
+def _ler(codigo):
+    dados = cache.get(CHAVE_CACHE.format(codigo)) or {}
+    return {caminho: Contadores.de_dict(dados.get(caminho, {})) for caminho in CAMINHOS}
+
+
+perfil_servicos = Perfil()
+# Comandos de gerenciamento terminam antes do intervalo de publicação
+atexit.register(perfil_servicos.publicar)
@@ -0,0 +1,97 @@
+"""
+Registro em memória das configurações ativas de serviços ecossistêmicos e
+das cidades (cujo clima entra nas fórmulas, ver cidades.py).
+
+As configurações ativas e as cidades são carregadas uma vez por processo e
+reutilizadas por todas as árvores e requests, em vez de uma consulta por
+árvore.
+
+A invalidação funciona entre processos (ex.: workers do gunicorn) por meio
+de um carimbo de versão guardado no cache do Django: os sinais post_save e
+post_delete de `EcosystemServiceConfig` e de `City` gravam um carimbo novo, e cada
+processo compara o carimbo no início de cada request (e, fora de requests,
+no máximo a cada INTERVALO_VERIFICACAO segundos) antes de reutilizar a
+cópia local. Para que isso funcione com vários workers, o backend de cache
+precisa ser compartilhado (ver CACHES em settings.py).
+"""
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+
+CHAVE_VERSAO = 'ecosystem_services:versao'
+INTERVALO_VERIFICACAO = 5.0  # segundos
+
+_lock = threading.Lock()
+_estado_thread = threading.local()
+_registro = {
+    'versao': None,
+    'servicos': [],
+    'por_codigo': {},
+    'cidades': {},
+}
+
+
+def _versao_atual():
+    """Lê o carimbo compartilhado, criando um se ainda não existir (ou se foi descartado)"""
+    versao = cache.get(CHAVE_VERSAO)
+    if versao is None:
+        versao = uuid.uuid4().hex
+        if not cache.add(CHAVE_VERSAO, versao, None):
+            versao = cache.get(CHAVE_VERSAO, versao)
+    return versao
+
+
+def _carregar(versao):
+    from .models import City, EcosystemServiceConfig
+
+    servicos = list(EcosystemServiceConfig.objects.filter(ativo=True).order_by('ordem_exibicao'))
+    cidades = {cidade.pk: cidade for cidade in City.objects.all()}
+    with _lock:
+        _registro['servicos'] = servicos
+        _registro['por_codigo'] = {servico.codigo: servico for servico in servicos}
+        _registro['cidades'] = cidades
+        _registro['versao'] = versao
+
+
+def _garantir_atualizado():
+    agora = time.monotonic()
+    verificado_em = getattr(_estado_thread, 'verificado_em', None)
+    if verificado_em is not None and agora - verificado_em < INTERVALO_VERIFICACAO:
+        return
+    versao = _versao_atual()
+    if versao != _registro['versao']:
+        _carregar(versao)
+    _estado_thread.verificado_em = agora
+
+
+def servicos_ativos():
+    """Lista das configurações ativas, em ordem de exibição"""
+    _garantir_atualizado()
+    return _registro['servicos']
+
+
+def servico_ativo(codigo):
+    """Configuração ativa com o código informado (ou None)"""
+    _garantir_atualizado()
+    return _registro['por_codigo'].get(codigo)
+
+
+def cidades():
+    """Dict id -> City de todas as cidades"""
+    _garantir_atualizado()
+    return _registro['cidades']
+
+
+def invalidar():
+    """Descarta a cópia local e publica um carimbo novo para os demais processos"""
+    with _lock:
+        _registro['versao'] = None
+    cache.set(CHAVE_VERSAO, uuid.uuid4().hex, None)
+    _estado_thread.verificado_em = None
+
+
+def marcar_para_verificacao(**kwargs):
+    """Receptor de request_started: força a conferência do carimbo no request atual"""
+    _estado_thread.verificado_em = None
@@ -0,0 +1,167 @@
+"""
+Sinais do app principal.
+
+Preenchem o bairro e o quadkey da árvore e mantêm os valores materializados
+dos serviços ecossistêmicos e a tabela de contagens de espécies por bairro
+em dia quando uma árvore é criada, alterada ou removida, descartam o
+detalhe da árvore em cache do mapa quando ela, seus posts ou seus laudos
+mudam, renovam a versão dos ladrilhos da camada de árvores quando árvores
+ou posts da cidade mudam, e invalidam o registro de configurações ativas
+quando uma configuração, uma cidade ou um coeficiente por espécie ou por
+cidade muda.
+"""
+from django.core.signals import request_started
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import cidades, geo, grade, ladrilhos, mapa, registry
+from .diversidade import CAMPOS_CONTAGEM, ajustar_contagem, chave_contagem
+from .formulas import invalidar_formula
+from .inventario import invalidar_inventario
+from .materializacao import recalcular_arvore
+from .models import (
+    City, CityCoefficient, EcosystemServiceConfig, EcosystemServiceValue, Laudo, Post, SpeciesCoefficient, Tree
+)
+
+request_started.connect(registry.marcar_para_verificacao, dispatch_uid='registry_request_started')
+
+
+@receiver(pre_save, sender=Tree)
+def preencher_bairro(sender, instance, raw=False, **kwargs):
+    """Localiza a cidade (se omitida), o bairro e o quadkey quando a árvore é nova ou mudou de lugar
+
+    Guarda também a chave de contagem anterior.
+    """
+    if raw:
+        return
+    if instance.city_id is None:
+        instance.city = cidades.cidade_do_ponto(instance.latitude, instance.longitude)
+    cidade = cidades.cidade(instance.city_id)
+    anterior = None
+    if instance.pk is not None:
+        anterior = Tree.objects.filter(pk=instance.pk).values_list('latitude', 'longitude', *CAMPOS_CONTAGEM).first()
+    if anterior is None:
+        instance._contagem_anterior = None
+        instance.bairro = geo.bairro_do_ponto(instance.latitude, instance.longitude, cidade)
+        instance.quadkey = grade.quadkey(instance.latitude, instance.longitude)
+        return
+    latitude, longitude, city_id, bairro, plantado_por, species_id = anterior
+    instance._contagem_anterior = (city_id, bairro or '', plantado_por or '', species_id)
+    mudou = (latitude, longitude, city_id) != (instance.latitude, instance.longitude, instance.city_id)
+    if not instance.bairro or mudou:
+        instance.bairro = geo.bairro_do_ponto(instance.latitude, instance.longitude, cidade)
+    if not instance.quadkey or mudou:
+        instance.quadkey = grade.quadkey(instance.latitude, instance.longitude)
+
+
+@receiver(post_save, sender=Tree)
+def atualizar_contagem_de_especies(sender, instance, raw=False, **kwargs):
+    """Move a árvore na tabela de contagens (no máximo duas linhas alteradas)"""
+    if raw:
+        return
+    anterior = instance.__dict__.pop('_contagem_anterior', None)
+    atual = (instance.city_id, instance.bairro or '', instance.plantado_por or '', instance.species_id)
+    if anterior != atual:
+        if anterior is not None:
+            ajustar_contagem(anterior, -1)
+        ajustar_contagem(atual, 1)
+
+
+@receiver(post_delete, sender=Tree)
+def remover_da_contagem_de_especies(sender, instance, **kwargs):
+    chave = chave_contagem(instance)
+    if chave is not None:
+        ajustar_contagem(chave, -1)
+
+
+@receiver(post_save, sender=Tree)
+@receiver(post_delete, sender=Tree)
+def invalidar_versao_do_inventario(sender, instance, **kwargs):
+    """Resultados derivados do inventário da cidade em cache (ex.: cobertura de copa) deixam de valer"""
+    invalidar_inventario(instance.city_id)
+
+
+@receiver(post_save, sender=Tree)
+def recalcular_servicos_da_arvore(sender, instance, raw=False, **kwargs):
+    """Recalcula apenas os serviços da árvore salva"""
+    if raw:
+        # Carga de fixtures: a árvore pode referenciar espécies ainda não carregadas
+        return
+    recalcular_arvore(instance)
+
+
+@receiver(post_save, sender=Tree)
+@receiver(post_delete, sender=Tree)
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+@receiver(post_save, sender=Laudo)
+@receiver(post_delete, sender=Laudo)
+def invalidar_detalhe_da_arvore(sender, instance, **kwargs):
+    """O painel da árvore no mapa (dados, contagem de posts, laudos aprovados) deixa de valer"""
+    mapa.invalidar_detalhe(instance.pk if sender is Tree else instance.tree_id)
+
+
+@receiver(post_save, sender=Tree)
+@receiver(post_delete, sender=Tree)
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def invalidar_ladrilhos_da_cidade(sender, instance, **kwargs):
+    """Os ladrilhos da camada de árvores (marcadores e cor pelos posts) passam a uma nova versão"""
+    if sender is Tree:
+        ladrilhos.invalidar_ladrilhos(instance.city_id)
+        return
+    # Na remoção em cascata a árvore pode já ter sido apagada; o sinal dela cobre a cidade
+    city_id = Tree.objects.filter(pk=instance.tree_id).values_list('city_id', flat=True).first()
+    if city_id is not None:
+        ladrilhos.invalidar_ladrilhos(city_id)
+
+
+@receiver(post_save, sender=EcosystemServiceConfig)
+@receiver(post_delete, sender=EcosystemServiceConfig)
+def invalidar_registro_de_servicos(sender, instance, **kwargs):
+    """Publica uma nova versão do registro de serviços ativos para todos os processos"""
+    invalidar_formula(instance.pk)
+    registry.invalidar()
+
+
+@receiver(post_save, sender=SpeciesCoefficient)
+@receiver(post_delete, sender=SpeciesCoefficient)
+@receiver(post_save, sender=CityCoefficient)
+@receiver(post_delete, sender=CityCoefficient)
+def nova_versao_do_servico(sender, instance, **kwargs):
+    """Coeficiente por espécie ou cidade alterado: nova versão da configuração (memo e valores materializados)"""
+    EcosystemServiceConfig.objects.filter(pk=instance.servico_id).update(data_atualizacao=timezone.now())
+    invalidar_formula(instance.servico_id)
+    registry.invalidar()
+
+
+@receiver(pre_save, sender=City)
+def guardar_clima_anterior(sender, instance, raw=False, **kwargs):
+    """Guarda o clima gravado da cidade para o post_save saber se ele mudou"""
+    if raw or instance.pk is None:
+        instance._clima_anterior = None
+        return
+    instance._clima_anterior = City.objects.filter(pk=instance.pk).values_list('precipitacao', 'radiacao').first()
+
+
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+def invalidar_registro_de_cidades(sender, instance, **kwargs):
+    """Publica uma nova versão do registro (cidades em memória) para todos os processos
+
+    Só quando o clima de uma cidade existente muda os valores dos serviços
+    das árvores dela deixam de valer: as linhas materializadas da cidade são
+    removidas (e recalculadas na próxima leitura, como as de versões antigas)
+    e os resultados em cache do inventário da cidade e o detalhe das árvores
+    dela são descartados. As configurações e as demais cidades não mudam. Uma
+    cidade nova ou removida não tem árvores (Tree.city é PROTECT).
+    """
+    registry.invalidar()
+    anterior = instance.__dict__.pop('_clima_anterior', None)
+    if anterior is None or anterior == (instance.precipitacao, instance.radiacao):
+        return
+    arvores = Tree.objects.filter(city_id=instance.pk).values_list('id', flat=True)
+    EcosystemServiceValue.objects.filter(tree__in=arvores).delete()
+    mapa.invalidar_detalhes(arvores)
+    invalidar_inventario(instance.pk)
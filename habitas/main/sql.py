@@ -0,0 +1,269 @@
+"""
+Tradução das fórmulas de serviços ecossistêmicos para expressões do ORM.
+
+Formatos comuns de fórmula (aritmética, `**`, `math.exp`, `math.log`,
+`math.sqrt`, `math.pi`, coeficientes e `tree.species.bio_index`) são
+convertidos em expressões do Django, de modo que `SUM(serviço)` sobre um
+queryset filtrado de `Tree` rode no banco em uma única consulta, sem
+instanciar as árvores. No SQLite as funções matemáticas são as funções
+determinísticas que o próprio Django registra na conexão (EXP, LN, POWER...).
+
+Coeficientes sobrepostos por cidade (ver coeficientes.py) viram um CASE
+sobre `city_id`. Fórmulas que não podem ser traduzidas (ou que falham no
+banco) e configurações com coeficientes por espécie caem, de forma
+transparente, no avaliador em lote em Python.
+"""
+import ast
+import math
+
+from django.db import DatabaseError
+from django.db.models import Case, F, FloatField, Q, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce, Exp, Ln, Log, Mod, Power, Round, Sqrt
+
+from .batch import BIOMASSA_BETA0, BIOMASSA_BETA1, BIOMASSA_BETA2, evaluate_services
+from .coeficientes import tabela_coeficientes
+
+CONSTANTES_MATH = {'pi': math.pi, 'e': math.e}
+FUNCOES_MATH = {'exp': Exp, 'log': Ln, 'sqrt': Sqrt, 'pow': Power}
+# Campos de Tree e Species que podem ser lidos diretamente das colunas
+CAMPOS_TREE = {'dap', 'altura', 'latitude', 'longitude', 'N_placa'}
+CAMPOS_SPECIES = {'bio_index'}
+
+
+class FormulaNaoTraduzivel(Exception):
+    """A fórmula usa construções sem equivalente no ORM"""
+
+
+def _valor(numero):
+    return Value(float(numero), output_field=FloatField())
+
+
+def _coluna(caminho):
+    # Cast garante divisão em ponto flutuante (dap é inteiro no banco)
+    return Cast(F(caminho), output_field=FloatField())
+
+
+class _TradutorSQL:
+    """Converte a AST de uma fórmula em expressão do ORM"""
+
+    def __init__(self, coeficientes, sobreposicoes_cidade=None):
+        self.coeficientes = coeficientes or {}
+        # city_id -> {chave: valor}
+        self.sobreposicoes_cidade = sobreposicoes_cidade or {}
+
+    def traduzir(self, node):
+        metodo = getattr(self, f'_{type(node).__name__}', None)
+        if metodo is None:
+            raise FormulaNaoTraduzivel(type(node).__name__)
+        return metodo(node)
+
+    def _Expression(self, node):
+        return self.traduzir(node.body)
+
+    def _Constant(self, node):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise FormulaNaoTraduzivel(repr(node.value))
+        return _valor(node.value)
+
+    def _Name(self, node):
+        if node.id in ('dap', 'altura'):
+            return _coluna(node.id)
+        if node.id == 'biomassa':
+            return Exp(
+                _valor(BIOMASSA_BETA0)
+                + _valor(BIOMASSA_BETA1) * Ln(_coluna('dap'))
+                + _valor(BIOMASSA_BETA2) * Ln(_coluna('altura'))
+            ) / _valor(1000)
+        if node.id in self.coeficientes:
+            return self._coeficiente(node.id)
+        raise FormulaNaoTraduzivel(node.id)
+
+    def _coeficiente(self, chave):
+        valor = self.coeficientes.get(chave)
+        if isinstance(valor, bool) or not isinstance(valor, (int, float)):
+            raise FormulaNaoTraduzivel(f'coeficiente {chave}')
+        por_cidade = [
+            When(city_id=city_id, then=_valor(valores[chave]))
+            for city_id, valores in sorted(self.sobreposicoes_cidade.items()) if chave in valores
+        ]
+        if por_cidade:
+            return Case(*por_cidade, default=_valor(valor), output_field=FloatField())
+        return _valor(valor)
+
+    def _Subscript(self, node):
+        # coeficientes["CHAVE"]
+        if (
+            isinstance(node.value, ast.Name) and node.value.id == 'coeficientes'
+            and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str)
+        ):
+            return self._coeficiente(node.slice.value)
+        raise FormulaNaoTraduzivel('subscrito')
+
+    def _Attribute(self, node):
+        caminho = _caminho_atributo(node)
+        if caminho[:1] == ['math'] and len(caminho) == 2 and caminho[1] in CONSTANTES_MATH:
+            return _valor(CONSTANTES_MATH[caminho[1]])
+        if caminho[:1] == ['tree']:
+            if len(caminho) == 2 and caminho[1] in CAMPOS_TREE:
+                return _coluna(caminho[1])
+            if len(caminho) == 3 and caminho[1] == 'species' and caminho[2] in CAMPOS_SPECIES:
+                return _coluna(f'species__{caminho[2]}')
+        raise FormulaNaoTraduzivel('.'.join(caminho))
+
+    def _Call(self, node):
+        if node.keywords or not isinstance(node.func, ast.Attribute):
+            raise FormulaNaoTraduzivel('chamada')
+        caminho = _caminho_atributo(node.func)
+        if caminho[:1] != ['math'] or len(caminho) != 2:
+            raise FormulaNaoTraduzivel('.'.join(caminho))
+        args = [self.traduzir(arg) for arg in node.args]
+        if caminho[1] == 'log' and len(args) == 2:
+            # math.log(x, base) -> LOG(base, x)
+            return Log(args[1], args[0])
+        funcao = FUNCOES_MATH.get(caminho[1])
+        if funcao is None:
+            raise FormulaNaoTraduzivel(f'math.{caminho[1]}')
+        return funcao(*args)
+
+    def _BinOp(self, node):
+        esquerda = self.traduzir(node.left)
+        direita = self.traduzir(node.right)
+        if isinstance(node.op, ast.Add):
+            return esquerda + direita
+        if isinstance(node.op, ast.Sub):
+            return esquerda - direita
+        if isinstance(node.op, ast.Mult):
+            return esquerda * direita
+        if isinstance(node.op, ast.Div):
+            return esquerda / direita
+        if isinstance(node.op, ast.Pow):
+            return Power(esquerda, direita)
+        if isinstance(node.op, ast.Mod):
+            return Mod(esquerda, direita)
+        raise FormulaNaoTraduzivel(type(node.op).__name__)
+
+    def _UnaryOp(self, node):
+        operando = self.traduzir(node.operand)
+        if isinstance(node.op, ast.USub):
+            return _valor(-1) * operando
+        if isinstance(node.op, ast.UAdd):
+            return operando
+        raise FormulaNaoTraduzivel(type(node.op).__name__)
+
+    def _IfExp(self, node):
+        return Case(
+            When(self._condicao(node.test), then=self.traduzir(node.body)),
+            default=self.traduzir(node.orelse),
+            output_field=FloatField(),
+        )
+
+    def _condicao(self, node):
+        """Converte testes sobre a espécie em Q (ex.: tree.species is not None)"""
+        if isinstance(node, ast.BoolOp):
+            condicoes = [self._condicao(valor) for valor in node.values]
+            resultado = condicoes[0]
+            for condicao in condicoes[1:]:
+                resultado = resultado & condicao if isinstance(node.op, ast.And) else resultado | condicao
+            return resultado
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return ~self._condicao(node.operand)
+        if (
+            isinstance(node, ast.Compare) and len(node.ops) == 1
+            and isinstance(node.ops[0], (ast.Is, ast.IsNot))
+            and isinstance(node.comparators[0], ast.Constant) and node.comparators[0].value is None
+            and isinstance(node.left, ast.Attribute) and _caminho_atributo(node.left) == ['tree', 'species']
+        ):
+            return Q(species__isnull=isinstance(node.ops[0], ast.Is))
+        if (
+            isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'hasattr'
+            and len(node.args) == 2 and isinstance(node.args[0], ast.Attribute)
+            and _caminho_atributo(node.args[0]) == ['tree', 'species']
+            and isinstance(node.args[1], ast.Constant) and node.args[1].value in CAMPOS_SPECIES
+        ):
+            # Campo do modelo: sempre presente quando a espécie existe
+            return Q(species__isnull=False)
+        raise FormulaNaoTraduzivel('condição')
+
+
+def _caminho_atributo(node):
+    """Converte a.b.c em ['a', 'b', 'c']"""
+    partes = []
+    while isinstance(node, ast.Attribute):
+        partes.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        raise FormulaNaoTraduzivel('atributo')
+    partes.append(node.id)
+    return partes[::-1]
+
+
+def expressao_sql(config):
+    """Expressão do ORM com o valor por árvore do serviço (mesmas regras de calcular)
+
+    Levanta FormulaNaoTraduzivel se a fórmula não tiver equivalente no banco.
+    """
+    tabela = tabela_coeficientes(config)
+    if tabela.por_especie:
+        raise FormulaNaoTraduzivel('coeficientes por espécie')
+    arvore = ast.parse(config.formula, mode='eval')
+    expressao = _TradutorSQL(config.coeficientes, tabela.sobreposicoes_cidade).traduzir(arvore)
+    # DAP/altura não positivos resultam em 0; NULL (dados ausentes) também
+    return Round(
+        Coalesce(
+            Case(
+                When(Q(dap__gt=0, altura__gt=0), then=expressao),
+                default=_valor(0),
+                output_field=FloatField(),
+            ),
+            _valor(0),
+        ),
+        4,
+    )
+
+
+def totais_servicos(queryset, servicos=None):
+    """Totais físico e monetário de cada serviço sobre um queryset de Tree
+
+    Os serviços traduzíveis são somados no banco em uma única consulta; os
+    demais são avaliados em lote em Python. O formato do retorno é o mesmo
+    de ResultadoLote.totais().
+    """
+    if servicos is None:
+        from . import registry
+
+        servicos = registry.servicos_ativos()
+    servicos = [servico for servico in servicos if servico.ativo]
+
+    somas = {}
+    em_python = []
+    for servico in servicos:
+        try:
+            somas[servico.codigo] = Sum(expressao_sql(servico))
+        except (FormulaNaoTraduzivel, SyntaxError):
+            em_python.append(servico)
+
+    totais_fisicos = {}
+    if somas:
+        try:
+            totais_fisicos = queryset.order_by().aggregate(**somas)
+        except (DatabaseError, ValueError, OverflowError):
+            # Ex.: overflow em EXP dentro do banco: recalcula esses serviços em Python
+            em_python.extend(servico for servico in servicos if servico.codigo in somas)
+            totais_fisicos = {}
+
+    if em_python:
+        for codigo, total in evaluate_services(queryset, em_python).totais().items():
+            totais_fisicos[codigo] = total['valor_fisico']
+
+    resultado = {}
+    for servico in servicos:
+        valor_fisico = float(totais_fisicos.get(servico.codigo) or 0.0)
+        resultado[servico.codigo] = {
+            'nome': servico.nome,
+            'valor_fisico': valor_fisico,
+            'valor_monetario': servico.calcular_valor_monetario(valor_fisico),
+            'unidade': servico.unidade_medida,
+            'codigo': servico.codigo,
+            'categoria': servico.categoria,
+        }
+    return resultado
@@ -3,6 +3,14 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('api/trees/', views.api_arvores, name='api_arvores'),
+    path('api/trees/pontos/', views.api_pontos, name='api_pontos'),
+    path('api/trees/agrupamentos/', views.api_agrupamentos, name='api_agrupamentos'),
+    path('api/trees/estatisticas/', views.api_estatisticas, name='api_estatisticas'),
+    path('api/trees/<int:tree_id>/', views.api_arvore, name='api_arvore'),
+    path('api/diversidade/', views.api_diversidade, name='api_diversidade'),
+    path('api/cobertura/', views.api_cobertura, name='api_cobertura'),
+    path('tiles/trees/<int:z>/<int:x>/<int:y>.png', views.ladrilho_arvores, name='ladrilho_arvores'),
     
     # Autenticação
     path('register/cidadao/', views.register_cidadao, name='register_cidadao'),
@@ -1,9 +1,16 @@
+import hashlib
+import math
+from functools import wraps
+
+from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Count
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
 from .models import (
     Tree,
     Post,
@@ -11,7 +18,6 @@ from .models import (
     Laudo,
     Notificacao,
     HistoricoNotificacao,
-    EcosystemServiceConfig,
 )
 from .forms import (
     CidadaoRegistrationForm,
@@ -21,11 +27,48 @@ from .forms import (
     ParecerTecnicoForm,
     AprovacaoTecnicoForm,
 )
+from . import cidades, copa, diversidade, ladrilhos, mapa, registry
+from .sql import totais_servicos
 from .decorators import gestor_required, tecnico_required, gestor_ou_tecnico_required
 
 
-def index(request):
-    filters = {}
+# Filtros do mapa cobertos pela tabela de contagens de espécies (ver diversidade.py)
+FILTROS_CONTAGEM = ("cidade", "bairro", "plantado_por", "species")
+
+
+# Filtros numéricos do mapa: parâmetro GET -> lookup de Tree
+FILTROS_NUMERICOS = {
+    "altura_min": "altura__gte",
+    "altura_max": "altura__lte",
+    "dap_min": "dap__gte",
+    "dap_max": "dap__lte",
+}
+
+
+class FiltroInvalido(ValueError):
+    """Parâmetro de filtro do mapa com valor inválido"""
+
+
+def _numero(request, nome, tipo=float):
+    """Parâmetro GET convertido por `tipo`; FiltroInvalido se não for um número finito"""
+    try:
+        valor = tipo(request.GET[nome])
+    except ValueError:
+        raise FiltroInvalido(f'O filtro "{nome}" deve ser numérico')
+    if not math.isfinite(valor):
+        raise FiltroInvalido(f'O filtro "{nome}" deve ser finito')
+    return valor
+
+
+def filtros_arvores(request):
+    """Filtros do mapa (parâmetros GET) como argumentos de Tree.objects.filter, sempre restritos a uma cidade
+
+    Os valores numéricos são validados aqui, antes de qualquer consulta ou
+    resposta em blocos (FiltroInvalido; ver filtros_validados).
+    """
+    filters = {"city": cidades.cidade_da_requisicao(request)}
+    if request.GET.get("bairro"):
+        filters["bairro"] = request.GET["bairro"]
     if request.GET.get("nome_popular"):
         filters["nome_popular__icontains"] = request.GET["nome_popular"]
     if request.GET.get("nome_cientifico"):
@@ -33,33 +76,178 @@ def index(request):
     if request.GET.get("plantado_por"):
         filters["plantado_por__icontains"] = request.GET["plantado_por"]
     if request.GET.get("species"):
-        filters["species"] = request.GET["species"]
-    if request.GET.get("altura_min"):
-        filters["altura__gte"] = request.GET["altura_min"]
-    if request.GET.get("altura_max"):
-        filters["altura__lte"] = request.GET["altura_max"]
-    if request.GET.get("dap_min"):
-        filters["dap__gte"] = request.GET["dap_min"]
-    if request.GET.get("dap_max"):
-        filters["dap__lte"] = request.GET["dap_max"]
-    trees = (
-        Tree.objects.filter(**filters)
-        .select_related("species")
-        .annotate(n_posts=Count("posts"))
-    )
-    ecosystem_services = EcosystemServiceConfig.objects.filter(ativo=True).order_by(
-        "ordem_exibicao"
-    )
-    species_list = Tree.objects.values_list("species__id", "species__name").distinct()
+        filters["species"] = _numero(request, "species", int)
+    for parametro, lookup in FILTROS_NUMERICOS.items():
+        if request.GET.get(parametro):
+            filters[lookup] = _numero(request, parametro)
+    return filters
+
+
+def filtros_validados(view_func):
+    """Responde 400 (JSON) quando a view levanta FiltroInvalido ao ler os filtros do mapa"""
+    @wraps(view_func)
+    def wrapped_view(request, *args, **kwargs):
+        try:
+            return view_func(request, *args, **kwargs)
+        except FiltroInvalido as erro:
+            return JsonResponse({"erro": str(erro)}, status=400)
+    return wrapped_view
+
+
+def lista_especies(cidade):
+    """Espécies (id, nome) presentes no inventário da cidade, para o filtro do mapa"""
+    return Tree.objects.filter(city=cidade).values_list("species__id", "species__name").distinct()
+
+
+def index(request):
+    """Página do mapa; as árvores são carregadas depois pelo navegador via api_arvores"""
+    cidade = cidades.cidade_da_requisicao(request)
     context = {
-        "trees": trees,
-        "ecosystem_services": ecosystem_services,
-        "species_list": species_list,
+        "cidade": cidade,
+        "cidades": sorted(registry.cidades().values(), key=lambda cidade: cidade.nome),
+        "ecosystem_services": registry.servicos_ativos(),
+        "species_list": lista_especies(cidade),
         "request": request,
     }
     return render(request, "index.html", context)
 
 
+def _inteiro_positivo(request, nome):
+    """Parâmetro GET inteiro e positivo (None se ausente); ValueError se inválido"""
+    valor = request.GET.get(nome)
+    if not valor:
+        return None
+    valor = int(valor)
+    if valor < 1:
+        raise ValueError(nome)
+    return valor
+
+
+@filtros_validados
+def api_arvores(request):
+    """Árvores do mapa com os mesmos filtros do index, em JSON transmitido em blocos
+
+    Sem parâmetros de paginação vêm todas as árvores da seleção. Com `limite`
+    vem uma página, e `proximo` indica o `apos` da página seguinte.
+    """
+    try:
+        limite = _inteiro_positivo(request, "limite")
+        apos = _inteiro_positivo(request, "apos")
+    except ValueError:
+        return JsonResponse({"erro": "limite e apos devem ser inteiros positivos"}, status=400)
+    # Filtros validados antes de criar a resposta: depois do status 200 um erro não vira mais 400
+    trees = Tree.objects.filter(**filtros_arvores(request))
+    return StreamingHttpResponse(
+        mapa.json_arvores(trees, registry.servicos_ativos(), apos=apos, limite=limite),
+        content_type="application/json",
+    )
+
+
+@filtros_validados
+def api_pontos(request):
+    """Marcadores do mapa no formato colunar binário (ver mapa.py), com os mesmos filtros do index
+
+    Com `bbox` (oeste,sul,leste,norte) vêm só as árvores do retângulo, como faz o mapa.
+    """
+    trees = Tree.objects.filter(**filtros_arvores(request))
+    if request.GET.get("bbox"):
+        try:
+            oeste, sul, leste, norte = (float(valor) for valor in request.GET["bbox"].split(","))
+        except ValueError:
+            return JsonResponse({"erro": "informe bbox=oeste,sul,leste,norte"}, status=400)
+        trees = trees.filter(
+            latitude__gte=sul, latitude__lte=norte, longitude__gte=oeste, longitude__lte=leste
+        )
+    resposta = HttpResponse(
+        mapa.pontos_colunares(trees, registry.servicos_ativos()), content_type="application/octet-stream"
+    )
+    resposta["X-Formato-Pontos"] = str(mapa.VERSAO_PONTOS)
+    return resposta
+
+
+@filtros_validados
+def api_estatisticas(request):
+    """Totais da seleção do mapa (árvores, espécies, comentários e serviços), com os mesmos filtros do index"""
+    return JsonResponse(mapa.estatisticas(filtros_arvores(request), registry.servicos_ativos()))
+
+
+@filtros_validados
+def api_agrupamentos(request):
+    """Árvores do retângulo `bbox` (oeste,sul,leste,norte) agrupadas na grade do `zoom`, com os filtros do index"""
+    try:
+        oeste, sul, leste, norte = (float(valor) for valor in request.GET.get("bbox", "").split(","))
+        zoom = int(request.GET.get("zoom", ""))
+    except ValueError:
+        return JsonResponse({"erro": "informe bbox=oeste,sul,leste,norte e zoom inteiro"}, status=400)
+    if not (sul <= norte and oeste <= leste and 0 <= zoom <= 30):
+        return JsonResponse({"erro": "bbox ou zoom fora do intervalo"}, status=400)
+    return JsonResponse(
+        mapa.agrupamentos(filtros_arvores(request), registry.servicos_ativos(), sul, oeste, norte, leste, zoom)
+    )
+
+
+def api_arvore(request, tree_id):
+    """Detalhes de uma árvore para o painel do mapa (serviços, imagens, laudos e posts), com Cache-Control e ETag"""
+    detalhe = mapa.detalhe_arvore(tree_id)
+    if detalhe is None:
+        return JsonResponse({"erro": "Árvore não encontrada"}, status=404)
+    resposta = JsonResponse(detalhe)
+    etag = quote_etag(hashlib.md5(resposta.content).hexdigest())
+    resposta["ETag"] = etag
+    patch_cache_control(
+        resposta, public=True, max_age=getattr(settings, "MAPA_DETALHE_MAX_AGE", mapa.MAX_AGE_DETALHE)
+    )
+    return get_conditional_response(request, etag=etag, response=resposta)
+
+
+@filtros_validados
+def ladrilho_arvores(request, z, x, y):
+    """Ladrilho PNG da camada de árvores, com os filtros do index, lido do cache em disco ou desenhado"""
+    if z > ladrilhos.ZOOM_MAXIMO or x >= 2 ** z or y >= 2 ** z:
+        return JsonResponse({"erro": "Ladrilho fora da grade"}, status=404)
+    resposta = HttpResponse(ladrilhos.ladrilho(filtros_arvores(request), z, x, y), content_type="image/png")
+    etag = quote_etag(hashlib.md5(resposta.content).hexdigest())
+    resposta["ETag"] = etag
+    patch_cache_control(resposta, public=True, max_age=ladrilhos.MAX_AGE)
+    return get_conditional_response(request, etag=etag, response=resposta)
+
+
+@filtros_validados
+def api_diversidade(request):
+    """Riqueza, Shannon e Simpson da seleção do mapa e de cada bairro (JSON)
+
+    Com filtros apenas de bairro, plantado_por e espécie os índices vêm da
+    tabela de contagens mantida de forma incremental; os demais filtros
+    (nome, DAP, altura) exigem um GROUP BY sobre as árvores filtradas.
+    """
+    parametros = {chave for chave, valor in request.GET.items() if valor}
+    selecao = filtros_arvores(request)
+    if parametros <= set(FILTROS_CONTAGEM):
+        bairro = request.GET.get("bairro")
+        filtros = {
+            "cidade": selecao["city"],
+            "bairros": [bairro] if bairro else None,
+            "plantado_por": request.GET.get("plantado_por"),
+            "species": selecao.get("species"),
+        }
+        return JsonResponse({
+            "fonte": "contagens",
+            "selecao": diversidade.indices_selecao(**filtros),
+            "por_bairro": diversidade.indices_por_bairro(**filtros),
+        })
+    trees = Tree.objects.filter(**selecao)
+    return JsonResponse({
+        "fonte": "consulta",
+        "selecao": diversidade.indices_queryset(trees),
+        "por_bairro": diversidade.indices_queryset_por_bairro(trees),
+    })
+
+
+def api_cobertura(request):
+    """Área de copa e porcentagem de cobertura por bairro da cidade (JSON), em cache por versão do inventário"""
+    return JsonResponse(copa.cobertura_por_bairro(cidades.cidade_da_requisicao(request)))
+
+
 # ==================== AUTENTICAÇÃO ====================
 
 
@@ -139,8 +327,11 @@ def user_logout(request):
 @gestor_required
 def dashboard_gestor(request):
     """Dashboard para gestores (Nível 1)"""
+    cidade = cidades.cidade_da_requisicao(request)
+    arvores = Tree.objects.filter(city=cidade)
     context = {
-        "total_trees": Tree.objects.count(),
+        "cidade": cidade,
+        "total_trees": arvores.count(),
         "tecnicos_pendentes": CustomUser.objects.filter(
             user_type=CustomUser.UserType.TECNICO,
             aprovacao_status=CustomUser.ApprovalStatus.PENDENTE,
@@ -151,6 +342,8 @@ def dashboard_gestor(request):
         "notificacoes_pendentes": Notificacao.objects.filter(
             status=Notificacao.StatusNotificacao.PENDENTE
         ).count(),
+        # Somados no banco (SUM por serviço) sem instanciar as árvores
+        "totais_servicos": totais_servicos(arvores),
     }
     return render(request, "dashboards/gestor.html", context)
 